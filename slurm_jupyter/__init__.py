@@ -8,36 +8,59 @@ import time
 import select
 import selectors
 import getpass
-import webbrowser
-import platform
 import argparse
 import signal
+import json
+import glob
 from textwrap import wrap
-from distutils.version import LooseVersion
-from packaging import version
 from datetime import datetime
 
 from subprocess import PIPE, Popen
 from threading  import Thread, Event, Timer
-import webbrowser
 
 import shlex
+import secrets
 import shutil
 
-from colorama import init
-init()
-
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty  # python 3.x
 
-from .templates import slurm_server_script, slurm_batch_script, mem_script
-from .utils import execute, modpath, on_windows, str_to_mb, seconds2string, human2walltime, ExecuteException
+from .templates import slurm_server_script, slurm_batch_script, mem_script, activation_script, snapshot_activation, local_env_activation, probe_script, idle_watch, idle_script, workshop_task, beacon_script, stage_inputs, stage_script
+from .utils import execute, modpath, on_windows, str_to_mb, seconds2string, human2walltime, index_ranges, ExecuteException
+from .dag import build_dag, parse_after, topological_order, critical_path, notebook_metadata, DependencyException
+from .spike import make_variants, SpikeException
+from .backend import NEVER_SATISFIED, SubmitException, submit_graph, queued_job_ids, job_states, count_states
+from .cache import cache_key, parameter_digest, environment_digest, lookup, restore, store_command, evict
+from .progress import EVENT_DIR_VARIABLE, HEARTBEAT_INTERVAL, event_file, ProgressTracker
+from .profiling import notebook_files, cell_profiles, group_profiles, write_profiles
+from .tracing import PhaseTrace
+from .readiness import wait_for_server
+from .teardown import Teardown
+from .agent import SESSION_FILE_VARIABLE, start_agent, send as agent_send
+from .status import CACHE_MAX_AGE, fetch_status, add_tunnel_state
+from .clusters import AUTO, load_profiles, profiles_file, probe_clusters, expected_wait
+from .workshop import BEACON_ROOT, save_workshop, load_workshop, workshop_file, read_students, collect, count_task_states, roster_rows, write_roster
+from .memory import MemoryTrend, parse_sample, parse_oom, parse_kernels, format_kernels, suggested_memory, relaunch_argv
+
+# colorama is only needed to show colors on Windows (and is slow to import)
+if on_windows():
+    from colorama import init
+    init()
 
 # global run event to communicate with threads
 RUN_EVENT = None
 
+# global trace of the phases of the session
+TRACE = PhaseTrace()
+
+# marks the output of each sbatch when submitting scripts in bulk
+SUBMIT_MARK = 'SLURM_JUPYTER_SUBMIT'
+
+# prefix of lines the idle watcher (templates.idle_script) writes to the server's stderr
+IDLE_MARK = '[SlurmJptr idle]'
+
 # terminal colors
 BLUE = '\033[94m'
 GREEN = '\033[92m'
@@ -87,7 +110,12 @@ def check_for_conda_update():
     cmd[0] = shutil.which(cmd[0])    
     conda_search = subprocess.check_output(cmd, shell=False).decode()
     this_version = conda_search.strip().splitlines()[-1].split()[1]
-    if LooseVersion(newest_version) > LooseVersion(this_version):
+    from packaging.version import parse as parse_version, InvalidVersion
+    try:
+        newer = parse_version(newest_version) > parse_version(this_version)
+    except InvalidVersion:
+        return
+    if newer:
         msg = '\nA newer version of slurm-jupyter exists ({}). To update run:\n'.format(newest_version)
         msg += '\n\tconda install -c kaspermunch -c conda-forge slurm-jupyter={}\n'.format(newest_version)
         print(RED + msg + ENDC)
@@ -135,6 +163,275 @@ def get_cluster_uid(spec):
     return uid
 
 
+# bump this to remake all activation snapshots
+ACTIVATION_VERSION = '1'
+
+def cached_activation(spec, verbose=False):
+    """Makes sure there is an up-to-date snapshot of the environment activation 
+    on the cluster, so the job can source it instead of starting conda. The 
+    snapshot is only remade when the environment changes.
+
+    Args:
+        spec (dict): Parameter specification.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        dict: Snapshot path, conda root and environment prefix, and status
+            ('cached', 'created' or 'missing' if the environment does not exist).
+    """
+    cmd = 'ssh -q {user}@{frontend} sh -s'.format(**spec)
+    script = activation_script.format(version=ACTIVATION_VERSION, **spec)
+    if verbose: print(cmd, script, sep='\n')
+    stdout, stderr = execute(cmd, stdin=script.encode())
+    activation = {}
+    for line in stdout.decode().splitlines():
+        key, _, value = line.partition('=')
+        if key in ['status', 'snapshot', 'root', 'prefix']:
+            activation[key] = value.strip()
+    if verbose: print(activation)
+    return activation
+
+
+def args_with_profile(parser, profile):
+    """Parses the command line with option defaults from a cluster profile.
+    Options given on the command line take precedence.
+
+    Args:
+        parser (argparse.ArgumentParser): Argument parser.
+        profile (dict): Option destinations mapped to values.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    saved = dict((dest, parser.get_default(dest)) for dest in profile)
+    parser.set_defaults(**profile)
+    try:
+        return parser.parse_args()
+    finally:
+        parser.set_defaults(**saved)
+
+
+def resolve_cluster(parser, args):
+    """Applies the cluster profile named by --cluster. In auto mode, all
+    clusters are probed at the same time for reachability, the environment,
+    the predicted start of a job (sbatch --test-only) and idle nodes (sinfo),
+    and the profile of the cluster expected to start the server first is applied.
+
+    Args:
+        parser (argparse.ArgumentParser): Argument parser.
+        args (argparse.Namespace): Parsed arguments.
+
+    Returns:
+        (argparse.Namespace, dict): Arguments and, in auto mode, the probe of the chosen cluster.
+    """
+    try:
+        profiles = load_profiles()
+    except ValueError as e:
+        print("Could not read cluster profiles in {}: {}".format(profiles_file(), e))
+        sys.exit()
+
+    if args.cluster != AUTO:
+        if args.cluster not in profiles:
+            print("No cluster profile named {} in {}".format(args.cluster, profiles_file()))
+            sys.exit()
+        return args_with_profile(parser, profiles[args.cluster]), None
+
+    if not profiles:
+        print("No cluster profiles in {}".format(profiles_file()))
+        sys.exit()
+    if args.attach:
+        print("Use --cluster with a profile name to attach to a server")
+        sys.exit()
+
+    targets = []
+    for name, profile in profiles.items():
+        profile_args = args_with_profile(parser, profile)
+        activation = activation_script.format(version=ACTIVATION_VERSION, tmp_dir='.slurm_jupyter',
+                                              environment_name=profile_args.environment)
+        memory = profile_args.total_memory or '{}m'.format(str_to_mb(profile_args.memory_per_cpu) * profile_args.cores)
+        script = probe_script.format(activation=activation, queue=profile_args.queue, nr_cores=profile_args.cores,
+                                     walltime=normalize_walltime(profile_args.time), memory_mb=int(str_to_mb(memory)),
+                                     account_option=profile_args.account and '-A ' + profile_args.account or '')
+        targets.append((name, profile_args.user, profile_args.frontend, script))
+
+    print(BLUE+log_prefix()+'Probing clusters: {}'.format(', '.join(profiles))+ENDC)
+    probes = probe_clusters(targets, verbose=args.verbose)
+    for probe in probes:
+        if not probe['reachable']:
+            status = 'unreachable: {}'.format(probe.get('error', ''))
+        elif not probe['usable']:
+            status = 'environment not found'
+        else:
+            status = 'expected start in {}, {} idle nodes'.format(format_duration(expected_wait(probe)), probe['idle'])
+        print(BLUE+log_prefix()+'  {:<12} {:<25} {} ({:.1f} s)'.format(probe['name'], probe['frontend'], status, probe['latency'])+ENDC)
+    best = probes[0]
+    if not best['usable']:
+        print(RED+log_prefix()+'No cluster can run the server'+ENDC)
+        sys.exit()
+    print(BLUE+log_prefix()+'Using cluster {}'.format(best['name'])+ENDC)
+    return args_with_profile(parser, profiles[best['name']]), best
+
+
+def normalize_walltime(walltime):
+    """Translates walltimes like 30m or 5h to days-hours:mins:secs. Others are returned as they are.
+
+    Args:
+        walltime (str): Walltime.
+
+    Returns:
+        str: Walltime.
+    """
+    if walltime[-1] in 'smhdSMHD':
+        return human2walltime(**{walltime[-1].lower(): int(walltime[:-1])})
+    return walltime
+
+
+def walltime_seconds(walltime):
+    """Translates a slurm walltime (days-hours:mins:secs) to seconds.
+
+    Args:
+        walltime (str): Walltime.
+
+    Returns:
+        int: Seconds.
+    """
+    tup = walltime.split('-')
+    if len(tup) == 1:
+        days, (hours, mins, secs) = 0, tup[0].split(':')
+    else:
+        days, (hours, mins, secs) = tup[0], tup[1].split(':')
+    return int(days) * 86400 + int(hours) * 3600 + int(mins) * 60 + int(secs)
+
+
+def idle_spec(spec, idle_timeout=0, idle_warning=10, cull_kernels=0):
+    """Adds the idle watcher and kernel culling options to the server job.
+
+    Args:
+        spec (dict): Parameter specification.
+        idle_timeout (float, optional): Minutes without activity before the server is shut down
+            and the job cancelled. 0 disables the watcher. Defaults to 0.
+        idle_warning (float, optional): Minutes before the shutdown the user is warned. Defaults to 10.
+        cull_kernels (float, optional): Minutes without activity before a kernel is shut down.
+            0 disables culling. Defaults to 0.
+    """
+    spec['idle_watch'] = ''
+    if idle_timeout:
+        spec['idle_watch'] = idle_watch.format(idle_timeout=idle_timeout, idle_warning=min(idle_warning, idle_timeout),
+                                               walltime_seconds=walltime_seconds(spec['walltime']),
+                                               hostport=spec['hostport'], idle_script=idle_script)
+    spec['jupyter_options'] = ''
+    if cull_kernels:
+        spec['jupyter_options'] = '--MappingKernelManager.cull_idle_timeout={} ' \
+            '--MappingKernelManager.cull_interval=60'.format(int(cull_kernels * 60))
+
+
+def stage_spec(spec, paths, checksum=False):
+    """Adds the staging of input files to node-local disk to the job.
+
+    Args:
+        spec (dict): Parameter specification.
+        paths (list): Files and directories on the cluster to stage. 
+        checksum (bool, optional): Compare the content of files with the same 
+            size but another mtime than the local copy. Defaults to False.
+    """
+    spec['stage'] = ''
+    if paths:
+        spec['stage'] = stage_inputs.format(checksum=int(checksum), paths=' '.join(shlex.quote(p) for p in paths),
+                                            stage_script=stage_script)
+
+
+def local_conda_environment(environment_name=''):
+    """Finds the prefix of a conda environment on this machine.
+
+    Args:
+        environment_name (str, optional): Environment name. Defaults to the active environment.
+
+    Returns:
+        (str, str, str): Environment name, prefix and conda root prefix (None if not found).
+    """
+    root = os.environ.get('CONDA_EXE') and os.path.dirname(os.path.dirname(os.environ['CONDA_EXE'])) or ''
+    if not environment_name:
+        prefix = os.environ.get('CONDA_PREFIX')
+        return prefix and os.path.basename(prefix), prefix, root
+    try:
+        stdout, stderr = execute('conda env list --json')
+    except (ExecuteException, TypeError, OSError): # TypeError if conda is not on PATH
+        return environment_name, None, root
+    for prefix in json.loads(stdout.decode())['envs']:
+        if os.path.basename(prefix) == environment_name:
+            return environment_name, prefix, root
+    return environment_name, None, root
+
+
+def local_env_spec(spec, environment_prefix, env_timings='', fallback_activation=''):
+    """Makes the part of a job script that runs the job from a copy of the 
+    environment unpacked to node-local disk.
+
+    Args:
+        spec (dict): Parameter specification with environment_name and conda_root.
+        environment_prefix (str): Path to environment on the shared file system.
+        env_timings (str, optional): Comma separated modules to time importing from 
+            the shared and the local environment. Defaults to ''.
+        fallback_activation (str, optional): Shell code activating the shared environment 
+            if the environment cannot be unpacked. Defaults to ''.
+
+    Returns:
+        str: Shell code.
+    """
+    if not re.match(r'^[\w.,]*$', env_timings):
+        print("--env-timings must be a comma separated list of modules")
+        sys.exit()
+    return local_env_activation.format(environment_prefix=environment_prefix, env_timings=env_timings,
+                                       fallback_activation=fallback_activation or ':', **spec)
+
+
+def submit_scripts(user, frontend, scripts, directory=None, verbose=False):
+    """Submits slurm job scripts with a single ssh call. Each script is piped
+    to sbatch on the frontend, so no script files are written.
+
+    Args:
+        user (str): User name on the cluster.
+        frontend (str): Cluster frontend.
+        scripts (list): Job scripts.
+        directory (str, optional): Directory to make before submitting (E.g. for the
+            output files of the jobs). Defaults to None.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        list: (job id, sbatch output) for each script. The job id is None if
+            the script was not submitted.
+    """
+    # heredoc delimiter that is not in any of the scripts
+    delimiter = 'SLURM_JUPYTER_SCRIPT_' + secrets.token_hex(8)
+    lines = []
+    if directory:
+        lines.append('mkdir -p {}'.format(shlex.quote(directory)))
+    for i, script in enumerate(scripts):
+        lines += ['echo "{} {}"'.format(SUBMIT_MARK, i),
+                  "sbatch --parsable 2>&1 <<'{}'".format(delimiter), script.rstrip('\n'), delimiter,
+                  'echo "{} {} $?"'.format(SUBMIT_MARK, i)]
+    cmd = 'ssh -q {}@{} sh -s'.format(user, frontend)
+    if verbose: print(cmd, *lines, sep='\n')
+    stdout, stderr = execute(cmd, stdin='\n'.join(lines).encode() + b'\n')
+
+    # output of each sbatch is between the two marker lines
+    results = [(None, '')] * len(scripts)
+    index, output = None, []
+    for line in stdout.decode().splitlines():
+        if not line.startswith(SUBMIT_MARK):
+            output.append(line)
+            continue
+        fields = line.split()
+        if len(fields) == 2:
+            index, output = int(fields[1]), []
+            continue
+        # --parsable prints jobid[;cluster]
+        m = re.search(r'^(\d+)(;\S+)?$', '\n'.join(output), re.MULTILINE)
+        job_id = fields[2] == '0' and m and m.group(1) or None
+        results[index] = (job_id, '\n'.join(output).strip())
+    return results
+
+
 def submit_slurm_server_job(spec, verbose=False):
     """Submits slurm job that runs jupyter server.
 
@@ -145,41 +442,38 @@ def submit_slurm_server_job(spec, verbose=False):
     Returns:
         str: Slurm job id.
     """
-
-    cmd = 'ssh {user}@{frontend} cat - > {tmp_dir}/{tmp_script} ; mkdir -p {tmp_dir} ; sbatch {tmp_dir}/{tmp_script} '.format(**spec)
-        
-    if verbose: print("script ssh transfer:", cmd, sep='\n')
-
     script = slurm_server_script.format(**spec)
     if verbose: print("slurm script:", script, sep='\n')
 
-    script = script.encode()
-    stdout, stderr = execute(cmd, stdin=script) # hangs until submission
-
-    # get stdout and stderr and get jobid
-    stdout = stdout.decode()
-    stderr = stderr.decode()
+    # one ssh call makes the directory for the output files and submits the script
     try:
-        job_id = re.search(r'Submitted batch job (\d+)', stdout).group(1)
-    except AttributeError:
+        [(job_id, output)] = submit_scripts(spec['user'], spec['frontend'], [script],
+                                            directory=spec['tmp_dir'], verbose=verbose)
+    except ExecuteException as e:
+        job_id, output = None, str(e)
+    if job_id is None:
         print(BLUE+'Slurm job submission failed'+ENDC)
-        print(stdout)
-        print(stderr)
+        print(output)
         sys.exit()
     print(BLUE+log_prefix()+"Submitted slurm with job id:", job_id, ENDC)
 
     return job_id
 
 
-def submit_slurm_batch_job(spec, verbose=False):
+def submit_slurm_batch_job(spec, dependencies=None, verbose=False):
     """Submits slurm job that runs batch job.
 
     Args:
         spec (dict): Parameter specification.
+        dependencies (list, optional): Ids of jobs that must complete first. The kind of 
+            dependency is given by spec['dependency_type'] (default afterok). Defaults to None.
         verbose (bool, optional): Verbose if True. Defaults to False.
 
     Returns:
         str: Slurm job id.
+
+    Raises:
+        ExecuteException: If the job could not be submitted.
     """
 
     script = slurm_batch_script.format(**spec)
@@ -189,21 +483,23 @@ def submit_slurm_batch_job(spec, verbose=False):
     with open(tmp_script_path, 'w') as f:
         f.write(script)
 
-    cmd = 'sbatch {tmp_dir}/{tmp_script} '.format(**spec)
+    cmd = 'sbatch --parsable '
+    if dependencies:
+        # jobs whose dependencies fail are removed instead of pending forever
+        cmd += '--dependency={}:{} --kill-on-invalid-dep=yes '.format(
+            spec.get('dependency_type', 'afterok'), ':'.join(dependencies))
+    cmd += '{tmp_dir}/{tmp_script} '.format(**spec)
     if verbose: print("command:", cmd, sep='\n')
 
     stdout, stderr = execute(cmd, shell=False) # hangs until submission
 
-    # get stdout and stderr and get jobid
+    # get stdout and stderr and get jobid (--parsable prints jobid[;cluster])
     stdout = stdout.decode()
     stderr = stderr.decode()
     try:
-        job_id = re.search(r'Submitted batch job (\d+)', stdout).group(1)
+        job_id = re.match(r'(\d+)', stdout.strip()).group(1)
     except AttributeError:
-        print('Slurm job submission failed')
-        print(stdout)
-        print(stderr)
-        sys.exit()
+        raise ExecuteException('Slurm job submission failed:\n{}{}'.format(stdout, stderr))
     print("Submitted slurm with job id:", job_id)
 
     return job_id
@@ -219,22 +515,34 @@ def wait_for_job_allocation(spec, verbose=False):
     Returns:
         str: Id of node running job.
     """
-    # wait a bit to make sure jobinfo database is updated
-    time.sleep(20)
-
+    # polls squeue, often at first and then every 10 seconds. A job that
+    # squeue does not list (yet or anymore) is looked up with sacct
     regex = re.compile(r'(s\d+n\d+|cn-\d+)')
-    cmd = 'ssh {user}@{frontend} squeue --noheader --format %N -j {job_id}'.format(**spec)
-    if verbose: print(cmd)
-    stdout, stderr = execute(cmd)
-    stdout = stdout.decode()
-    m = regex.search(stdout)
-
-    while not m or m.group(1) == 'None':
-        time.sleep(10)
-        if verbose: print(cmd)
-        stdout, stderr = execute(cmd)
+    squeue_cmd = "ssh {user}@{frontend} squeue --noheader --format \"'%T %N'\" -j {job_id}".format(**spec)
+    sacct_cmd = 'ssh {user}@{frontend} sacct -n -X -P -o State,NodeList -j {job_id}'.format(**spec)
+    TRACE.begin('queue wait')
+    polls, delay = 0, 1
+    while True:
+        if verbose: print(squeue_cmd)
+        stdout, stderr = execute(squeue_cmd, check_failure=False)
         stdout = stdout.decode()
+        polls += 1
+        if not stdout.strip():
+            if verbose: print(sacct_cmd)
+            stdout, stderr = execute(sacct_cmd, check_failure=False)
+            stdout = stdout.decode()
+            state = stdout.strip() and stdout.replace('|', ' ').split()[0] or None
+            if state and state not in ACTIVE_STATES:
+                TRACE.end('queue wait', squeue_calls=polls)
+                print(RED+log_prefix()+'Slurm job {} ended ({}) before it was allocated a node.'.format(
+                    spec['job_id'], state)+ENDC)
+                raise StopServerException
         m = regex.search(stdout)
+        if m:
+            break
+        time.sleep(delay)
+        delay = min(10, delay * 2)
+    TRACE.end('queue wait', squeue_calls=polls)
     node_id = m.group(1)
     if verbose: print(stdout)
     
@@ -303,13 +611,17 @@ def open_jupyter_stdout_connection(spec, verbose=False):
 
     file_created = False
     cmd = 'ssh -q {user}@{frontend} [[ -f {tmp_dir}/{tmp_name}.{job_id}.out ]] && echo "File exists"'.format(**spec)
+    TRACE.begin('out log wait')
+    polls = 0
     while not file_created:
         if verbose: print("testing existence:", cmd)
         stdout, stderr = execute(cmd, check_failure=False)
+        polls += 1
         if "File exists" in stdout.decode():
             file_created = True
         else:
             time.sleep(10)
+    TRACE.end('out log wait', ssh_calls=polls)
 
     # cmd = "ssh {user}@{frontend} 'tail --pid=`ps -o ppid= $$` -F -n +1 {tmp_dir}/{tmp_name}.{job_id}.out'".format(**spec)
     cmd = "ssh {user}@{frontend} 'tail -F -n +1 {tmp_dir}/{tmp_name}.{job_id}.out'".format(**spec)
@@ -332,13 +644,17 @@ def open_jupyter_stderr_connection(spec, verbose=False):
 
     file_created = False
     cmd = 'ssh -q {user}@{frontend} [[ -f {tmp_dir}/{tmp_name}.{job_id}.err ]] && echo "File exists"'.format(**spec)
+    TRACE.begin('err log wait')
+    polls = 0
     while not file_created:
         if verbose: print("testing existence:", cmd)
         stdout, stderr = execute(cmd, check_failure=False)
+        polls += 1
         if "File exists" in stdout.decode():
             file_created = True
         else:
             time.sleep(10)
+    TRACE.end('err log wait', ssh_calls=polls)
 
     # cmd = "ssh {user}@{frontend} 'tail --pid=`ps -o ppid= $$` -F -n +1 {tmp_dir}/{tmp_name}.{job_id}.err'".format(**spec)
     cmd = "ssh {user}@{frontend} 'tail -F -n +1 {tmp_dir}/{tmp_name}.{job_id}.err'".format(**spec)
@@ -407,6 +723,9 @@ def open_browser(spec, force_chrome=False):
     Args:
         spec (dict): Parameter specification.
     """
+    import platform
+    import webbrowser
+
     if not spec['url']:
         spec['url'] = 'https://localhost:{port}'.format(**spec)
     if platform.platform().startswith('Darwin') or platform.platform().startswith('macOS-'):
@@ -428,6 +747,121 @@ def open_browser(spec, force_chrome=False):
         else:
             webbrowser.open(spec['url'], new=2)
 
+def open_browser_when_ready(spec, trace_file, force_chrome=False, verbose=False):
+    """Probes the jupyter server through the forwarded port and opens the 
+    browser once it is ready. Runs in its own thread until ready or until 
+    RUN_EVENT is cleared.
+
+    Args:
+        spec (dict): Parameter specification.
+        trace_file (str): File to save the trace of the startup phases to.
+        force_chrome (bool, optional): Open in Chrome if available. Defaults to False.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+    """
+    TRACE.begin('readiness')
+    ready = wait_for_server(spec, RUN_EVENT, verbose=verbose)
+    if ready is None:
+        return
+    spec['url'], counts = ready
+    TRACE.end('readiness', **counts)
+    record_session(spec)
+    open_browser(spec, force_chrome=force_chrome)
+    TRACE.mark('browser open')
+    TRACE.save(trace_file)
+    print(BLUE+log_prefix()+'Started in '+TRACE.breakdown()+ENDC)
+    prefix = log_prefix()
+    print(BLUE+prefix+'Your browser may complain that the connection is not private.\n',
+               prefix+' In Safari, you can proceed to allow this. In Chrome, you need"\n',
+               prefix+' to simply type the characters "thisisunsafe" while in the Chrome window.\n',
+               prefix+' Once ready, jupyter may ask for your cluster password.'+ENDC, sep='')
+
+
+def offer_relaunch(total_memory):
+    """Asks whether to relaunch the server with more memory after an OOM kill,
+    and replaces this process with the new slurm-jupyter if so.
+
+    Args:
+        total_memory (str): Memory size (E.g. '12G').
+    """
+    # the teardown ignores Ctrl-C, which should end the question
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        answer = input('Relaunch with --total-memory {}? [y/N] '.format(total_memory))
+    except (EOFError, KeyboardInterrupt):
+        return
+    if answer.strip().lower() not in ('y', 'yes'):
+        return
+    argv = relaunch_argv(sys.argv[1:], total_memory)
+    print(BLUE+log_prefix()+'slurm-jupyter '+' '.join(argv)+ENDC)
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, '-c', 'import sys; sys.argv[0] = "slurm-jupyter"; '
+                                'from slurm_jupyter import slurm_jupyter; slurm_jupyter()'] + argv)
+
+
+def record_session(spec):
+    """Writes the job details of a session run by the agent to the file the
+    agent reads them from. Does nothing in sessions not run by the agent.
+
+    Args:
+        spec (dict): Parameter specification.
+    """
+    path = os.environ.get(SESSION_FILE_VARIABLE)
+    if not path:
+        return
+    info = dict((key, spec.get(key)) for key in ['job_id', 'job_name', 'node', 'port', 'hostport', 'url'])
+    with open(path, 'w') as f:
+        json.dump(info, f)
+
+
+def agent_command(args, argv):
+    """Runs a session in the background agent or reports on or stops its sessions.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+        argv (list): Command line arguments.
+    """
+    if on_windows():
+        # the agent needs Unix-domain sockets and fork
+        print("The agent mode (--agent, --agent-status and --agent-stop) is not supported on Windows")
+        sys.exit(1)
+
+    if args.agent_status:
+        reply = agent_send({'cmd': 'status'})
+        if reply is None:
+            print("No agent running")
+            return
+        if not reply['sessions']:
+            print("No agent sessions")
+        for session in reply['sessions']:
+            color = session['state'] == 'running' and BLUE or ''
+            print(color + '{:>4} {:<9} job {:<10} node {:<12} started {} {}'.format(
+                session['id'], session['state'], str(session.get('job_id') or '-'), session.get('node') or '-',
+                datetime.fromtimestamp(session['started']).strftime('%Y-%m-%d %H:%M'),
+                session.get('url') or '') + (color and ENDC))
+            print('     log: ' + session['log_file'])
+        return
+
+    if args.agent_stop:
+        reply = agent_send({'cmd': 'stop', 'session': args.agent_stop})
+        if reply is None:
+            print("No agent running")
+        elif not reply['stopped']:
+            print("No running agent session: {}".format(args.agent_stop))
+        else:
+            print(BLUE+log_prefix()+'Stopping session(s) {} and canceling their slurm jobs'.format(', '.join(reply['stopped']))+ENDC)
+        return
+
+    if not start_agent():
+        print("Could not start the agent. See {}".format(os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'agent', 'agent.log')))
+        sys.exit(1)
+    argv = [a for a in argv if a != '--agent']
+    reply = agent_send({'cmd': 'launch', 'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)})
+    session = reply['session']
+    print(BLUE+log_prefix()+'Session {} runs in the background agent. The browser opens when the server is ready.'.format(session['id'])+ENDC)
+    print(BLUE+log_prefix()+'Log: {}'.format(session['log_file'])+ENDC)
+    print(BLUE+log_prefix()+'To stop it, run: slurm-jupyter --agent-stop {}'.format(session['id'])+ENDC)
+
+
 # TODO: make a check of jupyter lab version and give a user warning or abort if it is not 3
 def check_jupyterlab_version(spec):
     """Check that jupyter lab version is >=3
@@ -449,8 +883,9 @@ def check_jupyterlab_version(spec):
         stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
     assert not process.returncode
-    name, version, package = stdout.split()
-    return version.parse(version) >= version.parse("3.0.0")
+    name, jupyterlab_version, package = stdout.split()
+    from packaging.version import parse as parse_version
+    return parse_version(jupyterlab_version) >= parse_version("3.0.0")
 
 def transfer_memory_script(spec, verbose=False):
     """Transvers the a python script to the cluster, which monitors memory use on the node.
@@ -461,8 +896,7 @@ def transfer_memory_script(spec, verbose=False):
     """
     script = mem_script.format(**spec)
 
-    # cmd = 'ssh {user}@{frontend} cat - > {tmp_dir}/{mem_script} ; mkdir -p {tmp_dir}'.format(**spec)
-    cmd = 'ssh {user}@{frontend} cat - > {tmp_dir}/{mem_script} ; mkdir -p {tmp_dir}'.format(**spec)
+    cmd = 'ssh {user}@{frontend} mkdir -p {tmp_dir} && cat - > {tmp_dir}/{mem_script}'.format(**spec)
         
     if verbose: print("memory script:", script, sep='\n')
 
@@ -540,15 +974,381 @@ def add_slurm_arguments(parser):
                     action='store_true',
                     default=False,
                     help="Start an ipcluster")                    
+    parser.add_argument("--local-env",
+                    dest="local_env",
+                    action='store_true',
+                    help="Run from a copy of the environment unpacked to node-local disk ($TMPDIR) for faster "
+                         "imports. The environment is packed with conda-pack, which must be installed, "
+                         "and only repacked when it changes.")
+    parser.add_argument("--env-timings",
+                    dest="env_timings",
+                    type=str,
+                    default='',
+                    help="With --local-env, time importing these modules (comma separated, E.g. numpy,pandas,scipy) "
+                         "from the shared and the local environment and write the result to the job log.")
+    parser.add_argument("--stage",
+                    dest="stage",
+                    action='append',
+                    default=[],
+                    metavar='PATH',
+                    help="Copy this input file or directory on the cluster to node-local disk ($TMPDIR) before "
+                         "the job runs jupyter. Can be given more than once. The local paths are in $SLURM_JUPYTER_STAGED "
+                         "(separated by ':') and files that have not changed since they were last staged on the "
+                         "node are not copied again.")
+    parser.add_argument("--stage-checksum",
+                    dest="stage_checksum",
+                    action='store_true',
+                    help="With --stage, also skip files with the same content as the local copy when their "
+                         "mtime differs.")
 
 
 def log_prefix():
     return f'[I {str(datetime.now())[:-3]} SlurmJptr] '
 
-def slurm_jupyter():
+def print_status(jobs, fetched):
+    """Prints a table of servers and slurm-nb-run jobs.
+
+    Args:
+        jobs (list): Job dicts from fetch_status.
+        fetched (float): Time the status was fetched.
+    """
+    def mb(value):
+        if value is None:
+            return '-'
+        return value >= 1024 and '{:.1f}G'.format(value / 1024) or '{:.0f}M'.format(value)
+
+    print(log_prefix() + 'Status from {} ({} s ago)'.format(
+        datetime.fromtimestamp(fetched).strftime('%H:%M:%S'), int(time.time() - fetched)))
+    if not jobs:
+        print("No jupyter servers or slurm-nb-run jobs found")
+        return
+    header = '{:>10} {:<7} {:<30} {:<10} {:<12} {:>11} {:>8} {:>8}  {}'.format(
+        'JOBID', 'KIND', 'NAME', 'STATE', 'NODE', 'TIME LEFT', 'MEM REQ', 'MEM USED', 'TUNNEL')
+    print(BLUE + header + ENDC)
+    for job in jobs:
+        tunnel = job.get('tunnel') and '{} (localhost:{})'.format(job['tunnel'], job['local_port']) or '-'
+        used, requested = job['memory_used'], job['memory_requested']
+        color = ''
+        if used is not None and requested and used > 0.9 * requested or job.get('tunnel') == 'down':
+            color = RED
+        elif job['state'] == 'RUNNING':
+            color = GREEN
+        print(color + '{:>10} {:<7} {:<30} {:<10} {:<12} {:>11} {:>8} {:>8}  {}'.format(
+            job['job_id'], job['kind'], job['name'][:30], job['state'], job['node'] or '-', job['time_left'],
+            mb(requested), mb(used), tunnel) + (color and ENDC))
+
+
+def slurm_jupyter_status(argv=None):
+    """Command line script (slurm-jupyter status) showing the jupyter servers
+    and slurm-nb-run jobs of a user.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv[2:].
+    """
+    parser = argparse.ArgumentParser(prog='slurm-jupyter status',
+                                     description="Shows the node, walltime left, requested and used memory "
+                                                 "and port forwarding of your jupyter servers and slurm-nb-run jobs.")
+    parser.add_argument("-u", "--user",
+                    dest="user",
+                    type=str,
+                    default=getpass.getuser(),
+                    help="User name on the cluster.")
+    parser.add_argument("-f", "--frontend", 
+                    dest="frontend", 
+                    type=str, 
+                    default="login.genome.au.dk", 
+                    help="URL to cluster frontend.")
+    parser.add_argument("--json",
+                    dest="json",
+                    action='store_true',
+                    help="Print the status as JSON.")
+    parser.add_argument("--watch",
+                    dest="watch",
+                    type=float,
+                    nargs='?',
+                    const=CACHE_MAX_AGE,
+                    default=None,
+                    metavar='SECONDS',
+                    help="Update the status every SECONDS seconds (default {}) until Ctrl-C.".format(CACHE_MAX_AGE))
+    parser.add_argument("--max-age",
+                    dest="max_age",
+                    type=float,
+                    default=CACHE_MAX_AGE,
+                    help="Reuse a status fetched less than this many seconds ago.")
+    parser.add_argument("-v", "--verbose",
+                    dest="verbose",
+                    action='store_true',
+                    help="Print debugging information")
+    args = parser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    try:
+        while True:
+            try:
+                jobs, fetched = fetch_status(args.user, args.frontend, max_age=args.max_age, verbose=args.verbose)
+            except ExecuteException as e:
+                print("Could not get the status from {}@{}:".format(args.user, args.frontend))
+                print(e)
+                sys.exit(1)
+            add_tunnel_state(jobs, args.frontend)
+            if args.json:
+                print(json.dumps({'fetched': fetched, 'jobs': jobs}, indent=2), flush=True)
+            else:
+                if args.watch and sys.stdout.isatty():
+                    # clear screen
+                    print('\033[2J\033[H', end='')
+                print_status(jobs, fetched)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_roster(rows):
+    """Prints the student, node, port and URL of each server in a workshop."""
+    for row in rows:
+        if row['url']:
+            print('{:<20} {:<10} {:<6} {}'.format(row['student'], row['node'], row['port'], row['url']))
+        else:
+            print(RED+'{:<20} not ready ({})'.format(row['student'], row['state'].lower())+ENDC)
+
+
+def workshop_start(args):
+    """Submits the job array of a workshop and waits for the servers to be ready.
+
+    Args:
+        args (argparse.Namespace): Arguments of slurm-jupyter workshop start.
+    """
+    students = args.students and read_students(args.students) or \
+        ['student{:02d}'.format(i + 1) for i in range(args.count)]
+    if not students:
+        print("No students. Use --students or --count")
+        sys.exit(1)
+
+    spec = {'user': args.user,
+            'frontend': args.frontend,
+            'environment_name': args.environment,
+            'run': args.run,
+            'walltime': normalize_walltime(args.time),
+            'queue': args.queue,
+            'nr_nodes': args.nodes,
+            'nr_cores': args.cores,
+            'cwd': os.getcwd(),
+            'sources_loaded': '',
+            'tmp_name': 'slurm_jupyter',
+            'tmp_dir': '.slurm_jupyter',
+            'job_name': "sjup_{}_{}_{}_{}".format(args.name, getpass.getuser(), args.environment, int(time.time())),
+            'ipcluster': args.ipcluster and "ipcluster start -n {} &".format(args.cores) or '',
+            'gres': args.queue == 'gpu' and '#SBATCH --gres=gpu:1' or '',
+            'account_spec': args.account and "#SBATCH -A {}".format(args.account) or '',
+            'array_spec': '#SBATCH --array=0-{}'.format(len(students) - 1)}
+    if args.total_memory:
+        spec['memory_spec'] = '#SBATCH --mem {}'.format(int(str_to_mb(args.total_memory)))
+    else:
+        spec['memory_spec'] = '#SBATCH --mem-per-cpu {}'.format(int(str_to_mb(args.memory_per_cpu)))
+
+    try:
+        activation = cached_activation(spec, verbose=args.verbose)
+        base_port = args.hostport or 20000 + get_cluster_uid(spec) % 40000
+    except (ExecuteException, AssertionError) as e:
+        print("Could not resolve activation of environment {environment_name} at {user}@{frontend}:".format(**spec))
+        print(e)
+        sys.exit(1)
+    if activation.get('status') == 'missing':
+        print("Specified environment {environment_name} was not found at {user}@{frontend}".format(**spec))
+        sys.exit(1)
+    spec['activation_snapshot'] = activation['snapshot']
+    spec['conda_root'] = activation['root']
+    spec['activation'] = snapshot_activation.format(**spec)
+
+    # each task runs its server on the base port plus its task id
+    spec['hostport'] = '$HOSTPORT'
+    spec['task_setup'] = workshop_task.format(base_port=base_port, beacon_root=BEACON_ROOT,
+                                              beacon_script=beacon_script)
+    idle_spec(spec, idle_timeout=args.idle_timeout)
+    stage_spec(spec, args.stage, checksum=args.stage_checksum)
+
+    script = slurm_server_script.format(**spec)
+    if args.verbose: print("slurm script:", script, sep='\n')
+    try:
+        [(job_id, output)] = submit_scripts(spec['user'], spec['frontend'], [script],
+                                            directory=spec['tmp_dir'], verbose=args.verbose)
+    except ExecuteException as e:
+        job_id, output = None, str(e)
+    if job_id is None:
+        print(BLUE+'Slurm job submission failed'+ENDC)
+        print(output)
+        sys.exit(1)
+
+    workshop = {'job_id': job_id, 'user': args.user, 'frontend': args.frontend, 'run': args.run,
+                'students': students, 'base_port': base_port, 'created': time.time()}
+    save_workshop(workshop)
+    print(BLUE+log_prefix()+'Submitted job array {} with {} servers'.format(job_id, len(students))+ENDC)
+    print(BLUE+log_prefix()+'To stop all servers: slurm-jupyter workshop stop {}'.format(job_id)+ENDC)
+
+    roster = args.roster or 'workshop_{}.csv'.format(job_id)
+    start, last, states, beacons, seen = time.time(), None, {}, {}, False
+    try:
+        while time.time() - start < args.wait:
+            try:
+                states, beacons = collect(args.user, args.frontend, job_id, verbose=args.verbose)
+            except ExecuteException as e:
+                print(RED+log_prefix()+'Could not get the state of the servers: {}'.format(e)+ENDC)
+                time.sleep(args.interval)
+                continue
+            counts = count_task_states(states, beacons, len(students), seen=seen)
+            seen = seen or bool(states)
+            progress = 'Ready {ready}/{total}, starting {starting}, pending {pending}, ended {ended}'.format(
+                total=len(students), **counts)
+            if progress != last:
+                print(BLUE+log_prefix()+progress+ENDC)
+                last = progress
+            if counts['ready'] + counts['ended'] == len(students):
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print(BLUE+'\nNot waiting for the remaining servers. They keep running.'+ENDC)
+
+    rows = roster_rows(workshop, states, beacons)
+    write_roster(roster, rows)
+    print_roster(rows)
+    print(BLUE+log_prefix()+'Roster written to {}. Update it with: slurm-jupyter workshop roster {}'.format(
+        roster, job_id)+ENDC)
+
+
+def slurm_jupyter_workshop(argv=None):
+    """Command line script (slurm-jupyter workshop) running a jupyter server
+    for each student in a class as one slurm job array.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv[2:].
+    """
+    parser = argparse.ArgumentParser(prog='slurm-jupyter workshop',
+                                     description="Runs identical jupyter servers for a class, one per student, "
+                                                 "as one slurm job array and writes a roster with the URL of "
+                                                 "each student's server.")
+    subparsers = parser.add_subparsers(dest='command')
+    start = subparsers.add_parser('start', help="Start the servers.")
+    add_slurm_arguments(start)
+    start.add_argument("--students",
+                    dest="students",
+                    type=str,
+                    default=None,
+                    help="File with the names of the students, one per line.")
+    start.add_argument("--count",
+                    dest="count",
+                    type=int,
+                    default=0,
+                    help="Number of servers (if there is no --students file).")
+    start.add_argument("--run", 
+                    dest="run", 
+                    type=str, 
+                    choices=['notebook', 'lab'],
+                    default='lab',
+                    help="Run jupyter notebook or jupyterlab.")
+    start.add_argument("--hostport",
+                    dest="hostport",
+                    type=int,
+                    default=None,
+                    help="Port of the first server. Server n uses this port plus n.")
+    start.add_argument("--idle-timeout",
+                    dest="idle_timeout",
+                    type=float,
+                    default=0,
+                    metavar='MINUTES',
+                    help="Stop servers that have not been used for this many minutes. Off by default.")
+    start.add_argument("--roster",
+                    dest="roster",
+                    type=str,
+                    default=None,
+                    help="Roster file to write. Defaults to workshop_<job id>.csv.")
+    start.add_argument("--wait",
+                    dest="wait",
+                    type=float,
+                    default=1800,
+                    help="Max seconds to wait for the servers to be ready.")
+    start.add_argument("--interval",
+                    dest="interval",
+                    type=float,
+                    default=5,
+                    help="Seconds between checks of the servers.")
+    start.add_argument("-v", "--verbose",
+                    dest="verbose",
+                    action='store_true',
+                    help="Print debugging information")
+    roster = subparsers.add_parser('roster', help="Write the roster of a running workshop again.")
+    roster.add_argument('job_id', help="Job id of the workshop.")
+    roster.add_argument("--roster",
+                    dest="roster",
+                    type=str,
+                    default=None,
+                    help="Roster file to write. Defaults to workshop_<job id>.csv.")
+    roster.add_argument("-v", "--verbose",
+                    dest="verbose",
+                    action='store_true',
+                    help="Print debugging information")
+    stop = subparsers.add_parser('stop', help="Stop all servers of a workshop.")
+    stop.add_argument('job_id', help="Job id of the workshop.")
+    stop.add_argument("-v", "--verbose",
+                    dest="verbose",
+                    action='store_true',
+                    help="Print debugging information")
+    args = parser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    if args.command == 'start':
+        workshop_start(args)
+        return
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    workshop = load_workshop(args.job_id)
+    if workshop is None:
+        print("No workshop with job id {} (see {})".format(args.job_id, os.path.dirname(workshop_file(args.job_id))))
+        sys.exit(1)
+
+    if args.command == 'roster':
+        try:
+            states, beacons = collect(workshop['user'], workshop['frontend'], workshop['job_id'], verbose=args.verbose)
+        except ExecuteException as e:
+            print("Could not get the state of the servers:", e)
+            sys.exit(1)
+        rows = roster_rows(workshop, states, beacons)
+        roster = args.roster or 'workshop_{}.csv'.format(workshop['job_id'])
+        write_roster(roster, rows)
+        print_roster(rows)
+        print(BLUE+log_prefix()+'Roster written to {}'.format(roster)+ENDC)
+
+    elif args.command == 'stop':
+        # one ssh call cancels all tasks and removes the beacons
+        cmd = 'ssh -q {user}@{frontend} scancel {job_id} && rm -rf {beacon_root}/{job_id}'.format(
+            beacon_root=BEACON_ROOT, **workshop)
+        if args.verbose: print(cmd)
+        try:
+            execute(cmd)
+        except ExecuteException as e:
+            print("Could not cancel job array {}:".format(workshop['job_id']), e)
+            sys.exit(1)
+        os.remove(workshop_file(workshop['job_id']))
+        print(BLUE+log_prefix()+'Cancelled the {} servers of job array {}'.format(
+            len(workshop['students']), workshop['job_id'])+ENDC)
+
+
+def slurm_jupyter(teardown=None):
     """Command line script for use on a local machine. Runs and connects to a jupyter server on a slurm node.
+
+    Args:
+        teardown (Teardown, optional): Teardown of the session, so callers running 
+            the session can end it themselves. Defaults to a new Teardown, which also runs at exit.
     """ 
 
+    if sys.argv[1:2] == ['status']:
+        slurm_jupyter_status(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['workshop']:
+        slurm_jupyter_workshop(sys.argv[2:])
+        return
+
     description = """
     The script handles everything required to run jupyter on the cluster but show the notebook or jupyterlab 
     in your local browser."""
@@ -608,17 +1408,78 @@ def slurm_jupyter():
                     dest="skip_update_check",
                     action='store_true',
                     help="Skip searching for a package update.")
+    parser.add_argument("--agent",
+                    dest="agent",
+                    action='store_true',
+                    help="Run the session in the background agent (started if not running), so it survives "
+                         "closing the terminal. Use --agent-status and --agent-stop to manage it.")
+    parser.add_argument("--agent-status",
+                    dest="agent_status",
+                    action='store_true',
+                    help="List the sessions run by the background agent.")
+    parser.add_argument("--agent-stop",
+                    dest="agent_stop",
+                    type=str,
+                    default=None,
+                    metavar='SESSION',
+                    help="Stop a session run by the background agent (or all) and cancel its slurm job.")
+    parser.add_argument("--cluster",
+                    dest="cluster",
+                    type=str,
+                    default=None,
+                    help="Name of a cluster profile in ~/.slurm_jupyter/clusters.json with defaults for other "
+                         "options (E.g. frontend, user and account). Use 'auto' to probe all clusters at the "
+                         "same time and run on the one expected to start the server first.")
+    parser.add_argument("--idle-timeout",
+                    dest="idle_timeout",
+                    type=float,
+                    default=0,
+                    metavar='MINUTES',
+                    help="Shut down the server and cancel the slurm job when no kernel or terminal has been "
+                         "used and the job has not used CPU for this many minutes. Off by default.")
+    parser.add_argument("--idle-warning",
+                    dest="idle_warning",
+                    type=float,
+                    default=10,
+                    metavar='MINUTES',
+                    help="Warn this many minutes before an idle server is shut down. Default is 10.")
+    parser.add_argument("--top-kernels",
+                    dest="top_kernels",
+                    type=int,
+                    default=3,
+                    metavar='N',
+                    help="Show the memory used by the N notebooks whose kernels use the most. 0 turns it off. "
+                         "Default is 3.")
+    parser.add_argument("--cull-kernels",
+                    dest="cull_kernels",
+                    type=float,
+                    default=0,
+                    metavar='MINUTES',
+                    help="Shut down kernels that have been idle for this many minutes. The server keeps running. "
+                         "Off by default.")
 
     args = parser.parse_args()
 
+    if args.agent or args.agent_status or args.agent_stop:
+        agent_command(args, sys.argv[1:])
+        return
+
+    global TRACE
+    TRACE = PhaseTrace()
+
+    probe = None
+    if args.cluster:
+        if args.cluster == AUTO:
+            TRACE.begin('cluster probe')
+        args, probe = resolve_cluster(parser, args)
+        TRACE.end('cluster probe')
+
     if args.nodes != 1:
         print("Multiprocessing across multiple nodes not supported yet - sorry")
         sys.exit()
 
     if args.time[-1] in 'smhdSMHD':
-        unit = args.time[-1].lower()
-        value = int(args.time[:-1])
-        args.time = human2walltime(**{unit:value})
+        args.time = normalize_walltime(args.time)
     elif not re.match(r'(\d+-)?\d+:\d+:\d+', args.time):
         print("Wrongly formatted walltime spec:", args.time)
 
@@ -637,23 +1498,30 @@ def slurm_jupyter():
             'cwd': os.getcwd(),
             'sources_loaded': '',
             'mem_script': 'mem_jupyter.py',
-            'tmp_script': 'slurm_jupyter_{}.sh'.format(int(time.time())),
             'tmp_name': 'slurm_jupyter',
             'tmp_dir': '.slurm_jupyter',
             'frontend': args.frontend,
             'hostport': args.hostport,
+            'top_kernels': args.top_kernels,
+            'array_spec': '',
+            'task_setup': '',
             'job_name': "sjup_{}_{}_{}_{}".format(args.name, getpass.getuser(), args.environment, int(time.time())),
             'job_id': None,
             'url': None}
 
+    trace_file = os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'traces', '{}.json'.format(spec['job_name']))
+
     if not args.skip_update_check:
-        check_for_conda_update()
+        with TRACE.span('update check'):
+            check_for_conda_update()
 
-    # test ssh connection:
+    # test ssh connection (the probe in auto mode has already connected):
     cmd = 'ssh -q {user}@{frontend} exit'.format(**spec)
     if args.verbose: print(cmd)
     try:
-        stdout, stderr = execute(cmd)   
+        if probe is None:
+            with TRACE.span('ssh check'):
+                stdout, stderr = execute(cmd)   
     except ExecuteException as e:
         print("Cannot make ssh connection: {user}@{frontend}".format(**spec))
         sys.exit()
@@ -672,44 +1540,29 @@ def slurm_jupyter():
     #     sys.exit()
 
     if not args.attach:
-        # check environment exists on the cluster:
-        # cmd = r'''ssh {user}@{frontend} "conda info --envs | grep '{environment_name}\s'"'''.format(**spec)
-        cmd = r'ssh {user}@{frontend} "conda info --envs"'.format(**spec)
-        if args.verbose: print(cmd)
-        stdout, stderr = execute(cmd)
-        if args.verbose: print(stdout.decode())
-        if not args.attach:
-            if not any(line.startswith(spec['environment_name'] + ' ') or line.endswith(' ' + spec['environment_name'])  for line in stdout.decode().split('\n')):
-                print("Specified environment {environment_name} was not found at {user}@{frontend}".format(**spec))
-                sys.exit()
-
-        # get environment manager:
-        cmd = r'ssh -q {user}@{frontend} "conda config --show root_prefix"'.format(**spec)
-        stdout, stderr = execute(cmd)
-        if args.verbose: print(stdout.decode())
-        # if process.returncode:
-        #     print("Cannot identify cluster package mannager (CONDA_PREFIX not set).")
-        #     sys.exit()
-        # else:
-        #     spec['package_manager'] = stdout.strip()
-        spec['package_manager'] = stdout.decode().strip()
-
-        if args.verbose: print(spec['package_manager'])
-
-        # in case the cluster bash string comes back with profile formatting around the manager name
-        for manager in ['miniconda3', 'anaconda3', 'miniforge3', 'mambaforge']:
-            if manager in spec['package_manager']:
-                spec['package_manager'] = manager
-
-        if not spec['package_manager'] or spec['package_manager'] not in ['miniconda3', 'anaconda3', 'miniforge3', 'mambaforge']:
-            print("Conda package manager should be either miniconda3, anaconda3, miniforge3, or mambaforge.")
+        # check environment exists on the cluster and get cached activation:
+        try:
+            with TRACE.span('environment'):
+                activation = probe and probe['activation'] or cached_activation(spec, verbose=args.verbose)
+        except ExecuteException as e:
+            print("Could not resolve activation of environment {environment_name} at {user}@{frontend}:".format(**spec))
+            print(e)
             sys.exit()
-
-        if args.verbose: print("Found package manager:", spec['package_manager'])
+        if activation.get('status') == 'missing':
+            print("Specified environment {environment_name} was not found at {user}@{frontend}".format(**spec))
+            sys.exit()
+        spec['activation_snapshot'] = activation['snapshot']
+        spec['conda_root'] = activation['root']
+        if args.verbose: print("Environment activation snapshot ({status}):".format(**activation), activation['snapshot'])
+        spec['activation'] = snapshot_activation.format(**spec)
+        if args.local_env:
+            spec['activation'] = local_env_spec(spec, activation['prefix'], env_timings=args.env_timings, 
+                                                fallback_activation=spec['activation'])
 
         # TODO: test port check and make sure it works
         if spec['port'] is None and spec['hostport'] is None and not args.skip_port_check:
-            spec['port'] = get_cluster_uid(spec) 
+            with TRACE.span('port lookup'):
+                spec['port'] = get_cluster_uid(spec) 
 
             if sys.platform == "darwin":
                 cmd = f"lsof -i -P | grep LISTEN"           
@@ -759,19 +1612,31 @@ def slurm_jupyter():
         else:
             spec['account_spec'] = ""
 
+        idle_spec(spec, idle_timeout=args.idle_timeout, idle_warning=args.idle_warning,
+                  cull_kernels=args.cull_kernels)
+        stage_spec(spec, args.stage, checksum=args.stage_checksum)
 
-    # incept keyboard interrupt with user prompt
-    signal.signal(signal.SIGINT, keyboard_interrupt_handler)
 
-    try:
+    # event to communicate with threads (except memory thread)
+    global RUN_EVENT
+    RUN_EVENT = Event()
+    RUN_EVENT.set()
 
-        # event to communicate with threads (except memory thread)
-        global RUN_EVENT
-        RUN_EVENT = Event()
-        RUN_EVENT.set()
+    # Ctrl-C, a closed terminal (SIGHUP) and exit all end the session through
+    # the same teardown, which only runs once
+    if teardown is None:
+        teardown = Teardown()
+    teardown.run_event = RUN_EVENT
+    teardown.install()
+
+    # last OOM kill reported by the memory monitor
+    oom = None
+
+    try:
 
         if args.attach:
             # populate spec
+            TRACE.begin('attach lookup')
 
             if args.slurm_jobid:
                 spec['job_id'] = args.slurm_jobid
@@ -806,33 +1671,47 @@ def slurm_jupyter():
                     spec['hostport'] = re.search(r':(\d+) \(LISTEN\)', line).group(1)
                     if args.verbose: print('Found hostport:', spec['hostport'])
                     break
+            TRACE.end('attach lookup')
+            trace_file = os.path.join(os.path.dirname(trace_file), '{}_attach_{}.json'.format(spec['job_name'], int(time.time())))
 
         else:
-            spec['job_id'] = submit_slurm_server_job(spec, verbose=args.verbose)
+            with TRACE.span('sbatch'):
+                spec['job_id'] = submit_slurm_server_job(spec, verbose=args.verbose)
+            teardown.cancel_command = 'ssh {user}@{frontend} scancel {job_id}'.format(**spec)
             print(BLUE+log_prefix()+'Waiting for slurm job allocation'+ENDC)
 
-            spec['node'] = wait_for_job_allocation(spec, verbose=args.verbose)
+            with TRACE.span('allocation', job_id=spec['job_id']):
+                spec['node'] = wait_for_job_allocation(spec, verbose=args.verbose)
             print(BLUE+log_prefix()+'Compute node(s) allocated:', spec['node'], ENDC)
 
             assert spec['node']
             print(BLUE+log_prefix()+'Jupyter server: (to stop the server press Ctrl-C)'+ENDC)
 
-            time.sleep(5)
+        record_session(spec)
 
-        tup = spec['walltime'].split('-')
-        if len(tup) == 1:
-            days, (hours, mins, secs) = 0, tup[0].split(':')
-        else:
-            days, (hours, mins, secs) = tup[0], tup[1].split(':')
-        end_time = int(time.time()) + int(days) * 86400 + int(hours) * 3600 + int(mins) * 60 + int(secs)
+        # forward the port and open the browser as soon as the server answers
+        port_p, port_t, port_q = open_port(spec, verbose=args.verbose)
+        teardown.add(port_p, port_t)
+        ready_t = Thread(target=open_browser_when_ready, args=(spec, trace_file),
+                         kwargs=dict(force_chrome=args.chrome, verbose=args.verbose))
+        ready_t.daemon = True # thread dies with the program
+        ready_t.start()
+
+        end_time = int(time.time()) + walltime_seconds(spec['walltime'])
 
         # open connections to stdout and stderr from jupyter server
-        stdout_p, stdout_t, stdout_q = open_jupyter_stdout_connection(spec, verbose=args.verbose)
-        stderr_p, stderr_t, stderr_q = open_jupyter_stderr_connection(spec, verbose=args.verbose)
+        with TRACE.span('log wait'):
+            stdout_p, stdout_t, stdout_q = open_jupyter_stdout_connection(spec, verbose=args.verbose)
+            stderr_p, stderr_t, stderr_q = open_jupyter_stderr_connection(spec, verbose=args.verbose)
+            teardown.add(stdout_p, stdout_t)
+            teardown.add(stderr_p, stderr_t)
 
         # open connections to stdout from memory monitoring script
-        transfer_memory_script(spec, verbose=args.verbose)
-        mem_stdout_p, mem_stdout_t, mem_stdout_q = open_memory_stdout_connection(spec, verbose=args.verbose)
+        trend = MemoryTrend()
+        with TRACE.span('memory monitor'):
+            transfer_memory_script(spec, verbose=args.verbose)
+            mem_stdout_p, mem_stdout_t, mem_stdout_q = open_memory_stdout_connection(spec, verbose=args.verbose)
+            teardown.add(mem_stdout_p, mem_stdout_t)
 
         # # start thread monitoring memory usage
         # mem_print_t = StoppableThread(target=memory_monitor, args=[spec])
@@ -863,6 +1742,37 @@ def slurm_jupyter():
                     break
                 else:
                     mem_line = mem_line.decode().strip() 
+
+                    sample = parse_sample(mem_line)
+                    if sample is not None:
+                        trend.add(*sample)
+                        eta = trend.warning()
+                        if eta is not None:
+                            print(RED+log_prefix()+'Memory use grows by {:.1f} Gb/h and may reach the {:.1f} Gb '
+                                  'reserved in {}'.format(trend.growth() / 1024, sample[2] / 1024,
+                                                          seconds2string(eta))+ENDC)
+                        continue
+
+                    report = parse_oom(mem_line)
+                    if report is not None:
+                        oom = report
+                        if oom['pid'] is not None:
+                            killed = 'killed process {} ({}) using {:.1f} Gb'.format(
+                                oom['pid'], oom['command'][:60], oom['rss'] / 1024)
+                        else:
+                            killed = 'killed a process'
+                        print(RED+log_prefix()+'Out of memory: the kernel {}. The job used {:.1f} Gb of '
+                              '{:.1f} Gb reserved.'.format(killed, oom['peak'] / 1024, oom['reserved'] / 1024)+ENDC)
+                        if not args.attach:
+                            print(RED+log_prefix()+'Press Ctrl-C to relaunch the server with --total-memory {}'.format(
+                                suggested_memory(oom['reserved'], oom['peak']))+ENDC)
+                        continue
+
+                    report = parse_kernels(mem_line)
+                    if report is not None:
+                        print(BLUE+log_prefix()+'Kernel memory: '+format_kernels(report)+ENDC)
+                        continue
+
                     secs_left = end_time - int(time.time())
                     color = secs_left > 600 and BLUE or RED
                     mem_line += '  '+color+'Time: '+seconds2string(secs_left)+ENDC
@@ -880,35 +1790,20 @@ def slurm_jupyter():
                 else:
                     line = line.decode()
                     line = line.replace('\r', '\n')
+
+                    if IDLE_MARK in line:
+                        # from the idle watcher on the node
+                        message = line.split(IDLE_MARK, 1)[1].strip()
+                        print(RED+log_prefix()+'Idle server '+message+ENDC)
+                        if message.startswith('released'):
+                            # the watcher has shut down the server and cancelled the job
+                            teardown.cancel_command = None
+                            raise StopServerException
+                        continue
+
                     if 'SSLV3_ALERT_CERTIFICATE_UNKNOWN' not in line: # skip warnings about SSL certificate
                         print(line, end="")
 
-                    if re.search(r'Jupyter Notebook[\d. ]+is running', line) or re.search(r'Jupyter Server[\d. ]+is running', line):
-                        port_p, port_t, port_q = open_port(spec, verbose=args.verbose)
-                        token_url = None # server is runing, we now look for a token url
-
-                    # look for the token url
-                    m = re.search(r'https?://127.0.0.1\S+', line)
-                    if m and not token_url:
-                        token_url = m.group(0)
-                        spec['url'] = token_url
-                        open_browser(spec, force_chrome=args.chrome)
-                        prefix = log_prefix()
-                        print(BLUE+prefix+'Your browser may complain that the connection is not private.\n',
-                                   prefix+' In Safari, you can proceed to allow this. In Chrome, you need"\n',
-                                   prefix+' to simply type the characters "thisisunsafe" while in the Chrome window.\n',
-                                   prefix+' Once ready, jupyter may ask for your cluster password.'+ENDC, sep='')
-
-                    # in case we missed the token url
-                    m = re.search(r'Use Control-C to stop this server', line)
-                    # if m and not token_url:
-                    #     open_browser(spec, force_chrome=args.chrome)
-                    #     prefix = log_prefix()
-                    #     print(BLUE+prefix+'Your browser may complain that the connection is not private.\n',
-                    #                prefix+' In Safari, you can proceed to allow this. In Chrome, you need"\n',
-                    #                prefix+' to simply type the characters "thisisunsafe" while in the Chrome window.\n',
-                    #                prefix+' Once ready, jupyter may ask for your cluster password.'+ENDC, sep='')
-
                     if "CANCELLED" in line:
                         print('\n'+RED+log_prefix()+'Scheduled slurm job cancelled.'+ENDC)
                         raise StopServerException  
@@ -917,96 +1812,317 @@ def slurm_jupyter():
                         print('\n'+RED+log_prefix()+'Specified environment does not exist.'+ENDC)
                         raise StopServerException  
                                    
-    except StopServerException:
+    except (StopServerException, KeyboardInterrupt):
 
-        # not possible to do Keyboard interrupt from here on out
-        signal.signal(signal.SIGINT, keyboard_interrupt_repressor)
+        # cancels the job first, then stops ssh connections and threads
+        if args.attach:
+            teardown.run(message=BLUE+'\nDetaching from jupyter server'+ENDC, verbose=args.verbose)
+        else:
+            teardown.run(message=BLUE+'\nCanceling slurm job running jupyter server'+ENDC, verbose=args.verbose)
+            if oom is not None and sys.stdin.isatty():
+                offer_relaunch(suggested_memory(oom['reserved'], oom['peak']))
+            sys.exit()
 
-        # TODO: Double Ctrl-C bypasses canceling of slurm job
 
-        try:
-            RUN_EVENT.clear()
-            time.sleep(1)
+FAILED_STATES = ['FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE',
+                 NEVER_SATISFIED]
+ACTIVE_STATES = ['PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED', 'CONFIGURING', 'COMPLETING', 'UNKNOWN']
 
-            port_p.kill()
-            port_t.join()
-        except:
-            pass
+def load_run(spec, job_id=None):
+    """Loads the record of the jobs submitted by a run of slurm-nb-run.
 
-        try:
-            stdout_p.kill() 
-            stdout_t.join()
-        except:
-            pass
+    Args:
+        spec (dict): Parameter specification.
+        job_id (str, optional): Id of any job submitted in the run. Defaults to the latest run.
 
-        try:
-            stderr_p.kill()
-            stderr_t.join()
-        except:
-            pass
-            
-        try:
-            mem_stdout_p.kill()
-            mem_stdout_t.join()
-            # mem_print_t.stop()
-            # mem_print_t.join()
-        except:
-            pass
+    Returns:
+        dict: Run record or None if no run is found.
+    """
+    run_files = sorted(glob.glob(os.path.join(spec['tmp_dir'], 'run_*.json')), key=os.path.getmtime)
+    runs = []
+    for run_file in run_files:
+        with open(run_file) as f:
+            runs.append(json.load(f))
+    if job_id is not None:
+        runs = [r for r in runs if any(j['job_id'] == str(job_id) for j in r['jobs'])]
+    return runs and runs[-1] or None
+
+
+def run_tasks(job):
+    """Lists the tasks of a submitted job. Jobs that are not job arrays have a single task.
+
+    Args:
+        job (dict): Job from a run record.
+
+    Returns:
+        list: (job id, label, notebook) tuples, where the job id of an array task is E.g. 1234_5.
+    """
+    if 'tasks' in job:
+        tasks = sorted(job['tasks'].items(), key=lambda t: int(t[0]))
+        return [('{}_{}'.format(job['job_id'], idx), idx, task['notebook']) for idx, task in tasks]
+    return [(job['job_id'], job['job_id'], job['notebook'])]
+
+
+def run_status(spec, job_id=None, verbose=False):
+    """Prints the state of each job (and job array task) submitted by a run of slurm-nb-run.
+
+    Args:
+        spec (dict): Parameter specification.
+        job_id (str, optional): Id of any job submitted in the run. Defaults to the latest run.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+    """
+    run = load_run(spec, job_id)
+    if run is None:
+        print("No submitted jobs found")
+        return
+
+    states = job_states([j['job_id'] for j in run['jobs']], verbose=verbose)
+
+    counts, failed = {}, []
+    for job in run['jobs']:
+        if 'tasks' in job:
+            print(BLUE + "Job array {job_id}: {notebook}".format(**job) + ENDC)
+        for task_job_id, label, notebook in run_tasks(job):
+            state, exit_code, elapsed = states.get(task_job_id, ('UNKNOWN', '', ''))
+            counts[state] = counts.get(state, 0) + 1
+            color = state in FAILED_STATES and RED or ''
+            print(color + '  {:>8} {:<14} {:<6} {:>10}  {}'.format(label, state, exit_code, elapsed, notebook) + ENDC)
+            if color:
+                failed.append('{tmp_dir}/{tmp_name}.{id}.err'.format(id=task_job_id, **spec))
+    print(', '.join('{}: {}'.format(state, n) for state, n in sorted(counts.items())))
+    if failed:
+        print(RED + "Logs of failed jobs:" + ENDC)
+        for log_file in failed:
+            print('  ' + log_file)
+
+
+def wait_for_jobs(job_ids, interval=30, verbose=False):
+    """Waits for jobs to finish, printing the number of jobs in each state when it changes.
+
+    Args:
+        job_ids (list): Slurm job ids.
+        interval (int, optional): Seconds between checking job states. Defaults to 30.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+    """
+    prev_counts = None
+    while True:
+        time.sleep(interval)
+        counts = count_states(job_states(job_ids, verbose=verbose))
+        if counts != prev_counts:
+            print(log_prefix() + ', '.join('{}: {}'.format(state, n) for state, n in sorted(counts.items())))
+            prev_counts = counts
+        if counts and not any(state in ACTIVE_STATES for state in counts):
+            break
 
-        if args.attach:
-            print(BLUE+'\nDetached from jupyter server'+ENDC)
-        else:
-            print(BLUE+'\nCanceling slurm job running jupyter server'+ENDC)
-            cmd = 'ssh {user}@{frontend} scancel {job_id}'.format(**spec)
-            if args.verbose: print(cmd)
-            stdout, stderr = execute(cmd, check_failure=False)
-            sys.exit()
 
+def format_duration(secs):
+    """Formats seconds as E.g. 1h02m, 3m05s or 12s.
+
+    Args:
+        secs (float): Seconds.
+
+    Returns:
+        str: Duration.
+    """
+    secs = int(secs)
+    if secs >= 3600:
+        return '{}h{:02}m'.format(secs // 3600, secs % 3600 // 60)
+    if secs >= 60:
+        return '{}m{:02}s'.format(secs // 60, secs % 60)
+    return '{}s'.format(secs)
+
+
+def watch_run(spec, job_id=None, interval=10, verbose=False):
+    """Shows the progress of each notebook executing in a run of slurm-nb-run
+    until all its jobs have finished. Progress is read from the event file 
+    each job writes, and job states from a single sacct call.
+
+    Args:
+        spec (dict): Parameter specification.
+        job_id (str, optional): Id of any job submitted in the run. Defaults to the latest run.
+        interval (int, optional): Seconds between updates. Defaults to 10.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+    """
+    run = load_run(spec, job_id)
+    if run is None:
+        print("No submitted jobs found")
+        return
+    event_dir = os.path.join(spec['tmp_dir'], 'events')
+    tracker = ProgressTracker()
+    tasks = [task for job in run['jobs'] for task in run_tasks(job)]
+    try:
+        while True:
+            states = job_states([j['job_id'] for j in run['jobs']], verbose=verbose)
+            now = time.time()
+            lines, counts = [], {}
+            for task_job_id, label, notebook in tasks:
+                state = states.get(task_job_id, ('UNKNOWN', '', ''))[0]
+                counts[state] = counts.get(state, 0) + 1
+                progress = tracker.update(event_file(event_dir, task_job_id))
+                if not progress:
+                    color = state in FAILED_STATES and RED or ''
+                    lines.append(color + '  {:>12} {:<12} {}'.format(task_job_id, state, notebook) + ENDC)
+                for p in progress:
+                    cells = '{}/{}'.format(p['done'] + p['skipped'], p['cells'])
+                    if p['cell'] is not None:
+                        activity = 'cell {} running {}'.format(p['cell'], format_duration(now - p['cell_start']))
+                    elif p['ok'] is not None:
+                        activity = 'finished in {}'.format(format_duration(p['secs']))
+                    else:
+                        activity = ''
+                    memory = p['memory'] is not None and '{:.1f} Gb'.format(p['memory'] / 1024) or ''
+                    failed = p['errors'] or p['ok'] is False or state in FAILED_STATES
+                    if state == 'RUNNING' and p['ok'] is None and now - p['last'] > 3 * HEARTBEAT_INTERVAL:
+                        # no heartbeat: the process executing the notebook is not responding
+                        activity += ' (no events for {})'.format(format_duration(now - p['last']))
+                        failed = True
+                    color = failed and RED or ''
+                    lines.append(color + '  {:>12} {:<12} {:>9} {:<28} {:>8}  {}'.format(
+                        task_job_id, state, cells, activity, memory, p['notebook'] or notebook) + ENDC)
+                    for index, error in p['errors']:
+                        lines.append(RED + '{:>28} cell {}: {}'.format('', index, error[:100]) + ENDC)
+            if sys.stdout.isatty():
+                # clear screen
+                print('\033[2J\033[H', end='')
+            print(log_prefix() + ', '.join('{}: {}'.format(state, n) for state, n in sorted(counts.items())))
+            print('\n'.join(lines), flush=True)
+            if counts and not any(state in ACTIVE_STATES for state in counts):
+                break
+            time.sleep(interval)
     except KeyboardInterrupt:
+        pass
 
-        # not possible to do Keyboard interrupt from here on out
-        signal.signal(signal.SIGINT, keyboard_interrupt_repressor)
 
-        # TODO: Double Ctrl-C bypasses canceling of slurm job
+def executed_notebook_path(notebook_path, output_format='notebook', inplace=False):
+    """Path of the file nbconvert produces when executing a notebook.
 
-        # in try statements because these variables may not be defined at keyboard interrupt:
-        try:
-            RUN_EVENT.clear()
-            time.sleep(1)
+    Args:
+        notebook_path (str): Path to notebook.
+        output_format (str, optional): nbconvert output format. Defaults to 'notebook'.
+        inplace (bool, optional): Notebook is executed in place. Defaults to False.
 
-            port_p.kill()
-            port_t.join()
-        except:
-            pass
+    Returns:
+        str: Path to executed notebook or converted file.
+    """
+    if inplace:
+        return notebook_path
+    if output_format == 'notebook':
+        return modpath(notebook_path, suffix='.nbconvert.ipynb')
+    return modpath(notebook_path, suffix='.' + output_format)
 
-        try:
-            stdout_p.kill() 
-            stdout_t.join()
-        except:
-            pass
 
-        try:
-            stderr_p.kill()
-            stderr_t.join()
-        except:
-            pass
-            
-        try:
-            mem_stdout_p.kill()
-            mem_stdout_t.join()
-            # mem_print_t.stop()
-            # mem_print_t.join()
-        except:
-            pass
+def nbconvert_command(notebook_path, output_file, output_format='notebook', allow_errors=False, timeout=-1):
+    """Makes the shell command that executes a notebook using nbconvert.
 
-        if args.attach:
-            print(BLUE+'\nDetached from jupyter server'+ENDC)
-        else:
-            print(BLUE+'\nCanceling slurm job running jupyter server'+ENDC)
-            cmd = 'ssh {user}@{frontend} scancel {job_id}'.format(**spec)
-            if args.verbose: print(cmd)
-            stdout, stderr = execute(cmd, check_failure=False)
-            sys.exit()
+    The notebook is executed in its own directory so relative paths work as
+    in an interactive session. Output is written to a temporary file that is
+    only moved to output_file once execution completes. Cells are executed by 
+    ProgressExecutePreprocessor so the job reports the progress of each cell.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        output_file (str): Path to write executed notebook to.
+        output_format (str, optional): nbconvert output format. Defaults to 'notebook'.
+        allow_errors (bool, optional): Allow errors in cell executions. Defaults to False.
+        timeout (int, optional): Cell execution timeout in seconds. Defaults to -1.
+
+    Returns:
+        str: Shell command.
+    """
+    notebook_dir, notebook_name = os.path.split(os.path.abspath(notebook_path))
+    tmp_base = modpath(notebook_name, suffix='') + '.running'
+    if output_format == 'notebook':
+        tmp_file = tmp_base + '.ipynb'
+    else:
+        tmp_file = tmp_base + '.' + output_format
+    cmd = 'cd {dir} && jupyter nbconvert --ClearOutputPreprocessor.enabled=True --ExecutePreprocessor.timeout={timeout} {allow_errors} --Exporter.preprocessors=slurm_jupyter.preprocessors.ProgressExecutePreprocessor --to {format} --output {tmp_base} {notebook} && mv {tmp_file} {output_file}'
+    return cmd.format(dir=shlex.quote(notebook_dir), timeout=timeout, 
+                      allow_errors=allow_errors and '--allow-errors' or '',
+                      format=output_format, tmp_base=shlex.quote(tmp_base),
+                      notebook=shlex.quote(notebook_name), tmp_file=shlex.quote(tmp_file),
+                      output_file=shlex.quote(os.path.abspath(output_file)))
+
+
+def target_name(notebook_path, suffix=''):
+    """Makes a valid gwf target name for a notebook.
+
+    The name is made from the path relative to the current directory, so
+    notebooks with the same name in different directories get different
+    target names.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        suffix (str, optional): Appended to the name, e.g. the name of a spiked file. Defaults to ''.
+
+    Returns:
+        str: Target name.
+    """
+    name = os.path.splitext(os.path.relpath(notebook_path))[0]
+    if suffix:
+        name += '_' + suffix
+    name = re.sub(r'[^a-zA-Z0-9._]', '_', name)
+    if not re.match(r'[a-zA-Z_]', name):
+        name = '_' + name
+    return name
+
+
+def slurm_nb_profile(argv=None):
+    """Command line script for use on the cluster. Ranks the cells of executed 
+    notebooks by the time or memory they took. E.g. for all notebooks in a sweep:
+
+        slurm-nb-run profile --group notebook1
+    """
+    parser = argparse.ArgumentParser(prog='slurm-nb-run profile',
+                                     description="Ranks the cells of notebooks executed by slurm-nb-run by the time or memory they took.")
+    parser.add_argument("--top",
+                    dest="top",
+                    type=int,
+                    default=20,
+                    help="Number of cells to show. Default 20.")
+    parser.add_argument("--sort",
+                    dest="sort",
+                    choices=['wall', 'cpu', 'memory'],
+                    default='wall',
+                    help="Rank cells by wall time, CPU time, or peak memory increase. Default wall.")
+    parser.add_argument("--group",
+                    dest="group",
+                    action='store_true',
+                    help="Add up cells with the same code (E.g. the same cell in each variant of a sweep).")
+    parser.add_argument("--export",
+                    dest="export",
+                    type=str,
+                    default=None,
+                    help="Write the profile of all cells to this file (CSV if it ends with .csv, otherwise JSON).")
+    parser.add_argument('paths', nargs='*', default=['.'], 
+                    help="Executed notebooks or directories to search for them. Default is the current directory.")
+    args = parser.parse_args(argv)
+
+    notebook_paths = notebook_files(args.paths)
+    rows = cell_profiles(notebook_paths)
+    if not rows:
+        print("No profiled cells found in {} notebook(s)".format(len(notebook_paths)))
+        sys.exit(1)
+    if args.group:
+        rows = group_profiles(rows)
+    if args.export:
+        write_profiles(rows, args.export)
+
+    sort_key = {'wall': 'wall', 'cpu': 'cpu', 'memory': 'peak_rss_delta'}[args.sort]
+    rows.sort(key=lambda r: r[sort_key] or 0, reverse=True)
+    total_wall = sum(r['wall'] or 0 for r in rows)
+
+    def fmt(value, unit):
+        return value is not None and '{:.1f}{}'.format(value, unit) or '-'
+
+    print(BLUE + "Top {} of {} cells by {} ({} notebooks, {:.1f} s in total)".format(
+        min(args.top, len(rows)), len(rows), args.sort, len(notebook_paths), total_wall) + ENDC)
+    print('{:>9} {:>6} {:>9} {:>10} {:>6}  {}'.format('wall', '%', 'cpu', 'peak mem', 'runs' if args.group else 'cell', 'notebook / code'))
+    for r in rows[:args.top]:
+        share = total_wall and 100 * (r['wall'] or 0) / total_wall or 0
+        print('{:>9} {:>6} {:>9} {:>10} {:>6}  {}'.format(
+            fmt(r['wall'], 's'), '{:.1f}'.format(share), fmt(r['cpu'], 's'), fmt(r['peak_rss_delta'], 'M'),
+            r['count'] if args.group else r['cell'], r['notebook']))
+        print('{:>45}{}'.format('', r['code'][:80]))
 
 
 def slurm_nb_run():
@@ -1019,7 +2135,14 @@ def slurm_nb_run():
     (param1.py and param2.py):
 
         slurm-nb-run --spike param1.py --spike param2.py notebook1.ipynb, notebook2.ipynb
+
+    To rank the cells of executed notebooks by how long they took:
+
+        slurm-nb-run profile notebook1
     """
+    if len(sys.argv) > 1 and sys.argv[1] == 'profile':
+        slurm_nb_profile(sys.argv[2:])
+        return
 
     description = """
     The script executes a notebook on the cluster"""
@@ -1066,6 +2189,106 @@ def slurm_nb_run():
                     dest="replace_first_run_magic",
                     action='store_true',
                     help="Replace first cell with a %%run magic instead of just adding a top %%run magic cell") 
+    parser.add_argument("--after",
+                    dest="after",
+                    action='append',
+                    help="Run a notebook only after other notebooks complete. Specify as NOTEBOOK:DEPENDENCY[,DEPENDENCY...]. "
+                         "Dependencies can also be declared in notebook metadata (see documentation).")
+    parser.add_argument("--serial",
+                    dest="serial",
+                    action='store_true',
+                    help="Run notebooks one after the other in the order given instead of running independent notebooks concurrently.")
+    parser.add_argument("--force",
+                    dest="force",
+                    action='store_true',
+                    help="Execute notebooks even if a cached result exists for the same code, parameters, environment and inputs.")
+    parser.add_argument("--cache-max-age",
+                    dest="cache_max_age",
+                    type=float,
+                    default=30,
+                    help="Remove cached results not used for this many days. Default 30.")
+    parser.add_argument("--cache-max-size",
+                    dest="cache_max_size",
+                    type=str,
+                    default=None,
+                    help="Max total size of cached results in gigabytes or megabytes e.g. 20g or 500m. "
+                         "Least recently used results are removed first.")
+    parser.add_argument("--no-job-array",
+                    dest="job_array",
+                    action='store_false',
+                    help="Submit each notebook variant made with --spike as a separate job instead of one job array per notebook.")
+    parser.add_argument("--array-throttle",
+                    dest="array_throttle",
+                    type=int,
+                    default=None,
+                    help="Max number of tasks in a --spike job array running at the same time.")
+    parser.add_argument("--executor",
+                    dest="executor",
+                    choices=['nbconvert', 'kernel-pool'],
+                    default='nbconvert',
+                    help="How notebooks are executed. 'nbconvert' runs each notebook as a separate job using jupyter nbconvert. "
+                         "'kernel-pool' runs all notebooks in a single job using a pool of pre-started kernels.")
+    parser.add_argument("--pool-size",
+                    dest="pool_size",
+                    type=int,
+                    default=None,
+                    help="Number of kernels in the pool used with --executor kernel-pool. Defaults to the number of cores.")
+    parser.add_argument("--reuse-kernel",
+                    dest="reuse_kernel",
+                    action='store_true',
+                    help="With --executor kernel-pool, run all notebooks in one kernel that is only reset between notebooks. "
+                         "Imported modules stay loaded, so only use this for notebooks you trust not to interfere with each other.")
+    parser.add_argument("--preload",
+                    dest="preload",
+                    type=str,
+                    default='',
+                    help="With --executor kernel-pool, code to run in each kernel when it starts (E.g. \"import numpy, pandas\").")
+    parser.add_argument("--incremental",
+                    dest="incremental",
+                    action='store_true',
+                    help="Only execute cells that changed (or have changed cells above them) since the last run. "
+                         "Kernel state is saved after slow cells so execution can resume from there. "
+                         "Requires dill in the environment and implies --executor kernel-pool.")
+    parser.add_argument("--checkpoint-dir",
+                    dest="checkpoint_dir",
+                    type=str,
+                    default=None,
+                    help="Directory for --incremental checkpoints. Use a scratch directory visible from all nodes. "
+                         "Defaults to ~/.slurm_jupyter_run/checkpoints.")
+    parser.add_argument("--checkpoint-min-time",
+                    dest="checkpoint_min_time",
+                    type=float,
+                    default=30,
+                    help="With --incremental, save kernel state after cells taking at least this many seconds. Default 30.")
+    parser.add_argument("--status",
+                    dest="status",
+                    nargs='?',
+                    const='latest',
+                    default=None,
+                    help="Show the state of each job (and job array task) submitted by the latest run of slurm-nb-run "
+                         "(or the run that submitted the given job id) and exit.")
+    parser.add_argument("--watch",
+                    dest="watch",
+                    nargs='?',
+                    const='latest',
+                    default=None,
+                    help="Follow the progress of each cell in each notebook of the latest run of slurm-nb-run "
+                         "(or the run that submitted the given job id) until all jobs have finished.")
+    parser.add_argument("--wait",
+                    dest="wait",
+                    action='store_true',
+                    help="Wait for all jobs to finish and then show their state.")
+    parser.add_argument("--backend",
+                    dest="backend",
+                    choices=['sbatch', 'gwf'],
+                    default='sbatch',
+                    help="How jobs are submitted. 'sbatch' submits jobs directly. 'gwf' submits them as a gwf workflow (requires gwf) "
+                         "with a target for each notebook (and spike variant).")
+    parser.add_argument("--max-submit",
+                    dest="max_submit",
+                    type=int,
+                    default=8,
+                    help="Max number of jobs submitted at the same time.")
 
     parser.add_argument("-v", "--verbose",
                     dest="verbose",
@@ -1085,6 +2308,10 @@ def slurm_nb_run():
         print('Only not use --inplace with other formats than "notebook" format')
         sys.exit()
 
+    if args.backend == 'gwf' and (args.executor == 'kernel-pool' or args.incremental):
+        print("--backend gwf runs each notebook as a gwf target and cannot be used with --executor kernel-pool or --incremental")
+        sys.exit()
+
     # if args.cleanup and not args.spike:
     #     print("Only use --cleanup with --spike")
     #     sys.exit()
@@ -1107,14 +2334,30 @@ def slurm_nb_run():
             'slurm': 'source /com/extra/slurm/14.03.0/load.sh',
             'tmp_name': 'slurm_jupyter_run',
             'tmp_dir': home+'/.slurm_jupyter_run',
-            'tmp_script': 'slurm_jupyter_run_{}.sh'.format(int(time.time())),
+            'tmp_script': 'slurm_jupyter_run_{}_{}.sh'.format(int(time.time()), os.getpid()),
             'job_name': args.name,
             'job_id': None,
             'timeout': args.timeout,
             'format': args.format,
             'inplace': args.inplace,
+            'gres': '',
+            'log_id': '%j',
+            'array_spec': '',
+            'dependency_type': 'afterok',
+            'activation': '',
             }
 
+    if args.status:
+        run_status(spec, job_id=args.status != 'latest' and args.status or None, verbose=args.verbose)
+        return
+
+    if args.watch:
+        watch_run(spec, job_id=args.watch != 'latest' and args.watch or None, verbose=args.verbose)
+        return
+
+    if args.queue == 'gpu':
+        spec['gres'] = '#SBATCH --gres=gpu:1'
+
     if not os.path.exists(spec['tmp_dir']):
         os.makedirs(spec['tmp_dir'])
 
@@ -1144,6 +2387,18 @@ def slurm_nb_run():
     else:   
         spec['ipcluster'] = ''
 
+    if args.local_env:
+        spec['environment_name'], prefix, spec['conda_root'] = local_conda_environment(args.environment)
+        if prefix is None:
+            print("Could not find conda environment {} to use with --local-env".format(args.environment or '(none active)'))
+            sys.exit()
+        spec['activation'] = local_env_spec(spec, prefix, env_timings=args.env_timings)
+
+    for path in args.stage:
+        if not os.path.exists(path):
+            print("Input to stage not found:", path)
+            sys.exit()
+    stage_spec(spec, [os.path.abspath(p) for p in args.stage], checksum=args.stage_checksum)
 
     if args.allow_errors:
         spec['allow_errors'] = '--allow-errors'
@@ -1155,22 +2410,41 @@ def slurm_nb_run():
     else:
         spec['inplace'] = ''
 
-    nbconvert_cmd = "jupyter nbconvert --ClearOutputPreprocessor.enabled=True --ExecutePreprocessor.timeout={timeout} {allow_errors} {inplace} --to {format} --execute {notebook}"
-
     notebook_list = args.notebooks
 
-    import nbformat
+    global TRACE
+    TRACE = PhaseTrace()
 
+    # build the dependency graph between notebooks
+    try:
+        with TRACE.span('dag'):
+            dag = build_dag(notebook_list, after=parse_after(args.after), serial=args.serial)
+    except DependencyException as e:
+        print(e)
+        sys.exit()
 
-    # TODO: submit jobs trough GWF Do the whole thing in a tmp dir and only cp
-    # back to the destination as last command so that we do not get notebooks
-    # that are not run
-
-    # make a template that runs one notebook
-
-    from gwf import Workflow, AnonymousTarget
-
-    gwf = Workflow(defaults={'account': args.account})
+    # jobs and gwf targets are named after the notebooks
+    notebook_names = {}
+    for notebook in dag:
+        notebook_names.setdefault(target_name(notebook), []).append(notebook)
+    for name, notebooks in notebook_names.items():
+        if len(notebooks) > 1:
+            print("Notebooks {} would run as jobs with the same name ({}). Rename one of them.".format(
+                ' and '.join(notebooks), name))
+            sys.exit(1)
+
+    nr_variants = args.spike and len(args.spike) or 1
+    length, path = critical_path(dag)
+    print("Total work: {} notebook(s). Critical path: {} notebook(s) ({})".format(
+        len(dag) * nr_variants, length, ' -> '.join(modpath(p, parent='') for p in path)))
+
+    # TODO: Do the whole thing in a tmp dir and only cp back to the
+    # destination as last command so that we do not get notebooks that are
+    # not run
+
+    if args.backend == 'gwf':
+        from gwf import Workflow, AnonymousTarget
+        gwf = Workflow(defaults={'account': args.account})
 
     def run_workflow(workflow):
         from gwf.backends import Backend
@@ -1185,133 +2459,251 @@ def slurm_nb_run():
             scheduler = Scheduler(graph=graph, backend=backend, dry_run=False)
             scheduler.schedule_many(list(graph))
 
-    def nbconvert(notebook_file_name, output_file, dependencies=[], inplace=False, 
-                  output_format='notebook', allow_errors=False, timeout=-1):
+    def nbconvert(cmd, output_file, dependencies=[]):
         inputs = dependencies
         outputs = [output_file]
         options = {
             'cores': args.cores,
             'memory': args.total_memory,
         }
-
-        if allow_errors:
-            allow_errors = '--allow-errors'
-        else:
-            allow_errors = ''
-
-        if inplace:
-            inplace = '--inplace'
-        else:
-            inplace = ''
-
-        spec = f'''
-        cp {notebook_file_name} $TMPDIR/`basename {notebook_file_name}` && \
-        nbconvert_cmd = "jupyter nbconvert --ClearOutputPreprocessor.enabled=True \
-            --ExecutePreprocessor.timeout={timeout} {allow_errors} {inplace and '--allow-errors' or ''} \
-                --to {output_format} --execute {notebook_file_name}" && \
-        cp $TMPDIR/`basename {notebook_file_name}` {output_file}
-        '''
-
-        return AnonymousTarget(inputs=inputs, outputs=outputs, options=options, spec=spec)
-
-
-
-
-    if not args.spike:
-        dependencies = []
-        for notebook in notebook_list:
-            gwf.target_from_template(
-                name=modpath(notebook, parent=''),
-                template=nbconvert(
-                    notebook_file_name=notebook,
-                    dependencies=dependencies,
-                    inplace=True,
-                    allow_errors=False, 
-                    timeout=args.timeout,
-                    output_format=args.format
+        return AnonymousTarget(inputs=inputs, outputs=outputs, options=options, spec=cmd)
+
+    # jobs for the sbatch backend: name mapped to (spec, names of jobs it
+    # depends on) and what each job runs
+    jobs, records = {}, {}
+    # names of jobs not submitted because their results were restored from the cache
+    restored = set()
+
+    def add_job(name, commands, dependencies, record, **options):
+        job_spec = spec.copy()
+        job_spec.update(options)
+        job_spec['job_name'] = name
+        # the pid keeps the names apart when several runs start in the same second
+        job_spec['tmp_script'] = 'slurm_jupyter_run_{}_{}_{}.sh'.format(int(time.time()), os.getpid(), name)
+        # jobs report the progress of each cell to an event file in this directory
+        job_spec['commands'] = 'export {}={}\n{}'.format(
+            EVENT_DIR_VARIABLE, shlex.quote(os.path.join(spec['tmp_dir'], 'events')), commands)
+        unknown = [d for d in dependencies if d not in jobs and d not in restored]
+        if unknown:
+            print(RED + "Job {} depends on unknown job(s): {}".format(name, ', '.join(unknown)) + ENDC)
+            sys.exit(1)
+        jobs[name] = (job_spec, [d for d in dependencies if d in jobs])
+        records[name] = record
+
+    # remove old cached results and get environment digest for cache keys
+    cache_dir = os.path.join(spec['tmp_dir'], 'cache')
+    max_size = args.cache_max_size and str_to_mb(args.cache_max_size) or None
+    with TRACE.span('cache eviction'):
+        removed, freed = evict(cache_dir, max_age=args.cache_max_age, max_size=max_size)
+    if removed:
+        print("Removed {} old cache entries ({:.1f} Mb)".format(removed, freed / 1024**2))
+    with TRACE.span('environment digest'):
+        env_digest = environment_digest(args.environment)
+
+    for path in glob.glob(os.path.join(spec['tmp_dir'], 'events', '*.jsonl')):
+        if time.time() - os.path.getmtime(path) > args.cache_max_age * 86400:
+            os.remove(path)
+
+    checkpoint_dir = args.checkpoint_dir or os.path.join(spec['tmp_dir'], 'checkpoints')
+    if args.incremental:
+        evict(checkpoint_dir, max_age=args.cache_max_age, max_size=max_size)
+        if args.executor != 'kernel-pool':
+            print("Using --executor kernel-pool for --incremental")
+            args.executor = 'kernel-pool'
+
+    def prepare(notebook, notebook_path, upstream_keys, spike_file=None):
+        # looks up cached result and otherwise makes the command storing the result in the cache
+        inplace = bool(spec['inplace'])
+        notebook_path = os.path.abspath(notebook_path)
+        output_file = executed_notebook_path(notebook_path, args.format, inplace=inplace)
+
+        # skip notebooks if a result for the same code, parameters, environment and inputs is cached
+        declared = notebook_metadata(notebook)
+        key = cache_key(notebook_path, spike_file=spike_file, env_digest=env_digest,
+                        input_files=declared['inputs'], upstream_keys=upstream_keys,
+                        options=[args.format, args.allow_errors, inplace], all_cells=inplace)
+        entry = lookup(cache_dir, key)
+        if entry and not args.force:
+            restore(entry)
+            print("Restored cached result:", modpath(output_file, parent=''))
+            return key, output_file, None
+        return key, output_file, store_command(cache_dir, key, [output_file] + declared['outputs'])
+
+    def execute_command(notebook_path, output_file, store_cmd):
+        return nbconvert_command(notebook_path, output_file, output_format=args.format,
+                                 allow_errors=args.allow_errors, timeout=args.timeout) + ' && ' + store_cmd
+
+    def add_targets(notebook_paths, suffix='', spike_file=None):
+        # one job for each notebook depending on the jobs of the notebooks
+        # it depends on so independent notebooks run concurrently
+        output_files, keys = {}, {}
+        for notebook in topological_order(dag):
+            keys[notebook], output_files[notebook], store_cmd = prepare(
+                notebook, notebook_paths[notebook], [keys[d] for d in dag[notebook]], spike_file)
+            if store_cmd is None:
+                restored.add(target_name(notebook, suffix))
+                continue
+            cmd = execute_command(notebook_paths[notebook], output_files[notebook], store_cmd)
+            if args.backend == 'gwf':
+                # gwf links targets through their input and output files
+                dependencies = [output_files[d] for d in dag[notebook]]
+                if not spec['inplace']:
+                    dependencies.append(os.path.abspath(notebook_paths[notebook]))
+                cmd = 'export {}={}\n{}'.format(
+                    EVENT_DIR_VARIABLE, shlex.quote(os.path.join(spec['tmp_dir'], 'events')), cmd)
+                gwf.target_from_template(
+                    name=target_name(notebook, suffix),
+                    template=nbconvert(cmd, output_files[notebook], dependencies=dependencies)
                 )
-            )
-            dependencies.append(notebook)
+                records[target_name(notebook, suffix)] = {'notebook': notebook_paths[notebook]}
+            else:
+                add_job(target_name(notebook, suffix), cmd, [target_name(d, suffix) for d in dag[notebook]],
+                        {'notebook': notebook_paths[notebook]})
+
+    def submit_arrays(variants):
+        # one job array for each notebook where task i runs the variant
+        # for spike file i. Tasks only wait for the corresponding task in
+        # the arrays of the notebooks they depend on.
+        keys = dict((spike_file, {}) for spike_file in args.spike)
+        for notebook in topological_order(dag):
+            cases, tasks = [], {}
+            for i, spike_file in enumerate(args.spike):
+                variant = variants[spike_file][notebook]
+                keys[spike_file][notebook], output_file, store_cmd = prepare(
+                    notebook, variant, [keys[spike_file][d] for d in dag[notebook]], os.path.abspath(spike_file))
+                if store_cmd is None:
+                    continue
+                cases.append('{}) {} ;;'.format(i, execute_command(variant, output_file, store_cmd)))
+                tasks[i] = {'spike': spike_file, 'notebook': variant}
+            if not tasks:
+                restored.add(target_name(notebook))
+                continue
+
+            array_spec = '#SBATCH --array={}'.format(index_ranges(tasks))
+            if args.array_throttle:
+                array_spec += '%{}'.format(args.array_throttle)
+            add_job(target_name(notebook), 
+                    'case $SLURM_ARRAY_TASK_ID in\n{}\nesac'.format('\n'.join(cases)),
+                    [target_name(d) for d in dag[notebook]],
+                    {'notebook': notebook, 'tasks': tasks},
+                    log_id='%A_%a', array_spec=array_spec, dependency_type='aftercorr')
+
+    def submit_pool_job(variants):
+        # a single job where one driver process runs all notebooks using a
+        # pool of pre-started kernels. variants is a list of (suffix,
+        # spike_file, notebook_paths) tuples
+        plan = {'timeout': args.timeout, 'allow_errors': args.allow_errors, 'format': args.format, 'tasks': []}
+        for suffix, spike_file, notebook_paths in variants:
+            keys, names = {}, {}
+            for notebook in topological_order(dag):
+                keys[notebook], output_file, store_cmd = prepare(
+                    notebook, notebook_paths[notebook], [keys[d] for d in dag[notebook]], spike_file)
+                if store_cmd is None:
+                    continue
+                names[notebook] = target_name(notebook, suffix)
+                task = {'name': names[notebook], 
+                        'notebook': os.path.abspath(notebook_paths[notebook]),
+                        'output': output_file,
+                        'dependencies': [names[d] for d in dag[notebook] if d in names],
+                        'post': store_cmd}
+                if args.incremental:
+                    # cell fingerprints must change with anything but the code the results depend on
+                    task['salt'] = parameter_digest(spike_file, env_digest, notebook_metadata(notebook)['inputs'],
+                                                    [keys[d] for d in dag[notebook]])
+                plan['tasks'].append(task)
+        if not plan['tasks']:
+            return
+        if args.incremental:
+            plan['checkpoints'] = {'dir': checkpoint_dir, 'min_secs': args.checkpoint_min_time}
+
+        plan_file = os.path.join(spec['tmp_dir'], 'plan_{}_{}.json'.format(int(time.time()), os.getpid()))
+        with open(plan_file, 'w') as f:
+            json.dump(plan, f)
+        cmd = 'python -m slurm_jupyter.executor {} --pool-size {}'.format(plan_file, args.pool_size or args.cores)
+        if args.reuse_kernel:
+            cmd += ' --reuse-kernel'
+        if args.preload:
+            cmd += ' --preload {}'.format(shlex.quote(args.preload))
+        add_job(target_name(args.name), cmd, [], {'notebook': '{} notebook(s) using kernel pool'.format(len(plan['tasks']))})
+
+    # look up cached results and make the jobs for the rest
+    TRACE.begin('plan')
+    if not args.spike:
+        notebook_paths = dict((notebook, notebook) for notebook in notebook_list)
+        if args.executor == 'kernel-pool':
+            submit_pool_job([('', None, notebook_paths)])
+        else:
+            add_targets(notebook_paths)
 
         # command_list = [nbconvert_cmd.format(notebook=notebook, **spec) for notebook in notebook_list]
         # spec['commands'] = ' && '.join(command_list)
         # submit_slurm_batch_job(spec, verbose=args.verbose)
 
     else:
-        for spike_file in args.spike:
-
-            # new cell to add/replace:
-            new_cell_source = '%run {}'.format(os.path.abspath(spike_file))
-
-            new_notebook_list = list()
-
-            for notebook_path in notebook_list:
-
-                # TODO: instead add gwf targets with dependencies
-                # TODO: disallow --allow-errors when running more than one notebook
-
-                # find cell with %run magic if any
-                with open(notebook_path) as f:
-                    nb = nbformat.read(f, as_version=4)
-                for i in range(len(nb.cells)):
-                    cell = nb.cells[i]
-                    if r'%run' in cell.source:
-                        cell_idx = i
-                        break
-                else:
-                    cell_idx = None
-
-                if cell_idx is None or not args.replace_first_run_magic:
-                    # insert new cell at top
-                    if nb.nbformat == 4:
-                        new_cell = nbformat.v4.new_code_cell(source=new_cell_source)
-                    else:
-                        print("Notebook format is not 4", file=sys.stderr)
-                        sys.exit()
-                    nb.cells.insert(0, new_cell)
-                else:
-                    # replace argument to first %run magic
-                    nb.cells[cell_idx].source = re.sub(r'%run\s+\S+', 
-                        new_cell_source, nb.cells[cell_idx].source, 1)
-
-                notebook_base_name = modpath(notebook_path, parent='', suffix='')
-                out_dir = modpath(notebook_path, suffix='')
-                os.makedirs(out_dir, exist_ok=True)
-
-                suffix = modpath(spike_file, suffix='', parent='')
-
-                new_notebook_path = modpath(notebook_path, base=notebook_base_name + '_' + suffix, parent=out_dir)
-                with open(new_notebook_path, 'w') as f:
-                    nbformat.write(nb, f)
+        # TODO: disallow --allow-errors when running more than one notebook
+        try:
+            with TRACE.span('variants', count=len(notebook_list) * len(args.spike)):
+                variants = make_variants(notebook_list, args.spike, replace_run_magic=args.replace_first_run_magic)
+        except SpikeException as e:
+            print(e, file=sys.stderr)
+            sys.exit()
 
-                new_notebook_list.append(new_notebook_path)
+        if args.executor == 'kernel-pool':
+            submit_pool_job([(modpath(spike_file, parent='', suffix=''), os.path.abspath(spike_file), variants[spike_file]) 
+                             for spike_file in args.spike])
+        elif args.job_array and args.backend != 'gwf':
+            submit_arrays(variants)
+        else:
+            for spike_file in args.spike:
+                # variants of the same spike file have the same dependencies as the original notebooks
+                add_targets(variants[spike_file], suffix=modpath(spike_file, parent='', suffix=''), 
+                            spike_file=os.path.abspath(spike_file))
 
-            ###################################
-            dependencies = [os.path.abspath(spike_file)]
-            for notebook in notebook_list:
-                gwf.target_from_template(
-                    name=modpath(notebook, parent='', suffix='') + '_' + modpath(spike_file, parent='', suffix=''),
-                    template=nbconvert(
-                        notebook_file_name=os.path.abspath(notebook),
-                        output_file=os.path.abspath(new_notebook_path),
-                        dependencies=dependencies,
-                        inplace=True,
-                        allow_errors=False, 
-                        timeout=args.timeout,
-                        output_format=args.format
-                    )
-                )
-                dependencies.append(os.path.abspath(notebook))
+    TRACE.end('plan', jobs=len(jobs))
 
-            ###################################
+    trace_file = os.path.join(spec['tmp_dir'], 'traces', 'run_{}.json'.format(int(time.time())))
 
-            # if args.format != 'notebook' and args.cleanup:
-            #     param_nbconvert_cmd = nbconvert_cmd + ' && rm -f {notebook}'
-            # else:
-            #     param_nbconvert_cmd = nbconvert_cmd
+    job_ids = {}
+    if args.backend == 'gwf' and gwf.targets:
+        with TRACE.span('gwf'):
+            run_workflow(gwf)
+            # gwf names jobs after their targets
+            job_ids = queued_job_ids(list(gwf.targets), getpass.getuser(), verbose=args.verbose)
 
-            # command_list = [param_nbconvert_cmd.format(notebook=notebook, **spec) for notebook in new_notebook_list]
-            # spec['commands'] = ' && '.join(command_list)
-            # submit_slurm_batch_job(spec, verbose=args.verbose)
+    if jobs:
+        def submit(job_spec, dependencies):
+            return submit_slurm_batch_job(job_spec, dependencies=dependencies, verbose=args.verbose)
 
-    run_workflow(gwf)
+        start = time.time()
+        try:
+            with TRACE.span('submit', jobs=len(jobs)):
+                job_ids = submit_graph(jobs, submit, max_workers=args.max_submit)
+        except SubmitException as e:
+            print(RED + str(e.error).strip() + ENDC)
+            if e.job_ids:
+                # the run is incomplete, so jobs already submitted are cancelled rather than left orphaned
+                print("Cancelling the {} job(s) already submitted: {}".format(
+                    len(e.job_ids), ' '.join(e.job_ids.values())))
+                execute('scancel {}'.format(' '.join(e.job_ids.values())), check_failure=False)
+            sys.exit(1)
+        print("Submitted {} job(s) in {:.1f} s".format(len(job_ids), time.time() - start))
+
+    if job_ids:
+        run = {'created': time.time(), 
+               'jobs': [dict(records[name], name=name, job_id=job_ids[name]) for name in records if name in job_ids]}
+        run_file = os.path.join(spec['tmp_dir'], 'run_{}.json'.format(run['jobs'][0]['job_id']))
+        with open(run_file, 'w') as f:
+            json.dump(run, f)
+        trace_file = os.path.join(spec['tmp_dir'], 'traces', 'run_{}.json'.format(run['jobs'][0]['job_id']))
+
+    TRACE.save(trace_file)
+    print("Prepared in " + TRACE.breakdown())
+
+    if job_ids:
+        if args.wait:
+            with TRACE.span('wait'):
+                wait_for_jobs(list(job_ids.values()), verbose=args.verbose)
+            TRACE.save(trace_file)
+            run_status(spec, job_id=run['jobs'][0]['job_id'], verbose=args.verbose)
+        else:
+            print("Use slurm-nb-run --watch to follow the progress of each notebook or --status to see the state of each job")
@@ -0,0 +1,373 @@
+"""Opt-in local agent that runs jupyter sessions in the background. The agent
+listens on a Unix-domain socket in ~/.slurm_jupyter/agent and runs each
+session (port forwarding, log streams, memory monitor and teardown) in a
+forked process of its own, so sessions survive closed terminals and
+`slurm-jupyter --agent`, `--agent-status` and `--agent-stop` return at once.
+
+Clients send one JSON line and read one JSON line back:
+
+    {"cmd": "launch", "argv": [...], "cwd": "...", "env": {...}}
+    {"cmd": "status"}
+    {"cmd": "stop", "session": "3"}   # or "all"
+    {"cmd": "shutdown"}
+
+Sessions are kept in a journal (sessions.json), so an agent that is
+restarted picks up sessions that are still running.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import selectors
+import traceback
+from subprocess import Popen, DEVNULL
+
+from .utils import on_windows
+
+# sessions run by the agent write their job details to the file named by this variable
+SESSION_FILE_VARIABLE = 'SLURM_JUPYTER_SESSION_FILE'
+
+# seconds the agent keeps running without sessions
+IDLE_TIMEOUT = 600
+
+# seconds between update checks in sessions started by the agent
+UPDATE_CHECK_INTERVAL = 86400
+
+
+def agent_dir():
+    """Directory with the agent socket, journal and session logs.
+
+    Returns:
+        str: Directory path.
+    """
+    return os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'agent')
+
+
+def socket_path():
+    return os.path.join(agent_dir(), 'agent.sock')
+
+
+def send(message, timeout=10):
+    """Sends a request to the agent.
+
+    Args:
+        message (dict): Request.
+        timeout (float, optional): Seconds to wait for the reply. Defaults to 10.
+
+    Returns:
+        dict: Reply or None if the agent is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        return None
+    try:
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return data and json.loads(data.decode()) or None
+
+
+def start_agent(timeout=10):
+    """Starts the agent in the background unless it is running.
+
+    Args:
+        timeout (float, optional): Seconds to wait for the agent to listen. Defaults to 10.
+
+    Returns:
+        bool: True if the agent is running.
+    """
+    if send({'cmd': 'ping'}) is not None:
+        return True
+    os.makedirs(agent_dir(), mode=0o700, exist_ok=True)
+    with open(os.path.join(agent_dir(), 'agent.log'), 'a') as log:
+        Popen([sys.executable, '-c', 'from slurm_jupyter.agent import main; main()'],
+              stdin=DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    start = time.time()
+    while time.time() - start < timeout:
+        if send({'cmd': 'ping'}) is not None:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def process_alive(pid):
+    """Whether a process is running (and not a zombie)."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+class Agent(object):
+    """Agent serving requests on the socket and running sessions.
+
+    The agent is single-threaded, so sessions can safely be forked from it.
+    Forked sessions reuse the modules the agent has already imported.
+    """
+
+    def __init__(self):
+        self.dir = agent_dir()
+        self.journal = os.path.join(self.dir, 'sessions.json')
+        self.sessions = {}
+        self.next_id = 1
+        self.last_update_check = 0
+        self.idle_since = time.time()
+        self.running = True
+        self.listener = None
+        self.load()
+
+    def load(self):
+        """Loads the journal, keeping sessions that are still running."""
+        try:
+            with open(self.journal) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.next_id = journal.get('next_id', 1)
+        self.last_update_check = journal.get('last_update_check', 0)
+        for session in journal.get('sessions', []):
+            if session['state'] == 'running' and not process_alive(session['pid']):
+                session['state'] = 'lost'
+            self.sessions[session['id']] = session
+
+    def save(self):
+        tmp = self.journal + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'next_id': self.next_id, 'last_update_check': self.last_update_check,
+                       'sessions': list(self.sessions.values())}, f, indent=1)
+        os.replace(tmp, self.journal)
+
+    def session_info(self, session):
+        """Session with the job details the session has recorded."""
+        info = dict(session)
+        try:
+            with open(session['info_file']) as f:
+                info.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return info
+
+    def launch(self, argv, cwd, env):
+        """Forks a process running slurm-jupyter with the given arguments.
+
+        Args:
+            argv (list): Command line arguments.
+            cwd (str): Working directory of the client.
+            env (dict): Environment of the client.
+
+        Returns:
+            dict: The new session.
+        """
+        session_id = str(self.next_id)
+        self.next_id += 1
+        log_file = os.path.join(self.dir, 'session_{}.log'.format(session_id))
+        info_file = os.path.join(self.dir, 'session_{}.json'.format(session_id))
+        argv = list(argv)
+        if time.time() - self.last_update_check < UPDATE_CHECK_INTERVAL:
+            # preflight the agent has done recently
+            argv.append('--skip-update-check')
+        elif '-x' not in argv and '--skip-update-check' not in argv:
+            self.last_update_check = time.time()
+
+        pid = os.fork()
+        if pid == 0:
+            self.run_session(argv, cwd, dict(env, **{SESSION_FILE_VARIABLE: info_file}), log_file)
+        session = {'id': session_id, 'pid': pid, 'argv': argv, 'cwd': cwd, 'state': 'running',
+                   'started': time.time(), 'ended': None, 'exit_code': None,
+                   'log_file': log_file, 'info_file': info_file}
+        self.sessions[session_id] = session
+        self.save()
+        return session
+
+    def run_session(self, argv, cwd, env, log_file):
+        # runs in the forked process and never returns
+        code = 1
+        teardown = None
+        try:
+            os.setsid()
+            self.listener.close()
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            sys.stdout = os.fdopen(1, 'w', buffering=1, closefd=False)
+            sys.stderr = os.fdopen(2, 'w', buffering=1, closefd=False)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            sys.argv = ['slurm-jupyter'] + argv
+            from . import slurm_jupyter
+            from .teardown import Teardown
+            teardown = Teardown()
+            slurm_jupyter(teardown=teardown)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (e.code is not None)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            # cancel the job unless the session already ended through its teardown
+            if teardown is not None:
+                try:
+                    teardown.run()
+                except BaseException:
+                    pass
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def stop(self, session_id):
+        """Stops sessions like Ctrl-C, which cancels their jobs.
+
+        Args:
+            session_id (str): Session id or 'all'.
+
+        Returns:
+            list: Ids of the sessions stopped.
+        """
+        stopped = []
+        for session in self.sessions.values():
+            if session['state'] == 'running' and session_id in ('all', session['id']):
+                try:
+                    os.killpg(session['pid'], signal.SIGINT)
+                except OSError:
+                    continue
+                session['state'] = 'stopping'
+                stopped.append(session['id'])
+        self.save()
+        return stopped
+
+    def reap(self):
+        """Records the exit of sessions."""
+        changed = False
+        for session in self.sessions.values():
+            if session['state'] not in ('running', 'stopping'):
+                continue
+            try:
+                pid, status = os.waitpid(session['pid'], os.WNOHANG)
+            except ChildProcessError:
+                # adopted from an earlier agent
+                pid, status = (not process_alive(session['pid'])) and session['pid'], None
+            if pid:
+                session['state'] = 'ended'
+                session['ended'] = time.time()
+                if status is not None:
+                    session['exit_code'] = os.waitstatus_to_exitcode(status) \
+                        if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+                changed = True
+        if changed:
+            self.save()
+        if any(s['state'] in ('running', 'stopping') for s in self.sessions.values()):
+            self.idle_since = time.time()
+
+    def handle(self, message):
+        """Handles a request.
+
+        Args:
+            message (dict): Request.
+
+        Returns:
+            dict: Reply.
+        """
+        cmd = message.get('cmd')
+        if cmd == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        if cmd == 'launch':
+            session = self.launch(message['argv'], message['cwd'], message['env'])
+            return {'ok': True, 'session': session}
+        if cmd == 'status':
+            self.reap()
+            return {'ok': True, 'sessions': [self.session_info(s) for s in self.sessions.values()]}
+        if cmd == 'stop':
+            stopped = self.stop(str(message.get('session', 'all')))
+            return {'ok': bool(stopped), 'stopped': stopped}
+        if cmd == 'shutdown':
+            self.running = False
+            return {'ok': True, 'stopped': self.stop('all')}
+        return {'ok': False, 'error': 'Unknown command: {}'.format(cmd)}
+
+    def serve(self, idle_timeout=IDLE_TIMEOUT):
+        """Serves requests until shut down or idle for idle_timeout seconds.
+
+        Args:
+            idle_timeout (float, optional): Seconds without sessions before exiting. Defaults to IDLE_TIMEOUT.
+        """
+        os.makedirs(self.dir, mode=0o700, exist_ok=True)
+        path = socket_path()
+        if send({'cmd': 'ping'}, timeout=1) is not None:
+            print('Agent already running')
+            return
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen(16)
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        # a closed terminal or logout must not stop the sessions
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'running', False))
+        print('Agent {} listening on {}'.format(os.getpid(), path), flush=True)
+        try:
+            while self.running:
+                for key, _ in selector.select(timeout=1):
+                    conn, _ = self.listener.accept()
+                    self.respond(conn)
+                self.reap()
+                if time.time() - self.idle_since > idle_timeout:
+                    break
+        finally:
+            selector.close()
+            self.listener.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            self.save()
+
+    def respond(self, conn):
+        conn.settimeout(5)
+        try:
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                reply = self.handle(json.loads(data.decode()))
+            except (ValueError, KeyError) as e:
+                reply = {'ok': False, 'error': 'Bad request: {}'.format(e)}
+            conn.sendall(json.dumps(reply).encode() + b'\n')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+def main():
+    """Runs the agent in the foreground."""
+    if on_windows():
+        print('The agent is not supported on Windows')
+        sys.exit(1)
+    Agent().serve()
@@ -0,0 +1,140 @@
+import re
+
+from .utils import execute, expand_ranges
+
+# state reported for pending jobs whose dependencies can never be satisfied
+# (E.g. submitted without --kill-on-invalid-dep). They will never run.
+NEVER_SATISFIED = 'DEPENDENCY_NEVER_SATISFIED'
+
+
+class SubmitException(Exception):
+    """A job could not be submitted.
+
+    Args:
+        error (Exception): The error submitting the job.
+        job_ids (dict): Name mapped to id of the jobs submitted before the error.
+    """
+
+    def __init__(self, error, job_ids):
+        super().__init__(str(error))
+        self.error = error
+        self.job_ids = job_ids
+
+
+def submit_graph(jobs, submit, max_workers=8):
+    """Submits jobs concurrently, each as soon as the jobs it depends on are submitted.
+
+    Args:
+        jobs (dict): Job name mapped to (spec, names of jobs it depends on).
+        submit (callable): Function taking a spec and a list of job ids of
+            the jobs it depends on, that submits the job and returns its id.
+        max_workers (int, optional): Max number of submissions at the same time. Defaults to 8.
+
+    Returns:
+        dict: Job name mapped to slurm job id.
+
+    Raises:
+        SubmitException: If a job could not be submitted. No more jobs are
+            submitted, and the exception holds the ids of those that were.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    job_ids, running, error = {}, {}, None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(job_ids) < len(jobs) and error is None:
+            for name, (spec, dependencies) in jobs.items():
+                if name in job_ids or name in running.values():
+                    continue
+                if all(d in job_ids for d in dependencies):
+                    future = executor.submit(submit, spec, [job_ids[d] for d in dependencies])
+                    running[future] = name
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    job_ids[name] = future.result()
+                except Exception as e:
+                    error = error or e
+        # submissions under way when a submission failed
+        for future, name in running.items():
+            try:
+                job_ids[name] = future.result()
+            except Exception:
+                pass
+    if error is not None:
+        raise SubmitException(error, job_ids)
+    return job_ids
+
+
+def queued_job_ids(names, user, verbose=False):
+    """Gets the ids of queued jobs from their names using a single squeue call.
+    Used for jobs submitted by gwf, which names jobs after their targets.
+
+    Args:
+        names (list): Job names.
+        user (str): User that submitted the jobs.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        dict: Job name mapped to slurm job id (the latest if there are more).
+    """
+    if not names:
+        return {}
+    cmd = "squeue -h -u {} -n {} -o '%j|%i'".format(user, ','.join(names))
+    if verbose: print(cmd)
+    stdout, stderr = execute(cmd)
+    job_ids = {}
+    for line in stdout.decode().splitlines():
+        name, _, job_id = line.strip().partition('|')
+        if name in names and (name not in job_ids or int(job_id) > int(job_ids[name])):
+            job_ids[name] = job_id
+    return job_ids
+
+
+def job_states(job_ids, verbose=False):
+    """Gets the state of jobs and job array tasks using a single sacct call.
+
+    Args:
+        job_ids (list): Slurm job ids.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        dict: Job id (E.g. 1234 or 1234_5 for array tasks) mapped to
+            (state, exit code, elapsed time). Pending jobs whose dependencies
+            can never be satisfied have state NEVER_SATISFIED.
+    """
+    if not job_ids:
+        return {}
+    cmd = 'sacct -X --noheader --parsable2 --format=JobID,State,ExitCode,Elapsed,Reason -j {}'.format(','.join(job_ids))
+    if verbose: print(cmd)
+    stdout, stderr = execute(cmd)
+
+    states = {}
+    for line in stdout.decode().splitlines():
+        job_id, state, exit_code, elapsed, reason = line.split('|')[:5]
+        state = state.split()[0] # E.g. "CANCELLED by 1234"
+        if state == 'PENDING' and reason == 'DependencyNeverSatisfied':
+            state = NEVER_SATISFIED
+        # array tasks that have not started are reported together like 1234_[5-9%2]
+        m = re.match(r'(\d+)_\[([^%\]]+)', job_id)
+        if m:
+            for idx in expand_ranges(m.group(2)):
+                states['{}_{}'.format(m.group(1), idx)] = (state, '', '')
+        else:
+            states[job_id] = (state, exit_code, elapsed)
+    return states
+
+
+def count_states(states):
+    """Counts jobs in each state.
+
+    Args:
+        states (dict): Job states from job_states.
+
+    Returns:
+        dict: State mapped to number of jobs.
+    """
+    counts = {}
+    for state, exit_code, elapsed in states.values():
+        counts[state] = counts.get(state, 0) + 1
+    return counts
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import shlex
+import shutil
+import hashlib
+
+from .utils import execute, ExecuteException
+
+# bump this to invalidate all existing cache entries
+CACHE_VERSION = '1'
+
+
+def file_digest(path, h=None):
+    """Computes sha256 digest of a file's contents.
+
+    Args:
+        path (str): File path.
+        h (hashlib._Hash, optional): Hash object to update instead of making a new one. Defaults to None.
+
+    Returns:
+        str: Hex digest.
+    """
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def notebook_code_digest(notebook_path, all_cells=False):
+    """Computes a digest of the code cells in a notebook, ignoring outputs,
+    markdown and cell metadata.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        all_cells (bool, optional): Also include markdown and raw cells. Defaults to False.
+
+    Returns:
+        str: Hex digest.
+    """
+    with open(notebook_path) as f:
+        nb = json.load(f)
+    h = hashlib.sha256()
+    kernel = nb.get('metadata', {}).get('kernelspec', {}).get('name', '')
+    h.update(kernel.encode())
+    for cell in nb.get('cells', []):
+        if cell.get('cell_type') == 'code' or all_cells:
+            source = cell.get('source', '')
+            if isinstance(source, list):
+                source = ''.join(source)
+            if all_cells:
+                h.update(b'\0' + cell.get('cell_type', '').encode())
+            h.update(b'\0' + source.encode())
+    return h.hexdigest()
+
+
+def environment_digest(environment=''):
+    """Computes a digest of the package list of a conda environment.
+
+    Args:
+        environment (str, optional): Name of conda environment. Defaults to the active one.
+
+    Returns:
+        str: Hex digest or empty string if conda is not available.
+    """
+    cmd = 'conda list --export'
+    if environment:
+        cmd += ' -n {}'.format(environment)
+    try:
+        stdout, stderr = execute(cmd)
+    except (ExecuteException, TypeError, OSError): # TypeError if conda is not on PATH
+        return ''
+    return hashlib.sha256(stdout).hexdigest()
+
+
+def parameter_digest(spike_file=None, env_digest='', input_files=(), upstream_keys=(), options=()):
+    """Computes a digest of everything but the notebook code that the result of executing a notebook depends on.
+
+    Args:
+        spike_file (str, optional): Python file run in the notebook using --spike. Defaults to None.
+        env_digest (str, optional): Digest of the environment's package list. Defaults to ''.
+        input_files (list, optional): Declared input files. Defaults to ().
+        upstream_keys (list, optional): Keys of notebooks this one depends on. Defaults to ().
+        options (list, optional): Execution options affecting the output. Defaults to ().
+
+    Returns:
+        str: Hex digest.
+    """
+    h = hashlib.sha256()
+    h.update(CACHE_VERSION.encode())
+    if spike_file:
+        h.update(file_digest(spike_file).encode())
+    h.update(env_digest.encode())
+    for path in sorted(input_files):
+        h.update(path.encode())
+        if os.path.exists(path):
+            h.update(file_digest(path).encode())
+    for key in sorted(upstream_keys):
+        h.update(key.encode())
+    for option in options:
+        h.update(str(option).encode())
+    return h.hexdigest()
+
+
+def cache_key(notebook_path, spike_file=None, env_digest='', input_files=(), upstream_keys=(), options=(),
+              all_cells=False):
+    """Computes the cache key for executing a notebook.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        spike_file (str, optional): Python file run in the notebook using --spike. Defaults to None.
+        env_digest (str, optional): Digest of the environment's package list. Defaults to ''.
+        input_files (list, optional): Declared input files. Defaults to ().
+        upstream_keys (list, optional): Keys of notebooks this one depends on. Defaults to ().
+        options (list, optional): Execution options affecting the output. Defaults to ().
+        all_cells (bool, optional): Also include markdown and raw cells, so a restored 
+            notebook only differs from the notebook in its outputs. Use when the 
+            notebook is executed in place. Defaults to False.
+
+    Returns:
+        str: Hex digest.
+    """
+    h = hashlib.sha256()
+    h.update(notebook_code_digest(notebook_path, all_cells=all_cells).encode())
+    h.update(parameter_digest(spike_file, env_digest, input_files, upstream_keys, options).encode())
+    return h.hexdigest()
+
+
+def lookup(cache_dir, key):
+    """Looks up a cache entry.
+
+    Args:
+        cache_dir (str): Cache directory.
+        key (str): Cache key.
+
+    Returns:
+        str: Path to entry directory or None if there is no entry.
+    """
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry, 'manifest.json')):
+        return entry
+    return None
+
+
+def restore(entry):
+    """Copies files stored in a cache entry back to where they were produced.
+
+    Args:
+        entry (str): Path to entry directory.
+
+    Returns:
+        list: Restored file paths.
+    """
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        manifest = json.load(f)
+    restored = []
+    for name, path in sorted(manifest['files'].items()):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy2(os.path.join(entry, name), path)
+        restored.append(path)
+    # update modification time so eviction is least-recently-used
+    os.utime(entry)
+    return restored
+
+
+def is_pending(name):
+    """Whether a directory in the cache is an entry being written by store_command."""
+    return '.pending.' in name or '.old.' in name
+
+
+def store_command(cache_dir, key, files):
+    """Makes shell command storing files in the cache once a notebook has run.
+
+    The job copies the files and the manifest to a pending directory of its
+    own (named by job id and process id, so runs with the same key do not
+    share it) and renames it to the entry, so that incomplete entries are
+    never seen by lookup. An existing entry (e.g. stored by a concurrent run
+    or replaced with --force) is moved aside first.
+
+    Args:
+        cache_dir (str): Cache directory.
+        key (str): Cache key.
+        files (list): Files to store.
+
+    Returns:
+        str: Shell command.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = shlex.quote(os.path.join(cache_dir, key))
+    manifest = dict(files=dict((str(i), os.path.abspath(p)) for i, p in enumerate(files)),
+                    created=time.time())
+    cmds = ['sjr_pending={}.pending.${{SLURM_JOB_ID:-local}}.$$'.format(entry),
+            'mkdir -p "$sjr_pending"']
+    cmds.extend('cp {} "$sjr_pending"/{}'.format(shlex.quote(path), name) for name, path in manifest['files'].items())
+    cmds.append('printf %s {} > "$sjr_pending"/manifest.json'.format(shlex.quote(json.dumps(manifest))))
+    cmds.append('{{ mv -T "$sjr_pending" {entry} 2>/dev/null || {{ mv -T {entry} {entry}.old.$$ 2>/dev/null; '
+                'mv -T "$sjr_pending" {entry} 2>/dev/null || rm -rf "$sjr_pending"; rm -rf {entry}.old.$$; }}; }}'.format(
+                    entry=entry))
+    return ' && '.join(cmds)
+
+
+def entry_size(entry):
+    """Total size of files in a cache entry.
+
+    Args:
+        entry (str): Path to entry directory.
+
+    Returns:
+        int: Size in bytes.
+    """
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def evict(cache_dir, max_age=None, max_size=None):
+    """Removes old cache entries.
+
+    Pending entries (see store_command) may belong to jobs that are still
+    running, so they are never removed to make room, and only removed for
+    age once they are older than max_age (E.g. left by a job that failed).
+
+    Args:
+        cache_dir (str): Cache directory.
+        max_age (float, optional): Remove entries not used for this many days. Defaults to None.
+        max_size (float, optional): Remove least recently used entries until the cache is
+            smaller than this many megabytes. Defaults to None.
+
+    Returns:
+        (int, int): Number of entries removed and bytes freed.
+    """
+    if not os.path.exists(cache_dir):
+        return 0, 0
+    entries, pending = [], []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        try:
+            if not os.path.isdir(entry):
+                continue
+            info = (os.path.getmtime(entry), entry_size(entry), entry)
+        except OSError:
+            # renamed or removed by a job or another run while we looked
+            continue
+        if is_pending(name):
+            pending.append(info)
+        else:
+            entries.append(info)
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    removed, freed = 0, 0
+    for mtime, size, entry in entries:
+        too_old = max_age is not None and now - mtime > max_age * 86400
+        too_big = max_size is not None and total > max_size * 1024**2
+        if not too_old and not too_big:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+        freed += size
+    for mtime, size, entry in pending:
+        if max_age is not None and now - mtime > max_age * 86400:
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+            freed += size
+    return removed, freed
@@ -0,0 +1,124 @@
+"""Named cluster profiles and the auto mode that probes all clusters at the
+same time and picks the one that gives the earliest usable server.
+
+Profiles are read from ~/.slurm_jupyter/clusters.json, which maps profile
+names to default values of command line options:
+
+    {
+        "genomedk": {"frontend": "login.genome.au.dk", "account": "baboon"},
+        "other": {"frontend": "login.other.dk", "user": "kmt", "queue": "short"}
+    }
+"""
+
+import os
+import json
+import time
+
+from .utils import execute, ExecuteException
+
+# --cluster value that probes all profiles
+AUTO = 'auto'
+
+# seconds assumed until a job starts when slurm cannot predict it and no node is idle
+UNKNOWN_WAIT = 3600
+
+
+def profiles_file():
+    return os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'clusters.json')
+
+
+def load_profiles():
+    """Reads the cluster profiles.
+
+    Returns:
+        dict: Profile name mapped to option defaults. Empty if there is no profile file.
+    """
+    try:
+        with open(profiles_file()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def parse_probe(text):
+    """Parses the key=value lines printed by probe_script.
+
+    Args:
+        text (str): Output.
+
+    Returns:
+        dict: Values of status, snapshot, root, prefix, wait and idle found.
+    """
+    values = {}
+    for line in text.splitlines():
+        key, _, value = line.partition('=')
+        if key in ['status', 'snapshot', 'root', 'prefix', 'wait', 'idle']:
+            values[key] = value.strip()
+    return values
+
+
+def probe_cluster(name, user, frontend, script, verbose=False):
+    """Probes a cluster with a single ssh call.
+
+    Args:
+        name (str): Profile name.
+        user (str): User name on the cluster.
+        frontend (str): Cluster frontend.
+        script (str): Probe script (templates.probe_script).
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        dict: Profile name, whether the cluster is reachable and the environment
+            exists, predicted seconds until a job starts (wait, None if unknown),
+            number of idle nodes, seconds the probe took and the activation
+            snapshot (as returned by cached_activation).
+    """
+    cmd = 'ssh -q -o ConnectTimeout=10 {}@{} sh -s'.format(user, frontend)
+    if verbose: print(cmd, script, sep='\n')
+    probe = {'name': name, 'frontend': frontend, 'reachable': False, 'usable': False,
+             'wait': None, 'idle': 0, 'activation': None}
+    start = time.time()
+    try:
+        stdout, stderr = execute(cmd, stdin=script.encode())
+    except ExecuteException as e:
+        # last line of the error message (the first is the command)
+        probe['error'] = str(e).strip().splitlines()[-1]
+        probe['latency'] = time.time() - start
+        return probe
+    probe['latency'] = time.time() - start
+    values = parse_probe(stdout.decode())
+    probe['reachable'] = True
+    probe['activation'] = dict((k, values[k]) for k in ['status', 'snapshot', 'root', 'prefix'] if k in values)
+    probe['usable'] = values.get('status') in ('cached', 'created')
+    if values.get('wait', '').lstrip('-').isdigit():
+        probe['wait'] = max(0, int(values['wait']))
+    if values.get('idle', '').isdigit():
+        probe['idle'] = int(values['idle'])
+    return probe
+
+
+def expected_wait(probe):
+    """Seconds until a server job is expected to start on a probed cluster."""
+    if probe['wait'] is not None:
+        return probe['wait']
+    return 0 if probe['idle'] else UNKNOWN_WAIT
+
+
+def probe_clusters(targets, verbose=False):
+    """Probes clusters concurrently.
+
+    Args:
+        targets (list): (profile name, user, frontend, probe script) tuples.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        list: Probes (see probe_cluster), best cluster first. Clusters that
+            are usable come first, ordered by expected wait, then by the number
+            of idle nodes and the time the probe took.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+        futures = [executor.submit(probe_cluster, *target, verbose=verbose) for target in targets]
+        probes = [f.result() for f in futures]
+    return sorted(probes, key=lambda p: (not p['usable'], expected_wait(p), -p['idle'], p['latency']))
@@ -0,0 +1,159 @@
+import os
+import json
+
+
+class DependencyException(Exception):
+    pass
+
+
+def notebook_metadata(notebook_path):
+    """Reads the slurm_jupyter section of a notebook's metadata.
+
+    Notebooks can declare the files they read and write and the notebooks
+    they must run after in their top-level metadata like this:
+
+        "metadata": {
+            "slurm_jupyter": {
+                "inputs": ["data/raw.csv"],
+                "outputs": ["data/clean.csv"],
+                "after": ["download.ipynb"]
+            }
+        }
+
+    Relative paths are relative to the directory of the notebook.
+
+    Args:
+        notebook_path (str): Path to notebook.
+
+    Returns:
+        dict: Declared inputs, outputs and after lists as absolute paths.
+    """
+    with open(notebook_path) as f:
+        nb = json.load(f)
+    meta = nb.get('metadata', {}).get('slurm_jupyter', {})
+    notebook_dir = os.path.dirname(os.path.abspath(notebook_path))
+    declared = {}
+    for key in ['inputs', 'outputs', 'after']:
+        declared[key] = [os.path.normpath(os.path.join(notebook_dir, p)) for p in meta.get(key, [])]
+    return declared
+
+
+def parse_after(after_args):
+    """Parses --after arguments.
+
+    Args:
+        after_args (list): Strings like NOTEBOOK:DEPENDENCY[,DEPENDENCY...].
+
+    Returns:
+        dict: Absolute notebook path mapped to list of absolute dependency paths.
+    """
+    after = {}
+    for arg in after_args or []:
+        if ':' not in arg:
+            raise DependencyException('Wrongly formatted --after spec (use NOTEBOOK:DEPENDENCY): {}'.format(arg))
+        notebook, deps = arg.split(':', 1)
+        after.setdefault(os.path.abspath(notebook), []).extend(os.path.abspath(d) for d in deps.split(',') if d)
+    return after
+
+
+def build_dag(notebooks, after=None, serial=False):
+    """Builds the dependency graph between notebooks.
+
+    A notebook depends on another if it reads a file the other declares as
+    output, if it declares the other in its "after" metadata, or if an
+    --after argument says so. With serial=True each notebook simply depends
+    on the one before it.
+
+    Args:
+        notebooks (list): Notebook paths.
+        after (dict, optional): Explicit dependencies from parse_after. Defaults to None.
+        serial (bool, optional): Chain notebooks in the order given. Defaults to False.
+
+    Returns:
+        dict: Notebook path mapped to the list of notebook paths it depends on.
+    """
+    paths = [os.path.abspath(nb) for nb in notebooks]
+    original = dict(zip(paths, notebooks))
+    dag = dict((nb, []) for nb in notebooks)
+
+    if serial:
+        for prev, nb in zip(notebooks, notebooks[1:]):
+            dag[nb].append(prev)
+        return dag
+
+    declared = dict((p, notebook_metadata(p)) for p in paths)
+    producers = {}
+    for p in paths:
+        for output in declared[p]['outputs']:
+            producers[output] = p
+
+    after = after or {}
+    for p in paths:
+        deps = set(producers[i] for i in declared[p]['inputs'] if i in producers)
+        deps.update(declared[p]['after'])
+        deps.update(after.get(p, []))
+        deps.discard(p)
+        for d in deps:
+            if d not in original:
+                raise DependencyException('{} depends on {}, which is not among the notebooks to run'.format(original[p], d))
+        dag[original[p]] = sorted(original[d] for d in deps)
+
+    topological_order(dag) # raises on cycles
+    return dag
+
+
+def topological_order(dag):
+    """Orders notebooks so that each comes after its dependencies.
+
+    Args:
+        dag (dict): Notebook mapped to its dependencies.
+
+    Returns:
+        list: Notebooks in a valid execution order.
+    """
+    order, state = [], {}
+
+    def visit(node, stack):
+        if state.get(node) == 'done':
+            return
+        if state.get(node) == 'visiting':
+            raise DependencyException('Circular notebook dependencies: {}'.format(' -> '.join(stack + [node])))
+        state[node] = 'visiting'
+        for dep in dag[node]:
+            visit(dep, stack + [node])
+        state[node] = 'done'
+        order.append(node)
+
+    for node in dag:
+        visit(node, [])
+    return order
+
+
+def critical_path(dag, weights=None):
+    """Finds the longest chain of dependent notebooks.
+
+    Args:
+        dag (dict): Notebook mapped to its dependencies.
+        weights (dict, optional): Cost of each notebook. Defaults to one per notebook.
+
+    Returns:
+        (float, list): Length of critical path and the notebooks on it.
+    """
+    if weights is None:
+        weights = {}
+    finish, previous = {}, {}
+    for node in topological_order(dag):
+        start = 0
+        previous[node] = None
+        for dep in dag[node]:
+            if finish[dep] > start:
+                start, previous[node] = finish[dep], dep
+        finish[node] = start + weights.get(node, 1)
+    if not finish:
+        return 0, []
+    node = max(finish, key=finish.get)
+    length, path = finish[node], []
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return length, path[::-1]
@@ -0,0 +1,329 @@
+"""Executes the notebooks of a slurm-nb-run job in a single driver process
+using a pool of pre-started kernels. Runs on the compute node like this:
+
+    python -m slurm_jupyter.executor plan.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from threading import Thread
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .incremental import CheckpointStore, cell_fingerprints, save_state_code, load_state_code
+from .progress import open_event_log, NotebookProgress
+
+ASYNC_CLIENT = 'jupyter_client.asynchronous.AsyncKernelClient'
+
+
+class KernelPool(object):
+    """Pool of running kernels.
+
+    Kernels are returned to the pool after use. Unless kernels are reused,
+    they are restarted in the background first so each notebook gets a clean
+    kernel without waiting for one to start.
+
+    Args:
+        size (int): Number of kernels.
+        kernel_name (str, optional): Kernel spec name. Defaults to 'python3'.
+        preload (str, optional): Code run in each kernel when started (E.g. imports). Defaults to ''.
+        reuse (bool, optional): Keep kernels running between notebooks. Defaults to False.
+    """
+
+    def __init__(self, size, kernel_name='python3', preload='', reuse=False):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.preload = preload
+        self.reuse = reuse
+        self.available = Queue()
+        self.kernels = []
+        self.restarts = []
+        threads = [Thread(target=self._add_kernel) for _ in range(size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _start(self, km):
+        from jupyter_client.blocking import BlockingKernelClient
+        if km.has_kernel:
+            km.restart_kernel(now=True)
+        else:
+            km.start_kernel()
+        if self.preload:
+            kc = BlockingKernelClient()
+            kc.load_connection_info(km.get_connection_info())
+            kc.start_channels()
+            try:
+                kc.wait_for_ready(timeout=60)
+                kc.execute_interactive(self.preload, store_history=False, output_hook=lambda msg: None)
+            finally:
+                kc.stop_channels()
+        self.available.put(km)
+
+    def _add_kernel(self):
+        from jupyter_client import KernelManager
+        km = KernelManager(kernel_name=self.kernel_name, client_class=ASYNC_CLIENT)
+        self.kernels.append(km)
+        self._start(km)
+
+    def acquire(self, kernel_name=None):
+        """Gets a running kernel.
+
+        Args:
+            kernel_name (str, optional): Kernel spec name required by the notebook. Defaults to None.
+
+        Returns:
+            jupyter_client.KernelManager: Kernel manager with a running kernel or None if
+                the notebook needs a kernel not in the pool.
+        """
+        if kernel_name and kernel_name != self.kernel_name:
+            return None
+        return self.available.get()
+
+    def release(self, km):
+        """Returns a kernel to the pool.
+
+        Args:
+            km (jupyter_client.KernelManager): Kernel manager.
+        """
+        if self.reuse:
+            self.available.put(km)
+        else:
+            t = Thread(target=self._start, args=(km,))
+            t.daemon = True
+            t.start()
+            self.restarts.append(t)
+
+    def shutdown(self):
+        """Shuts down all kernels.
+        """
+        for t in self.restarts:
+            t.join()
+        for km in self.kernels:
+            try:
+                km.shutdown_kernel(now=True)
+            except Exception:
+                pass
+
+
+def run_hidden(client, code):
+    """Runs code in the kernel without recording it in the notebook.
+
+    Args:
+        client (nbclient.NotebookClient): Notebook client with a running kernel.
+        code (str): Python code.
+
+    Returns:
+        dict: Content of the execute reply.
+    """
+    from jupyter_core.utils import run_sync
+    msg_id = client.kc.execute(code, silent=True, store_history=False, allow_stdin=False)
+    reply = run_sync(client.async_wait_for_reply)(msg_id)
+    return reply['content']
+
+
+def execute_notebook(task, pool, timeout=-1, allow_errors=False, output_format='notebook', checkpoints=None, log=None):
+    """Executes a notebook using a kernel from the pool and writes the result.
+
+    Args:
+        task (dict): Notebook and output file paths from the plan.
+        pool (KernelPool): Kernel pool.
+        timeout (int, optional): Cell execution timeout in seconds. Defaults to -1.
+        allow_errors (bool, optional): Allow errors in cell executions. Defaults to False.
+        output_format (str, optional): nbconvert output format. Defaults to 'notebook'.
+        checkpoints (dict, optional): Checkpoint directory and minimum cell execution time 
+            for saving kernel state. Only cells changed since the last run are executed. Defaults to None.
+        log (progress.EventLog, optional): Event log to report the progress of each cell to. Defaults to None.
+
+    Returns:
+        (float, int, float): Seconds spent executing the notebook, number of cells 
+            skipped, and the seconds it took to execute them the last time.
+    """
+    import nbformat
+    from nbclient import NotebookClient
+    from jupyter_core.utils import run_sync
+
+    start = time.time()
+    with open(task['notebook']) as f:
+        nb = nbformat.read(f, as_version=4)
+    notebook_dir = os.path.dirname(os.path.abspath(task['notebook']))
+    kernel_name = nb.metadata.get('kernelspec', {}).get('name')
+
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            cell.outputs = []
+            cell.execution_count = None
+
+    store, resume = None, -1
+    if checkpoints:
+        store = CheckpointStore(checkpoints['dir'])
+        fingerprints = cell_fingerprints(nb, task.get('salt', ''))
+        resume = store.resume_point(fingerprints)
+
+    km = pool.acquire(kernel_name)
+    client = NotebookClient(nb, km=km, timeout=timeout > 0 and timeout or None,
+                            allow_errors=allow_errors, resources={'metadata': {'path': notebook_dir}})
+
+    if km is not None:
+        # a pooled kernel was not started in the notebook directory
+        setup = 'import os; os.chdir({!r})'.format(notebook_dir)
+        if pool.reuse:
+            setup = 'get_ipython().run_line_magic("reset", "-f")\n' + setup
+        client.on_notebook_start = lambda notebook: client.kc.execute(setup, silent=True, store_history=False)
+
+    progress = NotebookProgress(task['notebook'], log=log)
+    progress.attach(client)
+    progress.start(nb, skipped=sum(c.cell_type == 'code' for c in nb.cells[:resume + 1]))
+
+    skipped, saved, ok = 0, 0, False
+    try:
+        with client.setup_kernel():
+            info_msg = run_sync(client.async_wait_for_reply)(client.kc.kernel_info())
+            if info_msg is not None:
+                nb.metadata['language_info'] = info_msg['content']['language_info']
+
+            if resume >= 0:
+                reply = run_hidden(client, load_state_code(store.state_path(fingerprints[resume])))
+                if reply['status'] != 'ok':
+                    print('Could not restore checkpoint for {} ({}: {}). Executing all cells.'.format(
+                        task['notebook'], reply.get('ename'), reply.get('evalue')), flush=True)
+                    run_hidden(client, 'get_ipython().run_line_magic("reset", "-f")')
+                    resume = -1
+
+            for index, cell in enumerate(nb.cells):
+                if cell.cell_type != 'code':
+                    continue
+                if index <= resume:
+                    record = store.load_outputs(fingerprints[index])
+                    cell.outputs = [nbformat.from_dict(output) for output in record['outputs']]
+                    cell.execution_count = record['execution_count']
+                    if record.get('profile'):
+                        cell.metadata.setdefault('slurm_jupyter', {})['profile'] = record['profile']
+                    skipped += 1
+                    saved += record['secs']
+                    continue
+
+                cell_start = time.time()
+                client.execute_cell(cell, index)
+                secs = time.time() - cell_start
+
+                if store is not None:
+                    store.save_outputs(fingerprints[index], cell, secs)
+                    if secs >= checkpoints['min_secs']:
+                        reply = run_hidden(client, save_state_code(store.state_path(fingerprints[index])))
+                        if reply['status'] != 'ok':
+                            print('Could not save kernel state after cell {} of {} ({}: {})'.format(
+                                index, task['notebook'], reply.get('ename'), reply.get('evalue')), flush=True)
+        ok = True
+    finally:
+        progress.end(ok)
+        if km is not None:
+            client.kc.stop_channels()
+            pool.release(km)
+
+    if skipped:
+        print('Resumed {} after cell {}: skipped {} cell(s) saving {:.1f} s'.format(
+            task['notebook'], resume, skipped, saved), flush=True)
+
+    tmp_file = task['output'] + '.running'
+    if output_format == 'notebook':
+        with open(tmp_file, 'w') as f:
+            nbformat.write(nb, f)
+    else:
+        from nbconvert import get_exporter
+        body, resources = get_exporter(output_format)().from_notebook_node(nb)
+        with open(tmp_file, 'wb') as f:
+            f.write(body if isinstance(body, bytes) else body.encode())
+    os.replace(tmp_file, task['output'])
+
+    if task.get('post'):
+        subprocess.check_call(task['post'], shell=True)
+
+    return time.time() - start, skipped, saved
+
+
+def run_plan(plan, pool, log=None):
+    """Executes notebooks in a plan, running each once the notebooks it depends on have completed.
+
+    Args:
+        plan (dict): Execution plan written by slurm-nb-run.
+        pool (KernelPool): Kernel pool.
+        log (progress.EventLog, optional): Event log to report the progress of each cell to. Defaults to None.
+
+    Returns:
+        (list, int, float): Names of notebooks that failed or were skipped because a dependency failed,
+            total number of cells skipped, and seconds saved by skipping them.
+    """
+    tasks = dict((task['name'], task) for task in plan['tasks'])
+    done, failed = set(), []
+    total_skipped, total_saved = 0, 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        while len(done) + len(failed) < len(tasks):
+            for name, task in tasks.items():
+                if name in done or name in failed or name in running.values():
+                    continue
+                if any(dep in failed for dep in task['dependencies']):
+                    print('Skipping {} because a notebook it depends on failed'.format(task['notebook']), flush=True)
+                    failed.append(name)
+                elif all(dep in done for dep in task['dependencies']):
+                    future = executor.submit(execute_notebook, task, pool, timeout=plan['timeout'],
+                                             allow_errors=plan['allow_errors'], output_format=plan['format'],
+                                             checkpoints=plan.get('checkpoints'), log=log)
+                    running[future] = name
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    secs, skipped, saved = future.result()
+                except Exception as e:
+                    print('Failed: {}\n{}'.format(tasks[name]['notebook'], e), file=sys.stderr, flush=True)
+                    failed.append(name)
+                else:
+                    print('Executed {} in {:.1f} s'.format(tasks[name]['notebook'], secs), flush=True)
+                    done.add(name)
+                    total_skipped += skipped
+                    total_saved += saved
+    return failed, total_skipped, total_saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Executes notebooks using a pool of pre-started kernels.')
+    parser.add_argument('plan', help='Execution plan written by slurm-nb-run')
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=1,
+                        help='Number of kernels (and notebooks executing at the same time).')
+    parser.add_argument('--reuse-kernel', dest='reuse_kernel', action='store_true',
+                        help='Only reset the namespace between notebooks instead of restarting the kernel.')
+    parser.add_argument('--preload', dest='preload', type=str, default='',
+                        help='Code to run in each kernel when it starts (E.g. "import numpy, pandas").')
+    args = parser.parse_args()
+
+    with open(args.plan) as f:
+        plan = json.load(f)
+
+    log = open_event_log()
+    start = time.time()
+    pool = KernelPool(args.reuse_kernel and 1 or args.pool_size, preload=args.preload, reuse=args.reuse_kernel)
+    print('Started {} kernel(s) in {:.1f} s'.format(pool.size, time.time() - start), flush=True)
+    try:
+        failed, skipped, saved = run_plan(plan, pool, log=log)
+    finally:
+        pool.shutdown()
+        if log is not None:
+            log.close()
+    print('Executed {} notebook(s) in {:.1f} s'.format(len(plan['tasks']) - len(failed), time.time() - start), flush=True)
+    if plan.get('checkpoints'):
+        print('Skipped {} unchanged cell(s) saving {:.1f} s'.format(skipped, saved), flush=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+
+
+def cell_fingerprints(nb, salt=''):
+    """Fingerprints each code cell together with all code cells above it.
+
+    A cell's fingerprint changes if its source, the source of any code cell
+    above it, or the salt (E.g. a digest of parameters and environment) changes.
+
+    Args:
+        nb (nbformat.NotebookNode): Notebook.
+        salt (str, optional): Digest of everything else the execution depends on. Defaults to ''.
+
+    Returns:
+        list: Hex digest for each cell (None for cells that are not code cells).
+    """
+    fingerprint = hashlib.sha256(salt.encode()).hexdigest()
+    fingerprints = []
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            fingerprint = hashlib.sha256((fingerprint + '\0' + cell.source).encode()).hexdigest()
+            fingerprints.append(fingerprint)
+        else:
+            fingerprints.append(None)
+    return fingerprints
+
+
+def save_state_code(path):
+    """Code that saves the kernel namespace to a file when run in the kernel.
+
+    Args:
+        path (str): File to save state to.
+
+    Returns:
+        str: Python code.
+    """
+    return ('import dill as __dill, os as __os; '
+            '__dill.dump_module({tmp!r}, module=get_ipython().user_module, refimported=True); '
+            '__os.replace({tmp!r}, {path!r}); del __dill, __os').format(tmp=path + '.tmp', path=path)
+
+
+def load_state_code(path):
+    """Code that restores the kernel namespace from a file when run in the kernel.
+
+    Args:
+        path (str): File to load state from.
+
+    Returns:
+        str: Python code.
+    """
+    return 'import dill as __dill; __dill.load_module({!r}, module=get_ipython().user_module); del __dill'.format(path)
+
+
+class CheckpointStore(object):
+    """Stores outputs of executed cells and kernel state after slow cells,
+    keyed by cell fingerprint.
+
+    Args:
+        checkpoint_dir (str): Directory to keep checkpoints in (E.g. on shared scratch).
+    """
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+
+    def _path(self, fingerprint, name):
+        return os.path.join(self.checkpoint_dir, fingerprint, name)
+
+    def state_path(self, fingerprint):
+        """Path to kernel state saved after the cell with this fingerprint.
+
+        Args:
+            fingerprint (str): Cell fingerprint.
+
+        Returns:
+            str: File path.
+        """
+        os.makedirs(os.path.join(self.checkpoint_dir, fingerprint), exist_ok=True)
+        return self._path(fingerprint, 'state.pkl')
+
+    def has_state(self, fingerprint):
+        """Tests if kernel state is saved after the cell with this fingerprint.
+
+        Args:
+            fingerprint (str): Cell fingerprint.
+
+        Returns:
+            bool: True if state is saved.
+        """
+        return os.path.exists(self._path(fingerprint, 'state.pkl'))
+
+    def has_outputs(self, fingerprint):
+        """Tests if outputs are saved for the cell with this fingerprint.
+
+        Args:
+            fingerprint (str): Cell fingerprint.
+
+        Returns:
+            bool: True if outputs are saved.
+        """
+        return os.path.exists(self._path(fingerprint, 'outputs.json'))
+
+    def save_outputs(self, fingerprint, cell, secs):
+        """Saves the outputs of an executed cell.
+
+        Args:
+            fingerprint (str): Cell fingerprint.
+            cell (nbformat.NotebookNode): Executed cell.
+            secs (float): Seconds it took to execute the cell.
+        """
+        os.makedirs(os.path.join(self.checkpoint_dir, fingerprint), exist_ok=True)
+        path = self._path(fingerprint, 'outputs.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'outputs': cell.outputs, 'execution_count': cell.execution_count, 'secs': secs,
+                       'profile': cell.metadata.get('slurm_jupyter', {}).get('profile')}, f)
+        os.replace(path + '.tmp', path)
+
+    def load_outputs(self, fingerprint):
+        """Loads the outputs of a cell.
+
+        Args:
+            fingerprint (str): Cell fingerprint.
+
+        Returns:
+            dict: Outputs, execution count, seconds it took to execute the cell, and its profile.
+        """
+        with open(self._path(fingerprint, 'outputs.json')) as f:
+            record = json.load(f)
+        # update modification time so eviction is least-recently-used
+        os.utime(os.path.join(self.checkpoint_dir, fingerprint))
+        return record
+
+    def resume_point(self, fingerprints):
+        """Finds the last cell that execution can resume after.
+
+        That is the last cell with saved kernel state where all code cells
+        above it have saved outputs.
+
+        Args:
+            fingerprints (list): Fingerprints from cell_fingerprints.
+
+        Returns:
+            int: Cell index or -1 if the notebook must be executed from the top.
+        """
+        resume = -1
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint is None:
+                continue
+            if not self.has_outputs(fingerprint):
+                break
+            if self.has_state(fingerprint):
+                resume = index
+        return resume
@@ -0,0 +1,222 @@
+"""Memory warnings for jupyter servers. The memory monitor on the node
+(templates.mem_script) writes a sample of the memory used by the job every five
+seconds, a report of each process the kernel kills for running out of
+memory and the notebooks whose kernels use the most memory. The client fits
+a line to recent samples to warn before the reservation runs out, and offers
+to relaunch with more memory after an OOM kill.
+"""
+
+import re
+import math
+import json
+
+# prefixes of the lines with samples, OOM kills and kernel memory written by the memory monitor
+MEM_MARK = '[SlurmJptr mem]'
+OOM_MARK = '[SlurmJptr oom]'
+KERNELS_MARK = '[SlurmJptr kernels]'
+
+# seconds of samples the trend is fitted to
+WINDOW = 900
+
+# warn when the reservation is expected to run out within this many seconds
+HORIZON = 1800
+
+# seconds between repeated warnings (unless the expected time halves)
+REPEAT = 300
+
+
+def parse_sample(line):
+    """Parses a memory sample line.
+
+    Args:
+        line (str): Line from the memory monitor.
+
+    Returns:
+        (float, float, float): Time on the node, megabytes used and megabytes
+            reserved, or None if the line is not a sample.
+    """
+    if not line.startswith(MEM_MARK):
+        return None
+    try:
+        t, used, reserved = (float(x) for x in line[len(MEM_MARK):].split())
+    except ValueError:
+        return None
+    return t, used, reserved
+
+
+def parse_oom(line):
+    """Parses an OOM kill line.
+
+    Args:
+        line (str): Line from the memory monitor.
+
+    Returns:
+        dict: Number of kills, the pid, command and megabytes of the process
+            killed (None if not known), megabytes used by the job at the last
+            sample, the peak use and the reservation. None if the line is not
+            an OOM report.
+    """
+    if not line.startswith(OOM_MARK):
+        return None
+    try:
+        return json.loads(line[len(OOM_MARK):])
+    except ValueError:
+        return None
+
+
+def parse_kernels(line):
+    """Parses a line with the memory use of kernels.
+
+    Args:
+        line (str): Line from the memory monitor.
+
+    Returns:
+        dict: Number of kernels and the largest ones (dicts with notebook path,
+            PSS in megabytes and pid), or None if the line is not a kernel report.
+    """
+    if not line.startswith(KERNELS_MARK):
+        return None
+    try:
+        return json.loads(line[len(KERNELS_MARK):])
+    except ValueError:
+        return None
+
+
+def format_kernels(report):
+    """Formats a kernel report as a single line.
+
+    Args:
+        report (dict): Report from parse_kernels.
+
+    Returns:
+        str: E.g. 'analysis.ipynb 2.1 Gb, plots.ipynb 0.4 Gb (+3 kernels)'.
+    """
+    top = ', '.join('{} {:.1f} Gb'.format(k['path'], k['pss'] / 1024) for k in report['top'])
+    rest = report['kernels'] - len(report['top'])
+    if rest > 0:
+        top += ' (+{} kernel{})'.format(rest, rest > 1 and 's' or '')
+    return top or 'no kernels'
+
+
+class MemoryTrend(object):
+    """Least-squares trend of the memory use of a job.
+
+    Args:
+        window (float, optional): Seconds of samples to fit. Defaults to WINDOW.
+        horizon (float, optional): Seconds ahead to warn about. Defaults to HORIZON.
+        repeat (float, optional): Min seconds between warnings. Defaults to REPEAT.
+        min_samples (int, optional): Samples needed before predicting. Defaults to 12 (one minute).
+    """
+
+    def __init__(self, window=WINDOW, horizon=HORIZON, repeat=REPEAT, min_samples=12):
+        self.window = window
+        self.horizon = horizon
+        self.repeat = repeat
+        self.min_samples = min_samples
+        self.samples = []
+        self.reserved = None
+        self.warned_at = None
+        self.warned_eta = None
+
+    def add(self, t, used, reserved):
+        """Adds a sample.
+
+        Args:
+            t (float): Time on the node.
+            used (float): Megabytes used.
+            reserved (float): Megabytes reserved.
+        """
+        self.samples.append((t, used))
+        self.reserved = reserved
+        while self.samples and self.samples[0][0] < t - self.window:
+            self.samples.pop(0)
+
+    def fit(self):
+        """Fits a line to the samples.
+
+        Returns:
+            (float, float): Megabytes per second and the fitted megabytes used
+                at the last sample, or None if there are too few samples.
+        """
+        n = len(self.samples)
+        if n < self.min_samples:
+            return None
+        t0 = self.samples[0][0]
+        xs = [t - t0 for t, used in self.samples]
+        ys = [used for t, used in self.samples]
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        sxx = sum((x - mean_x)**2 for x in xs)
+        if not sxx:
+            return None
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+        return slope, mean_y + slope * (xs[-1] - mean_x)
+
+    def time_to_limit(self):
+        """Seconds until the memory used is expected to reach the reservation.
+
+        Returns:
+            float: Seconds or None if memory use is not growing.
+        """
+        fit = self.fit()
+        if fit is None or fit[0] <= 0 or not self.reserved:
+            return None
+        slope, used = fit
+        return max(0, (self.reserved - used) / slope)
+
+    def warning(self):
+        """Whether to warn now.
+
+        Returns:
+            float: Seconds until the reservation runs out, or None if there is
+                nothing (new) to warn about.
+        """
+        eta = self.time_to_limit()
+        if eta is None or eta > self.horizon:
+            self.warned_at = self.warned_eta = None
+            return None
+        now = self.samples[-1][0]
+        if self.warned_at is not None and now - self.warned_at < self.repeat and eta > self.warned_eta / 2:
+            return None
+        self.warned_at, self.warned_eta = now, eta
+        return eta
+
+    def growth(self):
+        """Megabytes per hour the memory use grows by (0 if not known)."""
+        fit = self.fit()
+        return fit and fit[0] * 3600 or 0
+
+
+def suggested_memory(reserved, peak):
+    """Memory to ask for after an OOM kill: half again the reservation, and at
+    least a quarter more than the peak use, in whole gigabytes.
+
+    Args:
+        reserved (float): Megabytes reserved.
+        peak (float): Peak megabytes used.
+
+    Returns:
+        str: Memory size (E.g. '12G').
+    """
+    return '{}G'.format(int(math.ceil(max(reserved * 1.5, (peak or 0) * 1.25) / 1024)))
+
+
+def relaunch_argv(argv, total_memory):
+    """Command line arguments with the memory options replaced by --total-memory.
+
+    Args:
+        argv (list): Command line arguments (without the program).
+        total_memory (str): Memory size.
+
+    Returns:
+        list: Arguments.
+    """
+    options = ['-m', '--total-memory', '--memory-per-cpu']
+    args, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif not any(arg.startswith(o + '=') for o in options) and not re.match(r'-m\S', arg):
+            args.append(arg)
+    return args + ['--total-memory', total_memory]
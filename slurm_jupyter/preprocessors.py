@@ -0,0 +1,35 @@
+"""nbconvert preprocessors used by the jobs slurm-nb-run submits. Runs on the
+compute node like this:
+
+    jupyter nbconvert --Exporter.preprocessors=slurm_jupyter.preprocessors.ProgressExecutePreprocessor notebook.ipynb
+"""
+
+import os
+
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from .progress import open_event_log, NotebookProgress
+
+
+class ProgressExecutePreprocessor(ExecutePreprocessor):
+    """Executes a notebook like ExecutePreprocessor, records the profile of
+    each cell in its metadata, and reports the progress of each cell to the
+    job's event file.
+    """
+
+    def preprocess(self, nb, resources=None, km=None):
+        log = open_event_log()
+        metadata = (resources or {}).get('metadata', {})
+        notebook = os.path.join(metadata.get('path', ''), metadata.get('name', '') + '.ipynb')
+        progress = NotebookProgress(os.path.abspath(notebook), log=log)
+        progress.attach(self)
+        progress.start(nb)
+        ok = False
+        try:
+            nb, resources = super().preprocess(nb, resources, km=km)
+            ok = True
+        finally:
+            progress.end(ok)
+            if log is not None:
+                log.close()
+        return nb, resources
@@ -0,0 +1,217 @@
+"""Per-cell execution profiles. Executing jobs record the wall time, CPU time
+and peak memory increase of each code cell in the cell's metadata:
+
+    "metadata": {
+        "slurm_jupyter": {
+            "profile": {"wall": 12.3, "cpu": 48.1, "peak_rss_delta": 512.0}
+        }
+    }
+
+Times are in seconds and memory in Mb. CPU time and memory are those of the
+kernel process. slurm-nb-run profile reads these back from executed notebooks
+and ranks the cells.
+"""
+
+import os
+import csv
+import json
+import glob
+import time
+import hashlib
+
+# fields of /proc/<pid>/stat after the command name (utime, stime, cutime, cstime)
+_CPU_FIELDS = slice(11, 15)
+
+
+def kernel_cpu_time(pid):
+    """CPU time used by a process and the children it has waited for.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        float: Seconds or None if it cannot be read (E.g. not on Linux).
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name may contain spaces so split after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        return sum(int(x) for x in fields[_CPU_FIELDS]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def kernel_memory(pid):
+    """Current and peak resident memory of a process.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        (float, float): Current and peak memory in Mb or (None, None) if it cannot be read.
+    """
+    rss, peak = None, None
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return rss, peak
+
+
+def reset_peak_memory(pid):
+    """Resets the peak memory of a process to its current memory so the peak
+    of the next cell can be measured.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        bool: True if the peak was reset.
+    """
+    try:
+        with open('/proc/{}/clear_refs'.format(pid), 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class CellProfiler(object):
+    """Measures wall time, CPU time and peak memory increase of cells
+    executed by a kernel.
+    """
+
+    def __init__(self):
+        self.start = {}
+
+    def cell_started(self, index, pid=None):
+        """Records counters before a cell executes.
+
+        Args:
+            index (int): Cell index.
+            pid (int, optional): Kernel process id. Defaults to None.
+        """
+        rss, peak = None, None
+        if pid:
+            rss, peak = kernel_memory(pid)
+            if reset_peak_memory(pid):
+                peak = rss
+        self.start[index] = (time.time(), pid and kernel_cpu_time(pid), rss, peak)
+
+    def cell_finished(self, index, pid=None):
+        """Computes the profile of a cell once it has executed.
+
+        Args:
+            index (int): Cell index.
+            pid (int, optional): Kernel process id. Defaults to None.
+
+        Returns:
+            dict: Wall time, CPU time and peak memory increase (None where not measured).
+        """
+        start, cpu, rss, peak = self.start.pop(index, (time.time(), None, None, None))
+        profile = {'wall': round(time.time() - start, 3), 'cpu': None, 'peak_rss_delta': None}
+        if pid and cpu is not None:
+            end_cpu = kernel_cpu_time(pid)
+            if end_cpu is not None:
+                profile['cpu'] = round(end_cpu - cpu, 3)
+        if pid and peak is not None:
+            _, end_peak = kernel_memory(pid)
+            if end_peak is not None:
+                # if the peak could not be reset this is the increase in the kernel's all-time peak
+                profile['peak_rss_delta'] = round(max(0, end_peak - peak), 1)
+        return profile
+
+
+def notebook_files(paths):
+    """Finds notebooks in a list of notebooks and directories.
+
+    Args:
+        paths (list): Notebook files and directories to search recursively.
+
+    Returns:
+        list: Notebook paths.
+    """
+    notebooks = []
+    for path in paths:
+        if os.path.isdir(path):
+            notebooks.extend(sorted(glob.glob(os.path.join(path, '**', '*.ipynb'), recursive=True)))
+        else:
+            notebooks.append(path)
+    return [p for p in notebooks if '.ipynb_checkpoints' not in p]
+
+
+def cell_profiles(notebook_paths):
+    """Reads the profile of each executed cell in a set of notebooks.
+
+    Args:
+        notebook_paths (list): Notebook paths.
+
+    Returns:
+        list: A dict for each profiled cell with notebook, cell index, digest and
+            first line of its code, wall time, CPU time and peak memory increase.
+    """
+    rows = []
+    for notebook_path in notebook_paths:
+        try:
+            with open(notebook_path) as f:
+                nb = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for index, cell in enumerate(nb.get('cells', [])):
+            profile = cell.get('metadata', {}).get('slurm_jupyter', {}).get('profile')
+            if cell.get('cell_type') != 'code' or not profile:
+                continue
+            source = cell.get('source', '')
+            if isinstance(source, list):
+                source = ''.join(source)
+            lines = [l for l in source.splitlines() if l.strip()]
+            rows.append({'notebook': notebook_path, 'cell': index,
+                         'digest': hashlib.sha256(source.encode()).hexdigest()[:12],
+                         'code': lines and lines[0].strip() or '',
+                         'wall': profile.get('wall'), 'cpu': profile.get('cpu'),
+                         'peak_rss_delta': profile.get('peak_rss_delta')})
+    return rows
+
+
+def group_profiles(rows):
+    """Aggregates profiles of cells with the same code, E.g. the same cell in
+    each variant of a notebook in a parameter sweep.
+
+    Args:
+        rows (list): Cell profiles from cell_profiles.
+
+    Returns:
+        list: A dict for each distinct cell with the number of executions, total
+            and max wall time, total CPU time, and max peak memory increase.
+    """
+    groups = {}
+    for row in rows:
+        g = groups.setdefault(row['digest'], dict(row, count=0, wall=0, max_wall=0, cpu=0, peak_rss_delta=0))
+        g['count'] += 1
+        g['wall'] += row['wall'] or 0
+        g['max_wall'] = max(g['max_wall'], row['wall'] or 0)
+        g['cpu'] += row['cpu'] or 0
+        g['peak_rss_delta'] = max(g['peak_rss_delta'], row['peak_rss_delta'] or 0)
+    return list(groups.values())
+
+
+def write_profiles(rows, path):
+    """Writes cell profiles to a CSV file (if the path ends with .csv) or a JSON file.
+
+    Args:
+        rows (list): Cell profiles.
+        path (str): Output file.
+    """
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ['notebook'])
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'created': time.time(), 'cells': rows}, f, separators=(',', ':'))
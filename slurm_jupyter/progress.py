@@ -0,0 +1,319 @@
+"""Per-cell progress events written by executing jobs and read by
+slurm-nb-run --watch. Each job appends compact JSON lines to its own file:
+
+    {"t": 1700000000.0, "e": "run", "nb": "/path/nb.ipynb", "i": 3}
+
+Event types are "start" (notebook started, "n" code cells, "k" cells skipped
+by incremental execution), "run" (cell "i" started), "done" (cell finished
+after "s" seconds with kernel memory "m" in Mb), "hb" (heartbeat while a slow
+cell runs), "error" (cell raised "x"), and "end" (notebook finished, "ok").
+"""
+
+import os
+import json
+import time
+from threading import Thread, Lock, Event
+
+from .profiling import CellProfiler
+
+# job scripts set this to the directory event files are written to
+EVENT_DIR_VARIABLE = 'SLURM_JUPYTER_EVENTS'
+
+# seconds between heartbeat events while a cell runs
+HEARTBEAT_INTERVAL = 60
+
+
+def job_event_id():
+    """Id of the running slurm job (E.g. 1234 or 1234_5 for array tasks).
+
+    Returns:
+        str: Job id or the process id if not running as a slurm job.
+    """
+    if os.environ.get('SLURM_ARRAY_TASK_ID'):
+        return '{}_{}'.format(os.environ['SLURM_ARRAY_JOB_ID'], os.environ['SLURM_ARRAY_TASK_ID'])
+    return os.environ.get('SLURM_JOB_ID', str(os.getpid()))
+
+
+def event_file(event_dir, event_id):
+    """Path of the event file of a job.
+
+    Args:
+        event_dir (str): Event directory.
+        event_id (str): Job id (E.g. 1234 or 1234_5 for array tasks).
+
+    Returns:
+        str: File path.
+    """
+    return os.path.join(event_dir, '{}.jsonl'.format(event_id))
+
+
+def process_rss(pid):
+    """Resident memory of a process and all its descendants.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        float: Memory in Mb or None if it cannot be read (E.g. not on Linux).
+    """
+    total, pids = 0, [pid]
+    try:
+        while pids:
+            pid = pids.pop()
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            for task in os.listdir('/proc/{}/task'.format(pid)):
+                with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+                    pids.extend(int(p) for p in f.read().split())
+    except (OSError, ValueError):
+        if not total:
+            return None
+    return round(total / 1024**2, 1)
+
+
+def kernel_pid(km):
+    """Process id of the kernel run by a kernel manager.
+
+    Args:
+        km (jupyter_client.KernelManager): Kernel manager.
+
+    Returns:
+        int: Process id or None if not known.
+    """
+    process = getattr(getattr(km, 'provisioner', None), 'process', None)
+    if process is None:
+        process = getattr(km, 'kernel', None)
+    return getattr(process, 'pid', None)
+
+
+class EventLog(object):
+    """Appends progress events to a job's event file.
+
+    Events are flushed as they are written so they can be followed while the
+    job runs. A background thread writes a heartbeat event with elapsed time
+    and memory for each cell that runs longer than the heartbeat interval.
+
+    Args:
+        path (str): Event file.
+        heartbeat (int, optional): Seconds between heartbeat events. Defaults to HEARTBEAT_INTERVAL.
+    """
+
+    def __init__(self, path, heartbeat=HEARTBEAT_INTERVAL):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a')
+        self.lock = Lock()
+        self.running = {}
+        self.closed = Event()
+        self.heartbeat = Thread(target=self._heartbeat, args=(heartbeat,))
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def write(self, kind, **fields):
+        """Writes an event.
+
+        Args:
+            kind (str): Event type.
+            **fields: Event fields.
+        """
+        event = {'t': round(time.time(), 1), 'e': kind}
+        event.update(fields)
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line)
+                self.file.flush()
+
+    def _heartbeat(self, interval):
+        while not self.closed.wait(interval):
+            now = time.time()
+            with self.lock:
+                running = list(self.running.items())
+            for (notebook, index), (start, pid) in running:
+                self.write('hb', nb=notebook, i=index, s=round(now - start, 1), m=pid and process_rss(pid))
+
+    def cell_started(self, notebook, index, pid=None):
+        """Records that a cell started executing.
+
+        Args:
+            notebook (str): Notebook path.
+            index (int): Cell index.
+            pid (int, optional): Kernel process id. Defaults to None.
+        """
+        with self.lock:
+            self.running[(notebook, index)] = (time.time(), pid)
+        self.write('run', nb=notebook, i=index)
+
+    def cell_finished(self, notebook, index, pid=None, error=None):
+        """Records that a cell finished executing.
+
+        Args:
+            notebook (str): Notebook path.
+            index (int): Cell index.
+            pid (int, optional): Kernel process id. Defaults to None.
+            error (str, optional): Error raised by the cell. Defaults to None.
+        """
+        with self.lock:
+            start, _ = self.running.pop((notebook, index), (time.time(), None))
+        if error:
+            self.write('error', nb=notebook, i=index, x=error)
+        self.write('done', nb=notebook, i=index, s=round(time.time() - start, 2), m=pid and process_rss(pid))
+
+    def close(self):
+        """Stops heartbeats and closes the event file.
+        """
+        self.closed.set()
+        with self.lock:
+            self.file.close()
+
+
+def open_event_log():
+    """Opens the event log of the running job if the job script asks for one.
+
+    Returns:
+        EventLog: Event log or None.
+    """
+    event_dir = os.environ.get(EVENT_DIR_VARIABLE)
+    if not event_dir:
+        return None
+    return EventLog(event_file(event_dir, job_event_id()))
+
+
+class NotebookProgress(object):
+    """Follows the execution of a notebook by an nbclient NotebookClient (or
+    nbconvert ExecutePreprocessor). Records the profile of each cell in its
+    metadata and reports progress to an event log.
+
+    Args:
+        notebook (str): Notebook path.
+        log (EventLog, optional): Event log. Defaults to None.
+    """
+
+    def __init__(self, notebook, log=None):
+        self.log = log
+        self.notebook = notebook
+        self.client = None
+        self.profiler = CellProfiler()
+        self.start_time = time.time()
+
+    def _pid(self):
+        return self.client is not None and kernel_pid(self.client.km) or None
+
+    def _cell_execute(self, cell, cell_index, **kwargs):
+        pid = self._pid()
+        if self.log is not None:
+            self.log.cell_started(self.notebook, cell_index, pid=pid)
+        self.profiler.cell_started(cell_index, pid=pid)
+
+    def _cell_executed(self, cell, cell_index, execute_reply=None, **kwargs):
+        pid = self._pid()
+        cell.metadata.setdefault('slurm_jupyter', {})['profile'] = self.profiler.cell_finished(cell_index, pid=pid)
+        if self.log is None:
+            return
+        error = None
+        content = execute_reply and execute_reply.get('content', {}) or {}
+        if content.get('status') == 'error':
+            error = '{}: {}'.format(content.get('ename'), content.get('evalue'))
+        self.log.cell_finished(self.notebook, cell_index, pid=pid, error=error)
+
+    def attach(self, client):
+        """Makes the client report cell executions.
+
+        Args:
+            client (nbclient.NotebookClient): Notebook client.
+        """
+        self.client = client
+        client.on_cell_execute = self._cell_execute
+        client.on_cell_executed = self._cell_executed
+
+    def start(self, nb, skipped=0):
+        """Records that the notebook started executing.
+
+        Args:
+            nb (nbformat.NotebookNode): Notebook.
+            skipped (int, optional): Number of code cells that are not executed. Defaults to 0.
+        """
+        self.start_time = time.time()
+        if self.log is not None:
+            self.log.write('start', nb=self.notebook, n=sum(c.cell_type == 'code' for c in nb.cells), k=skipped)
+
+    def end(self, ok):
+        """Records that the notebook finished executing.
+
+        Args:
+            ok (bool): True if all cells executed without errors.
+        """
+        if self.log is not None:
+            self.log.write('end', nb=self.notebook, ok=ok, s=round(time.time() - self.start_time, 1))
+
+
+def read_events(path, offset=0):
+    """Reads events appended to an event file since the last read.
+
+    Args:
+        path (str): Event file.
+        offset (int, optional): File position after the last read. Defaults to 0.
+
+    Returns:
+        (list, int): New events and the file position to read from next time.
+    """
+    if not os.path.exists(path):
+        return [], offset
+    with open(path) as f:
+        f.seek(offset)
+        data = f.read()
+    # ignore a partially written last line until it is complete
+    end = data.rfind('\n') + 1
+    events = []
+    for line in data[:end].splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            pass
+    return events, offset + len(data[:end].encode())
+
+
+class ProgressTracker(object):
+    """Follows the event files of a set of jobs and keeps the latest progress of
+    each notebook.
+    """
+
+    def __init__(self):
+        self.offsets = {}
+        self.notebooks = {}
+
+    def update(self, path):
+        """Reads new events from an event file.
+
+        Args:
+            path (str): Event file.
+
+        Returns:
+            list: Progress of each notebook in the file (see progress()).
+        """
+        events, self.offsets[path] = read_events(path, self.offsets.get(path, 0))
+        for event in events:
+            key = (path, event.get('nb'))
+            p = self.notebooks.setdefault(key, {
+                'notebook': event.get('nb'), 'cells': 0, 'skipped': 0, 'done': 0, 'cell': None,
+                'cell_start': None, 'memory': None, 'max_memory': None, 'errors': [],
+                'ok': None, 'secs': None, 'last': event['t'], 'slowest': (0, None)})
+            p['last'] = event['t']
+            kind = event['e']
+            if event.get('m') is not None:
+                p['memory'] = event['m']
+                p['max_memory'] = max(p['max_memory'] or 0, event['m'])
+            if kind == 'start':
+                p['cells'], p['skipped'], p['done'] = event['n'], event.get('k', 0), 0
+            elif kind == 'run':
+                p['cell'], p['cell_start'] = event['i'], event['t']
+            elif kind == 'done':
+                p['done'] += 1
+                p['cell'], p['cell_start'] = None, None
+                if p['slowest'][1] is None or event['s'] > p['slowest'][0]:
+                    p['slowest'] = (event['s'], event['i'])
+            elif kind == 'error':
+                p['errors'].append((event['i'], event['x']))
+            elif kind == 'end':
+                p['ok'], p['secs'] = event['ok'], event['s']
+                p['cell'], p['cell_start'] = None, None
+        return [p for (p_path, _), p in self.notebooks.items() if p_path == path]
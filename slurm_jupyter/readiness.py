@@ -0,0 +1,176 @@
+"""Decides when the jupyter server is ready by probing its /api/status
+endpoint through the forwarded port. The token is read from the runtime
+info file (jpserver-<pid>.json) the server writes to its runtime directory
+on the shared file system.
+"""
+
+import re
+import json
+import time
+
+from .utils import execute, ExecuteException
+
+# runtime directory on the cluster (evaluated by the remote shell)
+RUNTIME_DIR = '${JUPYTER_RUNTIME_DIR:-${XDG_DATA_HOME:-$HOME/.local/share}/jupyter/runtime}'
+
+NON_SPACE = re.compile(r'\S')
+
+
+def parse_server_info(text):
+    """Parses the concatenated contents of runtime info files.
+
+    Args:
+        text (str): Contents of one or more jpserver-<pid>.json files.
+
+    Returns:
+        list: Server info dicts in the order they appear.
+    """
+    decoder = json.JSONDecoder()
+    infos, pos = [], 0
+    while True:
+        m = NON_SPACE.search(text, pos)
+        if not m:
+            break
+        try:
+            info, pos = decoder.raw_decode(text, m.start())
+        except ValueError:
+            break
+        if isinstance(info, dict):
+            infos.append(info)
+    return infos
+
+
+def server_info(spec, verbose=False):
+    """Reads the runtime info of jupyter servers listening on the job's port.
+
+    Args:
+        spec (dict): Parameter specification.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        list: Server info dicts, most recent first.
+    """
+    cmd = """ssh -q {user}@{frontend} 'for f in $(ls -t "{runtime_dir}"/jpserver-*.json 2>/dev/null); do cat "$f"; echo; done'""".format(
+        runtime_dir=RUNTIME_DIR, **spec)
+    if verbose: print(cmd)
+    try:
+        stdout, stderr = execute(cmd)
+    except ExecuteException:
+        return []
+    return [info for info in parse_server_info(stdout.decode()) if str(info.get('port')) == str(spec['hostport'])]
+
+
+def probe_opener():
+    """URL opener for probing the server. Does not use proxies or verify the
+    server certificate, which is self-signed.
+
+    Returns:
+        urllib.request.OpenerDirector: Opener.
+    """
+    # ssl and urllib are imported when the server is probed, not at startup
+    import ssl
+    from urllib.request import build_opener, ProxyHandler, HTTPSHandler
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return build_opener(ProxyHandler({}), HTTPSHandler(context=context))
+
+
+def probe_status(port, token='', scheme='https', timeout=2, opener=None):
+    """Requests /api/status from the server through the forwarded port.
+
+    Args:
+        port (int): Local port forwarded to the server.
+        token (str, optional): Server token. Defaults to ''.
+        scheme (str, optional): 'https' or 'http'. Defaults to 'https'.
+        timeout (float, optional): Seconds to wait for a reply. Defaults to 2.
+        opener (urllib.request.OpenerDirector, optional): Opener from probe_opener(). Defaults to a new one.
+
+    Returns:
+        int: HTTP status or None if the server did not reply.
+    """
+    from urllib.request import Request
+    from urllib.error import HTTPError
+
+    if opener is None:
+        opener = probe_opener()
+    request = Request('{}://127.0.0.1:{}/api/status'.format(scheme, port))
+    if token:
+        request.add_header('Authorization', 'token ' + token)
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+    except Exception:
+        # not forwarded yet, not listening yet, or the wrong scheme
+        return None
+
+
+def server_url(spec, info, scheme):
+    """URL of the server on the forwarded port.
+
+    Args:
+        spec (dict): Parameter specification.
+        info (dict): Server info.
+        scheme (str): 'https' or 'http'.
+
+    Returns:
+        str: URL.
+    """
+    url = '{}://127.0.0.1:{}{}{}'.format(scheme, spec['port'], info.get('base_url', '/'),
+                                        spec['run'] == 'notebook' and 'tree' or 'lab')
+    if info.get('token'):
+        url += '?token=' + info['token']
+    return url
+
+
+def wait_for_server(spec, run_event, interval=0.5, info_interval=2, verbose=False):
+    """Probes the server until it answers with the token from its runtime info.
+
+    The server is probed without a token until it replies at all, which means
+    it has written its runtime info. The token is then read with a single ssh
+    call. A server without a token (password login) is ready when it replies.
+
+    Args:
+        spec (dict): Parameter specification.
+        run_event (threading.Event): Probing stops when this is cleared.
+        interval (float, optional): Seconds between probes. Defaults to 0.5.
+        info_interval (float, optional): Min seconds between reading runtime info. Defaults to 2.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        (str, dict): URL to open and counts of probes and ssh calls, or None if stopped.
+    """
+    opener = probe_opener()
+    schemes = ['https', 'http']
+    counts = {'probes': 0, 'ssh_calls': 0}
+    infos, info, last_read = [], None, 0
+    while run_event.is_set():
+        token = info and info.get('token') or ''
+        status = probe_status(spec['port'], token=token, scheme=schemes[0], opener=opener)
+        counts['probes'] += 1
+        if verbose: print('probe {}://127.0.0.1:{}/api/status:'.format(schemes[0], spec['port']), status)
+        if status is None:
+            if info is None:
+                # try the other scheme until the server replies
+                schemes.reverse()
+            time.sleep(interval)
+            continue
+
+        if info is not None and (status == 200 or (status in (401, 403) and not token)):
+            return server_url(spec, info, schemes[0]), counts
+
+        if info is not None and status in (401, 403):
+            # stale runtime info from an earlier server on the same port
+            info = infos and infos.pop(0) or None
+        if info is None and time.time() - last_read >= info_interval:
+            infos, last_read = server_info(spec, verbose=verbose), time.time()
+            counts['ssh_calls'] += 1
+            info = infos and infos.pop(0) or None
+            if info is not None:
+                schemes.sort(key=lambda s: s != (info.get('secure') and 'https' or 'http'))
+                continue
+        time.sleep(interval)
+    return None
@@ -0,0 +1,133 @@
+import os
+import re
+import json
+
+from .utils import modpath
+
+# stands in for the source of the parameter cell in notebook templates
+PLACEHOLDER = '__slurm_jupyter_spike_source__'
+
+# use a process pool when writing at least this many variants
+MIN_PARALLEL_VARIANTS = 16
+
+
+class SpikeException(Exception):
+    pass
+
+
+def notebook_template(notebook_path, replace_run_magic=False):
+    """Parses a notebook once and makes a template for its spiked variants.
+
+    Outputs are cleared and the parameter cell is either inserted at the top
+    or is the first code cell with a %run magic. The serialized notebook holds a
+    placeholder where the parameter cell source goes.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        replace_run_magic (bool, optional): Replace the first %run magic instead of adding a cell. Defaults to False.
+
+    Returns:
+        (str, str): Serialized notebook and the original source of the parameter cell (None if inserted).
+    """
+    with open(notebook_path) as f:
+        nb = json.load(f)
+    if nb.get('nbformat') != 4:
+        raise SpikeException('Notebook format is not 4: {}'.format(notebook_path))
+
+    for cell in nb['cells']:
+        if cell['cell_type'] == 'code':
+            cell['outputs'] = []
+            cell['execution_count'] = None
+
+    original_source = None
+    if replace_run_magic:
+        for cell in nb['cells']:
+            source = cell['source']
+            if isinstance(source, list):
+                source = ''.join(source)
+            if cell['cell_type'] == 'code' and '%run' in source:
+                original_source = source
+                cell['source'] = PLACEHOLDER
+                break
+
+    if original_source is None:
+        new_cell = {'cell_type': 'code', 'execution_count': None, 'metadata': {}, 'outputs': [], 'source': PLACEHOLDER}
+        if nb.get('nbformat_minor', 0) >= 5:
+            new_cell['id'] = 'slurm-jupyter-spike'
+        nb['cells'].insert(0, new_cell)
+
+    # same layout as nbformat.write
+    template = json.dumps(nb, sort_keys=True, indent=1, ensure_ascii=False) + '\n'
+    return template, original_source
+
+
+def variant_path(notebook_path, spike_file):
+    """Path of the variant of a notebook spiked with a parameter file.
+
+    Args:
+        notebook_path (str): Path to notebook.
+        spike_file (str): Path to parameter file.
+
+    Returns:
+        str: Path to notebook variant.
+    """
+    notebook_base_name = modpath(notebook_path, parent='', suffix='')
+    out_dir = modpath(notebook_path, suffix='')
+    suffix = modpath(spike_file, suffix='', parent='')
+    return modpath(notebook_path, base=notebook_base_name + '_' + suffix, parent=out_dir)
+
+
+_templates = {}
+
+def _init_worker(templates):
+    global _templates
+    _templates = templates
+
+
+def _write_variant(task):
+    notebook_path, source, path = task
+    with open(path, 'w') as f:
+        f.write(_templates[notebook_path].replace(json.dumps(PLACEHOLDER), json.dumps(source, ensure_ascii=False), 1))
+    return path
+
+
+def make_variants(notebook_paths, spike_files, replace_run_magic=False, processes=None):
+    """Writes a variant of each notebook for each parameter file.
+
+    Each variant runs one parameter file using a %run magic. Each notebook
+    is only parsed once, and the variants are written in parallel.
+
+    Args:
+        notebook_paths (list): Notebook paths.
+        spike_files (list): Parameter file paths.
+        replace_run_magic (bool, optional): Replace the first %run magic instead of adding a cell. Defaults to False.
+        processes (int, optional): Number of processes writing variants. Defaults to the number of CPUs.
+
+    Returns:
+        dict: Spike file mapped to a dict mapping each notebook path to the path of its variant.
+    """
+    templates, tasks = {}, []
+    variants = dict((spike_file, {}) for spike_file in spike_files)
+    for notebook_path in notebook_paths:
+        templates[notebook_path], original_source = notebook_template(notebook_path, replace_run_magic)
+        os.makedirs(modpath(notebook_path, suffix=''), exist_ok=True)
+        for spike_file in spike_files:
+            new_cell_source = '%run {}'.format(os.path.abspath(spike_file))
+            if original_source is not None:
+                # replace argument to first %run magic
+                new_cell_source = re.sub(r'%run\s+\S+', lambda m: new_cell_source, original_source, 1)
+            path = variant_path(notebook_path, spike_file)
+            variants[spike_file][notebook_path] = path
+            tasks.append((notebook_path, new_cell_source, path))
+
+    if len(tasks) < MIN_PARALLEL_VARIANTS or processes == 1:
+        _init_worker(templates)
+        for task in tasks:
+            _write_variant(task)
+    else:
+        # imported here, as multiprocessing is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(templates,)) as pool:
+            list(pool.map(_write_variant, tasks, chunksize=max(1, len(tasks) // (4 * (processes or os.cpu_count() or 1)))))
+
+    return variants
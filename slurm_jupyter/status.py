@@ -0,0 +1,200 @@
+"""Status of a user's jupyter servers and slurm-nb-run jobs. Everything is
+fetched with one ssh call running one squeue and one sstat, and cached for a
+few seconds so repeated calls (E.g. a watch mode) do not load slurmctld.
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import subprocess
+
+from .utils import execute
+
+# seconds a fetched status is reused
+CACHE_MAX_AGE = 5
+
+# job id, name, state, node, time left, time limit, requested memory, cpus and command (job script)
+SQUEUE_FORMAT = '%i|%j|%T|%N|%L|%l|%m|%C|%o'
+
+# one squeue for all jobs of the user and one sstat for the memory used by the running ones
+STATUS_SCRIPT = """jobs=$(squeue -h -u {user} -o '{squeue_format}')
+echo "$jobs"
+echo '--'
+ids=$(echo "$jobs" | awk -F'|' '$3 == "RUNNING" {{print $1}}' | paste -sd, -)
+if [ -n "$ids" ]; then sstat -n -P -a -j "$ids" --format=JobID,MaxRSS 2>/dev/null; fi
+"""
+
+SIZE = re.compile(r'([\d.]+)([KMGT]?)', re.IGNORECASE)
+
+
+def memory_mb(s, default_unit='M'):
+    """Translates slurm memory sizes (E.g. 8G, 8000M or 1234K) to megabytes.
+
+    Args:
+        s (str): Memory size.
+        default_unit (str, optional): Unit of sizes without one. Defaults to 'M'.
+
+    Returns:
+        float: Megabytes or None if s is not a size.
+    """
+    m = SIZE.match(s.strip())
+    if not m:
+        return None
+    scale = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024**2}
+    return float(m.group(1)) * scale[(m.group(2) or default_unit).upper()]
+
+
+def job_kind(name, command):
+    """Whether a job is a jupyter server or a job submitted by slurm-nb-run.
+
+    Returns:
+        str: 'server', 'nb-run' or None for other jobs.
+    """
+    if name.startswith('sjup_'):
+        return 'server'
+    if 'slurm_jupyter_run' in os.path.basename(command):
+        return 'nb-run'
+    return None
+
+
+def parse_status(text):
+    """Parses the output of STATUS_SCRIPT.
+
+    Args:
+        text (str): Output.
+
+    Returns:
+        list: Job dicts of servers and slurm-nb-run jobs.
+    """
+    queue, _, usage = text.partition('\n--\n')
+    used = {}
+    for line in usage.splitlines():
+        if '|' not in line:
+            continue
+        step, rss = line.split('|')[:2]
+        job_id = step.split('.')[0]
+        mb = memory_mb(rss, default_unit='K')
+        if mb is not None:
+            used[job_id] = max(used.get(job_id, 0), mb)
+
+    jobs = []
+    for line in queue.splitlines():
+        fields = line.split('|', 8)
+        if len(fields) != 9:
+            continue
+        job_id, name, state, node, time_left, time_limit, memory, cpus, command = fields
+        kind = job_kind(name, command)
+        if kind is None:
+            continue
+        job = {'job_id': job_id, 'kind': kind, 'name': name, 'state': state, 'node': node or None,
+               'time_left': time_left, 'time_limit': time_limit, 'cpus': cpus,
+               'memory_requested': memory_mb(memory), 'memory_used': used.get(job_id)}
+        m = re.match(r'sjup_([^_]+)_([^_]+)_([^_]+)_\d+', name)
+        if m:
+            job['environment'] = m.group(3)
+        jobs.append(job)
+    return jobs
+
+
+def cache_file():
+    return os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'status_cache.json')
+
+
+def fetch_status(user, frontend, max_age=CACHE_MAX_AGE, verbose=False):
+    """Gets the servers and slurm-nb-run jobs of a user, reusing a status
+    fetched less than max_age seconds ago.
+
+    Args:
+        user (str): User name on the cluster.
+        frontend (str): Cluster frontend.
+        max_age (float, optional): Max age in seconds of a cached status. Defaults to CACHE_MAX_AGE.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        (list, float): Job dicts and the time they were fetched.
+    """
+    key = '{}@{}'.format(user, frontend)
+    try:
+        with open(cache_file()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key in cache and time.time() - cache[key]['fetched'] < max_age:
+        return cache[key]['jobs'], cache[key]['fetched']
+
+    script = STATUS_SCRIPT.format(user=user, squeue_format=SQUEUE_FORMAT)
+    cmd = 'ssh -q {}@{} sh -s'.format(user, frontend)
+    if verbose: print(cmd, script, sep='\n')
+    fetched = time.time()
+    stdout, stderr = execute(cmd, stdin=script.encode())
+    jobs = parse_status(stdout.decode())
+
+    cache = dict((k, v) for k, v in cache.items() if time.time() - v['fetched'] < 3600)
+    cache[key] = {'fetched': fetched, 'jobs': jobs}
+    os.makedirs(os.path.dirname(cache_file()), exist_ok=True)
+    tmp = cache_file() + '.{}'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, cache_file())
+    return jobs, fetched
+
+
+def local_tunnels(frontend):
+    """Port forwardings to the frontend made by ssh processes on this machine.
+
+    Args:
+        frontend (str): Cluster frontend.
+
+    Returns:
+        list: (local port, node, remote port) tuples.
+    """
+    try:
+        ps = subprocess.run(['ps', '-eo', 'args'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return []
+    tunnels = []
+    for line in ps.stdout.decode(errors='replace').splitlines():
+        args = line.split()
+        # ssh may be run through an interpreter (E.g. a wrapper script)
+        if not any(os.path.basename(a) == 'ssh' for a in args[:3]):
+            continue
+        if not any(a.endswith('@' + frontend) or a == frontend for a in args):
+            continue
+        for m in re.finditer(r'-L\s*(?:[\w.]+:)?(\d+):([^:\s]+):(\d+)', line):
+            tunnels.append((int(m.group(1)), m.group(2), int(m.group(3))))
+    return tunnels
+
+
+def port_open(port, timeout=0.2):
+    """Whether a local port accepts connections."""
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def add_tunnel_state(jobs, frontend):
+    """Adds the state of the local port forwarding to each server.
+
+    The tunnel is 'up' if an ssh process forwards a local port to the node
+    of the server and the port accepts connections, 'down' if the port does
+    not accept connections and None if there is no forwarding.
+
+    Args:
+        jobs (list): Job dicts from fetch_status.
+        frontend (str): Cluster frontend.
+    """
+    tunnels = local_tunnels(frontend)
+    for job in jobs:
+        job['tunnel'], job['local_port'] = None, None
+        if job['kind'] != 'server' or job['state'] != 'RUNNING':
+            continue
+        for port, node, hostport in tunnels:
+            if node == job['node']:
+                job['local_port'] = port
+                job['tunnel'] = port_open(port) and 'up' or 'down'
+                if job['tunnel'] == 'up':
+                    break
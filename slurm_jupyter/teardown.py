@@ -0,0 +1,146 @@
+"""Teardown of a jupyter session: cancels the slurm job and stops the ssh
+processes and threads serving the session, exactly once, however the
+session ends (Ctrl-C, a closed terminal, an error or the end of the job).
+"""
+
+import sys
+import time
+import shlex
+import atexit
+import shutil
+import signal
+import threading
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+# signals that end a session
+STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM]
+if hasattr(signal, 'SIGHUP'):
+    STOP_SIGNALS.append(signal.SIGHUP)
+
+
+def safe_print(*args, **kwargs):
+    """Prints, ignoring errors when the terminal is gone."""
+    try:
+        print(*args, **kwargs)
+        sys.stdout.flush()
+    except (OSError, ValueError):
+        pass
+
+
+class Teardown(object):
+    """Coordinates the teardown of a session.
+
+    The job is cancelled first, in a new session so a second Ctrl-C cannot
+    interrupt it. All processes are then terminated at the same time and
+    killed if they do not exit within the timeout. Running the teardown
+    more than once, or from a signal handler while it runs, does nothing.
+
+    Args:
+        run_event (threading.Event, optional): Event that is cleared to stop threads. Defaults to None.
+        timeout (float, optional): Seconds to wait for processes and threads to stop. Defaults to 2.
+        cancel_timeout (float, optional): Seconds to wait for the job to be cancelled. Defaults to 15.
+    """
+
+    def __init__(self, run_event=None, timeout=2, cancel_timeout=15):
+        self.run_event = run_event
+        self.timeout = timeout
+        self.cancel_timeout = cancel_timeout
+        self.cancel_command = None
+        self.children = []
+        self.started = False
+        self.lock = threading.Lock()
+
+    def add(self, process=None, thread=None):
+        """Adds a process and/or thread to stop.
+
+        Args:
+            process (subprocess.Popen, optional): Process. Defaults to None.
+            thread (threading.Thread, optional): Thread. Defaults to None.
+        """
+        self.children.append((process, thread))
+
+    def install(self):
+        """Makes Ctrl-C, SIGTERM and SIGHUP (closed terminal) end the session
+        by raising KeyboardInterrupt in the main thread, and runs the teardown
+        at exit if it has not run.
+        """
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, self.interrupt)
+        atexit.register(self.run)
+
+    def interrupt(self, signum, frame):
+        """Signal handler raising KeyboardInterrupt unless the teardown has started."""
+        if not self.started:
+            raise KeyboardInterrupt
+
+    def _cancel(self, verbose=False):
+        if verbose: safe_print(self.cancel_command)
+        cmd = shlex.split(self.cancel_command)
+        cmd[0] = shutil.which(cmd[0]) or cmd[0]
+        try:
+            return Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE, start_new_session=True)
+        except OSError as e:
+            safe_print('Could not cancel slurm job:', e)
+            return False
+
+    def _stop_children(self):
+        deadline = time.time() + self.timeout
+        processes = [p for p, t in self.children if p is not None]
+        for p in processes:
+            try:
+                p.terminate()
+            except OSError:
+                pass
+        for p in processes:
+            try:
+                p.wait(timeout=max(0, deadline - time.time()))
+            except TimeoutExpired:
+                p.kill()
+        for p, t in self.children:
+            if t is not None and t is not threading.current_thread():
+                t.join(timeout=max(0, deadline - time.time()))
+
+    def run(self, message=None, verbose=False):
+        """Cancels the job and stops processes and threads. Only the first call
+        does anything.
+
+        Args:
+            message (str, optional): Message printed when the teardown starts. Defaults to None.
+            verbose (bool, optional): Verbose if True. Defaults to False.
+
+        Returns:
+            bool: True if the job was cancelled, False if cancelling failed and None
+                if there was no job to cancel or the teardown has already run.
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.started:
+                return None
+            self.started = True
+            if threading.current_thread() is threading.main_thread():
+                for signum in STOP_SIGNALS:
+                    signal.signal(signum, signal.SIG_IGN)
+            if message:
+                safe_print(message)
+
+            cancel = None
+            if self.cancel_command:
+                cancel = self._cancel(verbose=verbose)
+            if self.run_event is not None:
+                self.run_event.clear()
+            self._stop_children()
+
+            if cancel is None or cancel is False:
+                return cancel
+            try:
+                stdout, stderr = cancel.communicate(timeout=self.cancel_timeout)
+            except TimeoutExpired:
+                cancel.kill()
+                stdout, stderr = cancel.communicate()
+            if cancel.returncode:
+                safe_print('Could not cancel slurm job ({}):'.format(self.cancel_command), stderr.decode().strip())
+                return False
+            return True
+        finally:
+            self.lock.release()
@@ -9,12 +9,15 @@ slurm_batch_script =  """#!/bin/sh
 #SBATCH -n {nr_nodes}
 #SBATCH -c {nr_cores}
 #SBATCH -t {walltime}
-#SBATCH -o {tmp_dir}/{tmp_name}.%j.out
-#SBATCH -e {tmp_dir}/{tmp_name}.%j.err
+#SBATCH -o {tmp_dir}/{tmp_name}.{log_id}.out
+#SBATCH -e {tmp_dir}/{tmp_name}.{log_id}.err
 #SBATCH -J {job_name}
+{array_spec}
 {account_spec}
 {sources_loaded}
 ##cd "{cwd}"
+{activation}
+{stage}
 
 # Set nr of cores available to NumExpr
 export NUMEXPR_MAX_THREADS={nr_cores}
@@ -22,6 +25,82 @@ export NUMEXPR_MAX_THREADS={nr_cores}
 {commands}
 """
 
+# activates the environment from the snapshot made by activation_script
+# instead of starting conda
+snapshot_activation = """
+if [ -f "{activation_snapshot}" ]
+then
+    . "{activation_snapshot}"
+else
+    . "{conda_root}/etc/profile.d/conda.sh"
+    conda activate {environment_name}
+fi
+"""
+
+# runs the job from a copy of the environment unpacked to node-local disk.
+# The environment is packed with conda-pack into a tar file on the shared
+# file system, which is only remade when the environment changes. Reading
+# one large file is much faster than the many small reads and metadata
+# lookups of importing packages from the shared file system. Falls back to
+# the shared environment if packing or unpacking fails.
+local_env_activation = """
+env_key() {{
+    stat -c %Y "$1/conda-meta/history" "$1/etc/conda/activate.d" "$1/etc/conda/env_vars.d" 2>/dev/null | paste -sd- -
+}}
+now() {{
+    date +%s.%N
+}}
+secs() {{
+    awk "BEGIN {{ printf \\"%.1f\\", $2 - $1 }}"
+}}
+pack="$HOME/.slurm_jupyter/packs/{environment_name}.tar"
+local_prefix="${{TMPDIR:-/tmp}}/slurm_jupyter_env_{environment_name}_$SLURM_JOB_ID"
+key=$(env_key "{environment_prefix}")
+mkdir -p "$HOME/.slurm_jupyter/packs"
+t0=$(now)
+(
+    # only one job repacks at a time
+    flock 9
+    if [ ! -f "$pack" ] || [ "$(cat "$pack.key" 2>/dev/null)" != "$key" ]
+    then
+        echo "Packing environment {environment_name} (only done when the environment changes)" >&2
+        PATH="{environment_prefix}/bin:{conda_root}/bin:$PATH" conda-pack -q --force --ignore-editable-packages \\
+            --format tar -p "{environment_prefix}" -o "$pack.tmp" >&2 \\
+            && mv "$pack.tmp" "$pack" && echo "$key" > "$pack.key"
+    fi
+) 9> "$pack.lock"
+t1=$(now)
+if [ "$(cat "$pack.key" 2>/dev/null)" = "$key" ] && mkdir -p "$local_prefix" && tar -xf "$pack" -C "$local_prefix"
+then
+    export PATH="$local_prefix/bin:$PATH"
+    export CONDA_PREFIX="$local_prefix"
+    export CONDA_DEFAULT_ENV="{environment_name}"
+    for script in "$local_prefix"/etc/conda/activate.d/*.sh
+    do
+        [ -f "$script" ] && . "$script"
+    done
+    # fix paths that conda-pack could not make relative
+    conda-unpack
+    t2=$(now)
+    echo "Running from environment unpacked to $local_prefix (pack $(secs $t0 $t1) s, unpack $(secs $t1 $t2) s)" >&2
+    if [ -n "{env_timings}" ]
+    then
+        # time importing the same modules from the shared and the local environment
+        t3=$(now)
+        "{environment_prefix}/bin/python" -c "import {env_timings}"
+        t4=$(now)
+        "$local_prefix/bin/python" -c "import {env_timings}"
+        t5=$(now)
+        echo "Import of {env_timings}: shared $(secs $t3 $t4) s, local $(secs $t4 $t5) s" >&2
+        echo "{{\\"job\\": \\"$SLURM_JOB_ID\\", \\"environment\\": \\"{environment_name}\\", \\"modules\\": \\"{env_timings}\\", \\"pack\\": $(secs $t0 $t1), \\"unpack\\": $(secs $t1 $t2), \\"shared\\": $(secs $t3 $t4), \\"local\\": $(secs $t4 $t5)}}" \\
+            >> "$HOME/.slurm_jupyter/env_timings.jsonl"
+    fi
+else
+    echo "Could not unpack environment {environment_name} to $local_prefix. Using the shared environment." >&2
+    {fallback_activation}
+fi
+"""
+
 # shell script for running the jupyter server
 slurm_server_script =  """#!/bin/sh
 #SBATCH -p {queue}
@@ -33,96 +112,398 @@ slurm_server_script =  """#!/bin/sh
 #SBATCH -o {tmp_dir}/{tmp_name}.%j.out
 #SBATCH -e {tmp_dir}/{tmp_name}.%j.err
 #SBATCH -J {job_name}
+{array_spec}
 {account_spec}
 {sources_loaded}
 ##cd "{cwd}"
 
-if [ "{package_manager}" == "miniconda3" ] && [ -d "$HOME/miniconda3" ]
-then
-    # >>> conda initialize >>>
-    # !! Contents within this block are managed by 'conda init' !!
-    __conda_setup="$('$HOME/miniconda3/bin/conda' 'shell.bash' 'hook' 2> /dev/null)"
-    if [ $? -eq 0 ]; then
-        eval "$__conda_setup"
-    else
-        if [ -f "$HOME/miniconda3/etc/profile.d/conda.sh" ]; then
-            . "$HOME/miniconda3/etc/profile.d/conda.sh"
-        else
-            export PATH="$HOME/miniconda3/bin:$PATH"
-        fi
-    fi
-    unset __conda_setup
-    # <<< conda initialize <<<
-elif [ "{package_manager}" == "mambaforge" ] && [ -d "$HOME/mambaforge" ]
-then
-    # >>> conda initialize >>>
-    # !! Contents within this block are managed by 'conda init' !!
-    __conda_setup="$('$HOME/mambaforge/bin/conda' 'shell.bash' 'hook' 2> /dev/null)"
-    if [ $? -eq 0 ]; then
-        eval "$__conda_setup"
-    else
-        if [ -f "$HOME/mambaforge/etc/profile.d/conda.sh" ]; then
-            . "$HOME/mambaforge/etc/profile.d/conda.sh"
-        else
-            export PATH="$HOME/mambaforge/bin:$PATH"
-        fi
-    fi
-    unset __conda_setup
+{activation}
+{ipcluster}
+unset XDG_RUNTIME_DIR
+{stage}
+{task_setup}
+{idle_watch}
+jupyter {run} --ip=0.0.0.0 --no-browser --port={hostport} --ServerApp.iopub_data_rate_limit=10000000000 {jupyter_options}
+"""
 
-    if [ -f "$HOME/mambaforge/etc/profile.d/mamba.sh" ]; then
-        . "$HOME/mambaforge/etc/profile.d/mamba.sh"
-    fi
-    # <<< conda initialize <<<
-elif [ "{package_manager}" == "miniforge3" ] && [ -d "$HOME/miniforge3" ]
-then
-    # >>> conda initialize >>>
-    # !! Contents within this block are managed by 'conda init' !!
-    __conda_setup="$('$HOME/miniforge3/bin/conda' 'shell.bash' 'hook' 2> /dev/null)"
-    if [ $? -eq 0 ]; then
-        eval "$__conda_setup"
-    else
-        if [ -f "$HOME/miniforge3/etc/profile.d/conda.sh" ]; then
-            . "$HOME/miniforge3/etc/profile.d/conda.sh"
-        else
-            export PATH="$HOME/miniforge3/bin:$PATH"
-        fi
-    fi
-    unset __conda_setup
+# port and readiness beacon of each task of a workshop job array
+workshop_task = """HOSTPORT=$(({base_port} + SLURM_ARRAY_TASK_ID))
+mkdir -p {beacon_root}/$SLURM_ARRAY_JOB_ID
+python - $HOSTPORT {beacon_root}/$SLURM_ARRAY_JOB_ID/$SLURM_ARRAY_TASK_ID.json <<'SLURM_JUPYTER_BEACON' &
+{beacon_script}
+SLURM_JUPYTER_BEACON
+"""
 
-    if [ -f "$HOME/miniforge3/etc/profile.d/mamba.sh" ]; then
-        . "$HOME/miniforge3/etc/profile.d/mamba.sh"
-    fi
-    # <<< conda initialize <<<
-elif [ "{package_manager}" == "anaconda3" ] && [ -d "$HOME/anaconda3" ]
+# python script writing the readiness beacon of a workshop task: waits for
+# the server to answer with the token it has written to its runtime info and
+# then writes the node, port, token and scheme of the server to a file
+beacon_script = r"""
+import os
+import sys
+import ssl
+import glob
+import json
+import time
+from urllib.request import Request, build_opener, ProxyHandler, HTTPSHandler
+from urllib.parse import urlparse
+
+port, path = sys.argv[1], sys.argv[2]
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+context.check_hostname = False
+context.verify_mode = ssl.CERT_NONE
+opener = build_opener(ProxyHandler({}), HTTPSHandler(context=context))
+data_dir = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+runtime = os.environ.get('JUPYTER_RUNTIME_DIR') or os.path.join(data_dir, 'jupyter', 'runtime')
+
+while True:
+    time.sleep(1)
+    for info_file in glob.glob(os.path.join(runtime, 'jpserver-*.json')) + glob.glob(os.path.join(runtime, 'nbserver-*.json')):
+        try:
+            with open(info_file) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if str(info.get('port')) != port:
+            continue
+        scheme = info.get('secure') and 'https' or 'http'
+        host = urlparse(info.get('url', '')).hostname or '127.0.0.1'
+        request = Request('{}://{}:{}{}api/status'.format(scheme, host, port, info.get('base_url', '/')))
+        if info.get('token'):
+            request.add_header('Authorization', 'token ' + info['token'])
+        try:
+            with opener.open(request, timeout=5) as response:
+                if response.status != 200:
+                    continue
+        except Exception:
+            continue
+        beacon = {'task': int(os.environ['SLURM_ARRAY_TASK_ID']), 'job_id': os.environ.get('SLURM_JOB_ID'),
+                  'node': os.environ.get('SLURMD_NODENAME'), 'hostport': int(port), 'token': info.get('token', ''),
+                  'scheme': scheme, 'base_url': info.get('base_url', '/'), 'ready': time.time()}
+        old_umask = os.umask(0o077)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(beacon, f)
+        os.umask(old_umask)
+        os.replace(path + '.tmp', path)
+        sys.exit(0)
+"""
+
+# copies the inputs given with --stage to node-local disk before jupyter or
+# nbconvert starts and exports their local paths
+stage_inputs = """export SLURM_JUPYTER_STAGE_DIR="${{TMPDIR:-/tmp}}/slurm_jupyter_stage_$(id -un)"
+export SLURM_JUPYTER_STAGED="$(python - "$SLURM_JUPYTER_STAGE_DIR" {checksum} {paths} <<'SLURM_JUPYTER_STAGE'
+{stage_script}
+SLURM_JUPYTER_STAGE
+)"
+"""
+
+# python script staging inputs: each input is copied to the same absolute
+# path below the stage directory, so inputs from different directories do
+# not collide. Files are copied in parallel and files whose size and mtime
+# (or, with --stage-checksum, content) match the local copy are skipped. The
+# local paths are printed (separated by ':'), and the report written to
+# stderr and to ~/.slurm_jupyter/stage_timings.jsonl. If the node does not
+# have room for the files, the shared paths are printed instead.
+stage_script = r"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+root, checksum, inputs = sys.argv[1], sys.argv[2] == '1', sys.argv[3:]
+start = time.time()
+
+def local(path):
+    return os.path.join(root, os.path.abspath(path).lstrip(os.sep))
+
+def digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def unchanged(src, dst):
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if s.st_size != d.st_size:
+        return False
+    if int(s.st_mtime) == int(d.st_mtime):
+        return True
+    if checksum and digest(src) == digest(dst):
+        os.utime(dst, (s.st_atime, s.st_mtime))
+        return True
+    return False
+
+def stage(src):
+    dst = local(src)
+    if unchanged(src, dst):
+        return 0
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+files, found = [], []
+for path in inputs:
+    if os.path.isdir(path):
+        for dir_path, dir_names, file_names in os.walk(path):
+            files.extend(os.path.join(dir_path, name) for name in file_names)
+    elif os.path.isfile(path):
+        files.append(path)
+    else:
+        print('Cannot stage {}: no such file or directory'.format(path), file=sys.stderr)
+        continue
+    found.append(path)
+
+total = sum(os.path.getsize(f) for f in files)
+os.makedirs(root, mode=0o700, exist_ok=True)
+if total > shutil.disk_usage(root).free + sum(os.path.getsize(local(f)) for f in files if os.path.exists(local(f))):
+    print('Not enough space in {} to stage {:.1f} Gb. Using the shared files.'.format(root, total / 1024**3),
+          file=sys.stderr)
+    print(':'.join(os.path.abspath(path) for path in found))
+    sys.exit(0)
+
+with ThreadPoolExecutor(max_workers=max(1, min(8, len(files)))) as executor:
+    copied = list(executor.map(stage, files))
+
+seconds = time.time() - start
+mb = sum(copied) / 1024**2
+print('Staged {} files ({:.0f} Mb) to {} in {:.1f} s: {} copied ({:.0f} Mb at {:.0f} Mb/s), {} unchanged'.format(
+    len(files), total / 1024**2, root, seconds, len([c for c in copied if c]), mb, mb / max(seconds, 0.001),
+    len([c for c in copied if not c])), file=sys.stderr)
+try:
+    timings = os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'stage_timings.jsonl')
+    os.makedirs(os.path.dirname(timings), exist_ok=True)
+    with open(timings, 'a') as f:
+        print(json.dumps({'job': os.environ.get('SLURM_JOB_ID'), 'node': os.environ.get('SLURMD_NODENAME'),
+                          'files': len(files), 'total_mb': total / 1024**2, 'copied_mb': mb,
+                          'seconds': seconds}), file=f)
+except OSError:
+    pass
+print(':'.join(local(path) for path in found))
+"""
+
+# runs idle_script in the background in server jobs started with --idle-timeout
+idle_watch = """python - {idle_timeout} {idle_warning} {walltime_seconds} {hostport} <<'SLURM_JUPYTER_IDLE' &
+{idle_script}
+SLURM_JUPYTER_IDLE
+"""
+
+# python script watching a jupyter server for inactivity. Runs on the node
+# next to the server. The kernels and terminals of the server are read
+# through the jupyter API and the CPU use of all processes of the job from
+# /proc. The server is idle when no kernel is busy, no kernel or terminal has
+# had activity and the job has used less than IDLE_CPU cores. Warnings and
+# the release are written to stderr, which slurm-jupyter shows. On release
+# the server is shut down and the job cancelled.
+idle_script = r"""
+import os
+import sys
+import ssl
+import glob
+import json
+import time
+import subprocess
+from datetime import datetime
+from urllib.request import Request, build_opener, ProxyHandler, HTTPSHandler
+from urllib.parse import urlparse
+
+timeout, warning, walltime = float(sys.argv[1]) * 60, float(sys.argv[2]) * 60, float(sys.argv[3])
+port = sys.argv[4]
+cores = int(os.environ.get('SLURM_CPUS_PER_TASK', '1'))
+MARK = '[SlurmJptr idle]'
+IDLE_CPU = 0.1
+interval = min(60, max(1, timeout / 20))
+
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+context.check_hostname = False
+context.verify_mode = ssl.CERT_NONE
+opener = build_opener(ProxyHandler({}), HTTPSHandler(context=context))
+
+
+def log(message):
+    print(MARK + ' ' + message, file=sys.stderr, flush=True)
+
+
+def job_cpu(root, exclude):
+    # cpu seconds used by the processes of the job
+    children, cpu = {}, {}
+    for path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(path) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        pid = int(path.split('/')[2])
+        children.setdefault(int(fields[1]), []).append(pid)
+        cpu[pid] = int(fields[11]) + int(fields[12])
+    total, stack = 0, [root]
+    while stack:
+        pid = stack.pop()
+        if pid == exclude:
+            continue
+        total += cpu.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def server_info():
+    data_dir = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    runtime = os.environ.get('JUPYTER_RUNTIME_DIR') or os.path.join(data_dir, 'jupyter', 'runtime')
+    paths = glob.glob(os.path.join(runtime, 'jpserver-*.json')) + glob.glob(os.path.join(runtime, 'nbserver-*.json'))
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        try:
+            with open(path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if str(info.get('port')) == port:
+            return info
+    return None
+
+
+def api(info, path, method='GET'):
+    host = urlparse(info.get('url', '')).hostname or '127.0.0.1'
+    scheme = info.get('secure') and 'https' or 'http'
+    url = '{}://{}:{}{}api/{}'.format(scheme, host, port, info.get('base_url', '/'), path)
+    request = Request(url, method=method)
+    if info.get('token'):
+        request.add_header('Authorization', 'token ' + info['token'])
+    with opener.open(request, timeout=10) as response:
+        body = response.read()
+    return body and json.loads(body.decode()) or None
+
+
+def duration(secs):
+    return secs < 90 and '{:.0f} sec'.format(secs) or '{:.0f} min'.format(secs / 60)
+
+
+def timestamp(s):
+    return datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp()
+
+
+start = time.time()
+last_active = start
+prev_cpu, prev_time = job_cpu(os.getppid(), os.getpid()), start
+warned = False
+while True:
+    time.sleep(interval)
+    now = time.time()
+    cpu = job_cpu(os.getppid(), os.getpid())
+    if (cpu - prev_cpu) / (now - prev_time) >= IDLE_CPU:
+        last_active = now
+    prev_cpu, prev_time = cpu, now
+
+    info = server_info()
+    try:
+        kernels = api(info, 'kernels') or []
+    except Exception:
+        # server not running yet (or not answering): not idle
+        last_active = now
+        continue
+    try:
+        terminals = api(info, 'terminals') or []
+    except Exception:
+        terminals = []
+    for item in kernels + terminals:
+        if item.get('execution_state') == 'busy':
+            last_active = now
+        elif item.get('last_activity'):
+            last_active = max(last_active, timestamp(item['last_activity']))
+
+    idle = now - last_active
+    if idle >= timeout:
+        left = max(0, walltime - (now - start))
+        log('released: no activity for {}. Saved {:.1f} core-hours ({:.1f} h left x {} cores).'.format(
+            duration(idle), left / 3600 * cores, left / 3600, cores))
+        try:
+            api(info, 'shutdown', method='POST')
+        except Exception:
+            pass
+        try:
+            subprocess.call(['scancel', os.environ['SLURM_JOB_ID']])
+        except (OSError, KeyError):
+            pass
+        break
+    if idle >= timeout - warning and not warned:
+        log('warning: no activity for {}. The server is shut down and the job cancelled '
+            'in {} unless you use it.'.format(duration(idle), duration(timeout - idle)))
+        warned = True
+    elif idle < timeout - warning and warned:
+        log('activity resumed. The server keeps running.')
+        warned = False
+"""
+
+# shell script run on the frontend that makes sure there is an up-to-date
+# snapshot of what "conda activate" does for an environment. The snapshot is
+# remade when packages are installed or removed (which updates
+# conda-meta/history) or activation scripts change. Prints the snapshot
+# path, conda root and environment prefix.
+activation_script = """
+snapshot="$HOME/{tmp_dir}/activate_{environment_name}.sh"
+mkdir -p "$HOME/{tmp_dir}"
+
+env_key() {{
+    stat -c %Y "$1/conda-meta/history" "$1/etc/conda/activate.d" "$1/etc/conda/env_vars.d" 2>/dev/null | paste -sd- -
+}}
+
+status=cached
+if [ -f "$snapshot" ]
 then
-    # >>> conda initialize >>>
-    # !! Contents within this block are managed by 'conda init' !!
-    __conda_setup="$('$HOME/anaconda3/bin/conda' 'shell.bash' 'hook' 2> /dev/null)"
-    if [ $? -eq 0 ]; then
-        eval "$__conda_setup"
-    else
-        if [ -f "$HOME/anaconda3/etc/profile.d/conda.sh" ]; then
-            . "$HOME/anaconda3/etc/profile.d/conda.sh"
-        else
-            export PATH="$HOME/anaconda3/bin:$PATH"
-        fi
+    read -r _ version root prefix key < "$snapshot"
+fi
+if [ ! -f "$snapshot" ] || [ "$version" != "{version}" ] || [ ! -d "$prefix" ] || [ "$key" != "$(env_key "$prefix")" ]
+then
+    status=created
+    root=$(conda info --base) || exit 1
+    prefix=$(conda env list | awk '$1 == "{environment_name}" {{ print $NF }}')
+    if [ -z "$prefix" ]
+    then
+        echo "status=missing"
+        exit 0
     fi
-    unset __conda_setup
-    # <<< conda initialize <<<
+    # resolve activation with a placeholder for PATH so the job's own PATH is kept
+    echo "# {version} $root $prefix $(env_key "$prefix")" > "$snapshot.$$"
+    PATH="$root/condabin:__SLURM_JUPYTER_PATH__" "$root/bin/conda" shell.posix activate "$prefix" \\
+        | sed "s|__SLURM_JUPYTER_PATH__|'\\"\\$PATH\\"'|g" >> "$snapshot.$$" || exit 1
+    mv "$snapshot.$$" "$snapshot"
 fi
+echo "status=$status"
+echo "snapshot=$snapshot"
+echo "root=$root"
+echo "prefix=$prefix"
+"""
 
-{environment}
-{ipcluster}
-unset XDG_RUNTIME_DIR
-jupyter {run} --ip=0.0.0.0 --no-browser --port={hostport} --ServerApp.iopub_data_rate_limit=10000000000
+# shell script probing a cluster in auto mode for the expected queue wait and idle nodes
+probe_script = """
+{activation}
+test_only=$(sbatch --test-only -p {queue} -c {nr_cores} -t {walltime} --mem {memory_mb} {account_option} --wrap true 2>&1)
+start=$(echo "$test_only" | sed -n 's/.* to start at \\([^ ]*\\) .*/\\1/p' | head -n 1)
+if [ -n "$start" ]
+then
+    echo "wait=$(( $(date -d "$start" +%s) - $(date +%s) ))"
+fi
+echo "idle=$(sinfo -h -p {queue} -t idle -o %D 2>/dev/null | awk '{{ n += $1 }} END {{ print n + 0 }}')"
 """
 
 # python script for monitoring memory usage
 mem_script = """
 import psutil
 import os
-import time
+import re
 import sys
+import ssl
+import glob
+import json
+import time
+from urllib.request import Request, build_opener, ProxyHandler, HTTPSHandler
+from urllib.parse import urlparse
 
 def str_to_mb(s):
     # compute mem in mb
@@ -145,11 +526,17 @@ def memory_status(max_proportion):
         reserved_mem = str_to_mb('{total_memory}')
 
     used_mem = -1
+    processes = dict()
     for proc in psutil.process_iter():
         try:
             if '/job{job_id}/' in ' '. join(proc.cmdline()) and proc.username() == os.environ['USER']:            
                 # print(proc.cmdline())
-                used_mem = int(sum(c.memory_info().rss for c in proc.children(recursive=True)) ) / 1024**2
+                for c in proc.children(recursive=True):
+                    try:
+                        processes[c.pid] = (c.memory_info().rss / 1024**2, ' '.join(c.cmdline()))
+                    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                        pass
+                used_mem = sum(rss for rss, cmd in processes.values())
                 break
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
@@ -173,22 +560,149 @@ def memory_status(max_proportion):
         color = BLUE
     else:
         color = RED
-    return proportion, color + line + ENDC
+    return proportion, color + line + ENDC, used_mem, reserved_mem, processes
+
+def oom_files():
+    # memory.events (cgroup v2) or memory.oom_control (cgroup v1) of the job.
+    # The ssh session running this script is usually adopted into the job.
+    paths = []
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            path = line.strip().split(':', 2)[-1]
+            if '/job_{job_id}' in path:
+                path = path[:path.index('/job_{job_id}') + len('/job_{job_id}')]
+                paths += ['/sys/fs/cgroup' + path + '/memory.events',
+                          '/sys/fs/cgroup/memory' + path + '/memory.oom_control']
+    paths += glob.glob('/sys/fs/cgroup/system.slice/slurmstepd.scope/job_{job_id}/memory.events')
+    paths += glob.glob('/sys/fs/cgroup/slurm*/uid_*/job_{job_id}/memory.events')
+    paths += glob.glob('/sys/fs/cgroup/memory/slurm*/uid_*/job_{job_id}/memory.oom_control')
+    return [p for p in paths if os.path.exists(p)][:1]
+
+def oom_kills(files):
+    # number of processes killed for running out of memory
+    for path in files:
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith('oom_kill '):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+    return 0
+
+def report_oom(kills, processes, used_mem, peak_mem, reserved_mem):
+    # the process killed is the largest one that has gone since the last sample
+    gone = [(rss, pid, cmd) for pid, (rss, cmd) in processes.items() if not psutil.pid_exists(pid)]
+    rss, pid, cmd = max(gone) if gone else (None, None, None)
+    report = dict(kills=kills, pid=pid, command=cmd, rss=rss, used=used_mem, peak=peak_mem, reserved=reserved_mem)
+    print('[SlurmJptr oom] ' + json.dumps(report), file=sys.stdout)
+    sys.stdout.flush()
+
+def pss(pid):
+    # proportional set size in megabytes (shared pages are split between the processes sharing them)
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return psutil.Process(pid).memory_info().rss / 1024**2
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        return 0
+
+notebook_paths = dict()
+
+def server_sessions():
+    # kernel id to notebook path for the sessions of the server
+    data_dir = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    runtime = os.environ.get('JUPYTER_RUNTIME_DIR') or os.path.join(data_dir, 'jupyter', 'runtime')
+    for path in sorted(glob.glob(os.path.join(runtime, 'jpserver-*.json')), key=os.path.getmtime, reverse=True):
+        try:
+            with open(path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if str(info.get('port')) != '{hostport}':
+            continue
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        url = '%s://%s:{hostport}%sapi/sessions' % (info.get('secure') and 'https' or 'http',
+            urlparse(info.get('url', '')).hostname or '127.0.0.1', info.get('base_url', '/'))
+        request = Request(url, headers=dict(Authorization='token ' + info.get('token', '')))
+        try:
+            with build_opener(ProxyHandler(dict()), HTTPSHandler(context=context)).open(request, timeout=5) as response:
+                return dict((s['kernel']['id'], s['path']) for s in json.loads(response.read().decode()) if s.get('kernel'))
+        except Exception:
+            return dict()
+    return dict()
+
+def top_kernels(processes, n):
+    # memory of each kernel (and the processes it started), largest first
+    kernels = dict()
+    for pid, (rss, cmd) in processes.items():
+        m = re.search(r'kernel-([0-9a-f-]+)\\.json', cmd)
+        if m:
+            kernels[pid] = m.group(1)
+    if any(k not in notebook_paths for k in kernels.values()):
+        # only ask the server when there are new kernels
+        notebook_paths.update(server_sessions())
+    usage = []
+    for pid, kernel_id in kernels.items():
+        try:
+            pids = [pid] + [c.pid for c in psutil.Process(pid).children(recursive=True)]
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            continue
+        usage.append((sum(pss(p) for p in pids), notebook_paths.get(kernel_id, kernel_id[:8]), pid))
+    usage.sort(reverse=True)
+    return dict(kernels=len(usage), top=[dict(path=path, pss=mb, pid=pid) for mb, path, pid in usage[:n]])
+
+def kernels_changed(report, prev_report):
+    if prev_report is None or report['kernels'] != prev_report['kernels']:
+        return True
+    if [k['path'] for k in report['top']] != [k['path'] for k in prev_report['top']]:
+        return True
+    return any(abs(k['pss'] - p['pss']) > 0.1 * max(p['pss'], 100) for k, p in zip(report['top'], prev_report['top']))
 
 max_proportion = 0
 prev_proportion = 0
 prev_time = 0
+kernels_time, kernels_printed, prev_kernels = 0, 0, None
+files = oom_files()
+kills = oom_kills(files)
+processes, used_mem, peak_mem, reserved_mem = dict(), 0, 0, 0
+sample_time = 0
 while True:
-    time.sleep(5)
+    # OOM kills are checked every second, memory every five
+    time.sleep(1)
     try:
+        new_kills = oom_kills(files)
+        if new_kills > kills:
+            report_oom(new_kills - kills, processes, used_mem, peak_mem, reserved_mem)
+            kills = new_kills
+        if time.time() - sample_time < 5:
+            continue
+        sample_time = time.time()
         max_proportion = max(prev_proportion, max_proportion)
-        proportion, status_line = memory_status(max_proportion)
+        proportion, status_line, used_mem, reserved_mem, processes = memory_status(max_proportion)
+        if used_mem >= 0:
+            peak_mem = max(peak_mem, used_mem)
+            print('[SlurmJptr mem] {{:.0f}} {{:.1f}} {{:.1f}}'.format(sample_time, used_mem, reserved_mem), file=sys.stdout)
         max_interval = 5 * 60
         if abs(proportion - prev_proportion) > 0.1 or (time.time() - prev_time > max_interval):
             prev_proportion = proportion
             prev_time = time.time()
             print(status_line, file=sys.stdout)
-            sys.stdout.flush()
+        # per kernel memory is read less often, as it is more work with many kernels
+        if {top_kernels} and time.time() - kernels_time >= 30:
+            kernels_time = time.time()
+            report = top_kernels(processes, {top_kernels})
+            if kernels_changed(report, prev_kernels) or time.time() - kernels_printed > max_interval:
+                prev_kernels, kernels_printed = report, time.time()
+                print('[SlurmJptr kernels] ' + json.dumps(report), file=sys.stdout)
+        sys.stdout.flush()
     except UnboundLocalError:
         # This can happen when the function is interrupted halfway
         break
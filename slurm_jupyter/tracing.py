@@ -0,0 +1,118 @@
+"""Timestamped phase spans of a session, saved in the Chrome trace event
+format so they can be viewed in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class PhaseTrace(object):
+    """Records phases (spans) of a session.
+
+    Phases can be nested. Nesting is tracked for each thread, so phases
+    running concurrently in other threads are not recorded as nested in
+    each other. Top-level phases make up the one-line breakdown.
+    """
+
+    def __init__(self):
+        self.origin = time.time()
+        self.events = []
+        self.open = {}
+        # names of open phases started by each thread, innermost last
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def _now(self):
+        # microseconds since the trace started
+        return int((time.time() - self.origin) * 1e6)
+
+    def begin(self, name, **args):
+        """Starts a phase. It is nested in the phases the calling thread has open.
+
+        Args:
+            name (str): Phase name.
+            **args: Details shown with the phase in the trace viewer.
+        """
+        tid = threading.get_ident()
+        with self.lock:
+            stack = self.stacks.setdefault(tid, [])
+            self.open[name] = (self._now(), len(stack), args, tid)
+            stack.append(name)
+
+    def end(self, name, **args):
+        """Ends a phase. Does nothing if the phase was not started. The phase may
+        be ended by another thread than the one that started it.
+
+        Args:
+            name (str): Phase name.
+            **args: Details shown with the phase in the trace viewer.
+        """
+        with self.lock:
+            if name not in self.open:
+                return
+            start, depth, start_args, tid = self.open.pop(name)
+            stack = self.stacks[tid]
+            stack.remove(name)
+            if not stack:
+                del self.stacks[tid]
+            start_args.update(args)
+            self.events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': self._now() - start,
+                                'pid': os.getpid(), 'tid': tid % 2**31,
+                                'args': dict(start_args, depth=depth)})
+
+    @contextmanager
+    def span(self, name, **args):
+        """Context manager recording a phase.
+
+        Args:
+            name (str): Phase name.
+            **args: Details shown with the phase in the trace viewer.
+        """
+        self.begin(name, **args)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def mark(self, name, **args):
+        """Records an instant event.
+
+        Args:
+            name (str): Event name.
+            **args: Details shown with the event in the trace viewer.
+        """
+        with self.lock:
+            self.events.append({'name': name, 'ph': 'i', 's': 'p', 'ts': self._now(),
+                                'pid': os.getpid(), 'tid': threading.get_ident() % 2**31, 'args': args})
+
+    def breakdown(self):
+        """One-line summary of how long each top-level phase took.
+
+        Returns:
+            str: E.g. "24.3 s: update check 0.9 s, sbatch 0.6 s, ..."
+        """
+        phases = sorted((e for e in self.events if e['ph'] == 'X' and e['args'].get('depth') == 0),
+                        key=lambda e: e['ts'])
+        total = (time.time() - self.origin)
+        return '{:.1f} s: '.format(total) + ', '.join('{} {:.1f} s'.format(e['name'], e['dur'] / 1e6) for e in phases)
+
+    def save(self, path):
+        """Writes the trace as a Chrome trace JSON file. Phases still running are
+        written as ending now.
+
+        Args:
+            path (str): File path.
+        """
+        now = self._now()
+        with self.lock:
+            events = self.events + [{'name': name, 'ph': 'X', 'ts': start, 'dur': now - start,
+                                     'pid': os.getpid(), 'tid': tid % 2**31,
+                                     'args': dict(args, depth=depth, unfinished=True)}
+                                    for name, (start, depth, args, tid) in self.open.items()]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'start': self.origin}}, f)
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 from subprocess import PIPE, Popen
 import shlex
@@ -105,4 +106,41 @@ def str_to_mb(s):
         memory_per_cpu_mb *= 1024
     if scale == 'k':
         memory_per_cpu_mb /= 1024.0
-    return memory_per_cpu_mb
\ No newline at end of file
+    return memory_per_cpu_mb
+
+def index_ranges(indices):
+    """Formats integers as compact ranges like those used for slurm job arrays.
+
+    Args:
+        indices (list): Integers.
+
+    Returns:
+        str: Ranges (E.g. 0-4,7,9-12).
+    """
+    indices = sorted(int(i) for i in indices)
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(a == b and str(a) or '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def expand_ranges(s):
+    """Expands compact ranges like those used for slurm job arrays.
+
+    Args:
+        s (str): Ranges (E.g. 0-4,7,9-12).
+
+    Returns:
+        list: Integers.
+    """
+    indices = []
+    for part in s.split(','):
+        if '-' in part:
+            a, b = part.split('-')
+            indices.extend(range(int(a), int(b) + 1))
+        elif part:
+            indices.append(int(part))
+    return indices
@@ -0,0 +1,180 @@
+"""Workshop mode: identical jupyter servers for a class, one per student,
+run as the tasks of a single slurm job array. Each task runs its server on
+its own port (a base port plus the task id) with its own token and writes a
+readiness beacon (templates.beacon_script) to a directory on the cluster
+when the server answers. All beacons and the states of all tasks are
+collected with one ssh call, and the servers are written to a roster with
+the URL and tunnel command for each student.
+"""
+
+import os
+import re
+import csv
+import json
+
+from .utils import execute
+
+# directory on the cluster (relative to home) with the beacons of each workshop
+BEACON_ROOT = '.slurm_jupyter/workshops'
+
+# squeue states of all tasks and the beacons of the ready ones
+COLLECT_SCRIPT = """squeue -h -r -j {job_id} -o '%i|%T|%N' 2>/dev/null
+echo '--'
+for f in {beacon_root}/{job_id}/*.json; do if [ -f "$f" ]; then cat "$f"; echo; fi; done
+"""
+
+
+def workshop_file(job_id):
+    """Local record of a workshop.
+
+    Args:
+        job_id (str): Job id of the job array.
+
+    Returns:
+        str: File path.
+    """
+    return os.path.join(os.path.expanduser('~'), '.slurm_jupyter', 'workshops', '{}.json'.format(job_id))
+
+
+def save_workshop(workshop):
+    path = workshop_file(workshop['job_id'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(workshop, f, indent=1)
+
+
+def load_workshop(job_id):
+    """Reads the local record of a workshop.
+
+    Returns:
+        dict: Workshop or None if there is no record.
+    """
+    try:
+        with open(workshop_file(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_students(path):
+    """Reads student names, one per line. Empty lines and lines starting with # are skipped."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def parse_collect(text):
+    """Parses the output of COLLECT_SCRIPT.
+
+    Args:
+        text (str): Output.
+
+    Returns:
+        (dict, dict): Task id mapped to (state, node) and task id mapped to beacon.
+    """
+    queue, _, beacon_text = text.partition('\n--\n')
+    states = {}
+    for line in queue.splitlines():
+        fields = line.split('|')
+        m = re.match(r'\d+_(\d+)$', fields[0])
+        if len(fields) == 3 and m:
+            states[int(m.group(1))] = (fields[1], fields[2] or None)
+    beacons = {}
+    for line in beacon_text.splitlines():
+        try:
+            beacon = json.loads(line)
+        except ValueError:
+            continue
+        beacons[beacon['task']] = beacon
+    return states, beacons
+
+
+def collect(user, frontend, job_id, verbose=False):
+    """Gets the states of the tasks of a workshop and the beacons of servers
+    that are ready with a single ssh call.
+
+    Args:
+        user (str): User name on the cluster.
+        frontend (str): Cluster frontend.
+        job_id (str): Job id of the job array.
+        verbose (bool, optional): Verbose if True. Defaults to False.
+
+    Returns:
+        (dict, dict): Task id mapped to (state, node) and task id mapped to beacon.
+    """
+    script = COLLECT_SCRIPT.format(job_id=job_id, beacon_root=BEACON_ROOT)
+    cmd = 'ssh -q {}@{} sh -s'.format(user, frontend)
+    if verbose: print(cmd, script, sep='\n')
+    stdout, stderr = execute(cmd, stdin=script.encode())
+    return parse_collect(stdout.decode())
+
+
+def count_task_states(states, beacons, tasks, seen=False):
+    """Counts tasks that are ready, running (server starting), pending and ended.
+
+    Args:
+        states (dict): Task id mapped to (state, node).
+        beacons (dict): Task id mapped to beacon.
+        tasks (int): Number of tasks in the job array.
+        seen (bool, optional): Whether squeue has listed the job array before.
+            Tasks squeue no longer lists have then ended (or failed). Before
+            that, they may just not be listed yet. Defaults to False.
+
+    Returns:
+        dict: Counts.
+    """
+    counts = {'ready': 0, 'starting': 0, 'pending': 0, 'ended': 0}
+    for task in range(tasks):
+        state = states.get(task, (None, None))[0]
+        if task in beacons and state == 'RUNNING':
+            counts['ready'] += 1
+        elif state == 'RUNNING':
+            counts['starting'] += 1
+        elif state in ('PENDING', 'CONFIGURING') or state is None and not seen:
+            counts['pending'] += 1
+        else:
+            counts['ended'] += 1
+    return counts
+
+
+def roster_rows(workshop, states, beacons):
+    """Rows of the roster: one for each student.
+
+    Args:
+        workshop (dict): Workshop record.
+        states (dict): Task id mapped to (state, node).
+        beacons (dict): Task id mapped to beacon.
+
+    Returns:
+        list: Dicts with student, task, state, node, port, URL on the node,
+            tunnel command and URL through the tunnel. Servers that are not
+            ready have empty fields. Beacons left by tasks that are no longer
+            running are ignored.
+    """
+    rows = []
+    for task, student in enumerate(workshop['students']):
+        state = states.get(task, ('ENDED', None))[0]
+        row = {'student': student, 'task': task, 'state': state, 'node': '', 'port': '', 'url': '', 'tunnel': '',
+               'local_url': ''}
+        beacon = state == 'RUNNING' and beacons.get(task)
+        if beacon:
+            path = '{}{}?token={}'.format(beacon['base_url'], workshop['run'] == 'notebook' and 'tree' or 'lab',
+                                          beacon['token'])
+            row.update(node=beacon['node'], port=beacon['hostport'],
+                       url='{}://{}:{}{}'.format(beacon['scheme'], beacon['node'], beacon['hostport'], path),
+                       tunnel='ssh -N -L {port}:{node}:{port} USER@{frontend}'.format(
+                           port=beacon['hostport'], node=beacon['node'], frontend=workshop['frontend']),
+                       local_url='{}://localhost:{}{}'.format(beacon['scheme'], beacon['hostport'], path))
+        rows.append(row)
+    return rows
+
+
+def write_roster(path, rows):
+    """Writes the roster as a CSV file readable only by the owner (it holds the tokens)."""
+    old_umask = os.umask(0o077)
+    try:
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['student', 'task', 'state', 'node', 'port', 'url', 'tunnel', 'local_url'])
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        os.umask(old_umask)
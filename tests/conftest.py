@@ -0,0 +1,17 @@
+import os
+import pytest
+
+import fakecluster
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    """A fake cluster with the fake slurm tools first on PATH."""
+    path = str(tmp_path / 'cluster')
+    config = dict(fakecluster.DEFAULT_CONFIG, queue_delay=0.2, slurm_latency=0, ssh_latency=0)
+    fakecluster.make_cluster(path, config)
+    monkeypatch.setenv('PATH', os.path.join(path, 'bin') + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv(fakecluster.TAG_VARIABLE, 'pytest')
+    monkeypatch.chdir(str(tmp_path))
+    yield path
+    fakecluster.cleanup(path)
@@ -0,0 +1,1615 @@
+"""Offline benchmark harness for slurm-jupyter.
+
+Runs slurm-jupyter against a fake cluster on this machine so that changes
+to the orchestration can be measured and regression-tested without access
+to a real cluster. Stand-ins for ssh, sbatch, squeue, sacct, sstat, sinfo and scancel are
+put first on PATH. The fake ssh runs remote commands locally in a fake
+cluster home directory and forwards ports with -L. The fake sbatch queues
+jobs that start after a configurable delay on a fake node, where a fake
+jupyter serves a dummy HTTP API and writes a jupyter-like log. A fake browser
+records when the browser is opened and when the page loads through the
+forwarded port.
+
+Each cycle starts a session, waits for the browser, holds the session for
+a few seconds and stops it with Ctrl-C (SIGINT):
+
+    launch: slurm-jupyter submits a job and starts the server.
+    attach: a session is dropped (killed) and slurm-jupyter --attach
+        reconnects to its job.
+
+The startup scenario instead measures how long `slurm-jupyter --help` and
+`slurm-nb-run --help` take and how long slurm-jupyter takes to make its
+first ssh call, and fails if they exceed STARTUP_BUDGETS.
+
+Run it like this (Linux only):
+
+    python tests/fakecluster.py --cycles 3 --ssh-latency 0.1 --queue-delay 5
+
+The fake tools only use the standard library and load this file directly, so
+they start without importing the package.
+
+The tests next to this file use the same fake cluster (see the cluster
+fixture in conftest.py). Run them with:
+
+    python -m pytest tests
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import shutil
+import signal
+import socket
+import secrets
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
+
+# terminal colors
+BLUE = '\033[94m'
+RED = '\033[91m'
+ENDC = '\033[0m'
+
+# environment variables passed on to the fake tools
+TAG_VARIABLE = 'SLURM_JUPYTER_BENCH_TAG'
+NESTED_VARIABLE = 'SLURM_JUPYTER_BENCH_NESTED'
+NODE_VARIABLE = 'SLURM_JUPYTER_BENCH_NODE'
+
+CLIENT_TOOLS = ['ssh', 'sbatch', 'squeue', 'sacct', 'sstat', 'sinfo', 'scancel', 'browser']
+CLUSTER_TOOLS = ['jupyter', 'lsof', 'slurmd']
+
+FRONTEND = 'login.fake'
+ENVIRONMENT = 'bench'
+
+DEFAULT_CONFIG = {
+    'ssh_latency': 0.05,   # seconds added to each ssh connection
+    'slurm_latency': 0.02, # seconds added to each slurm command
+    'queue_delay': 2.0,    # seconds a job is pending
+    'boot_time': 2.0,      # seconds until jupyter reports it is running
+    'log_lines': 20,       # lines jupyter logs while starting
+    'nodes': 4,            # number of fake nodes
+}
+
+# seconds slurm-jupyter --help, slurm-nb-run --help and the first ssh call may take
+STARTUP_BUDGETS = {'help': 1.0, 'nb_run_help': 1.0, 'first_ssh': 1.5}
+
+JOB_STATES = {'PENDING': 'PD', 'RUNNING': 'R', 'COMPLETING': 'CG', 'COMPLETED': 'CD',
+              'CANCELLED': 'CA', 'FAILED': 'F', 'TIMEOUT': 'TO'}
+ACTIVE = ['PENDING', 'RUNNING']
+
+
+# -----------------------------------------------------------------------------
+# fake cluster state
+# -----------------------------------------------------------------------------
+
+def load_config(cluster):
+    with open(os.path.join(cluster, 'config.json')) as f:
+        return json.load(f)
+
+
+def log_event(cluster, tool, **fields):
+    """Appends an event to the event log of the fake cluster.
+
+    Args:
+        cluster (str): Fake cluster directory.
+        tool (str): Name of the tool writing the event.
+        **fields: Event fields.
+    """
+    event = dict(t=time.time(), tool=tool, tag=os.environ.get(TAG_VARIABLE, ''),
+                 nested=os.environ.get(NESTED_VARIABLE) == '1', pid=os.getpid())
+    event.update(fields)
+    fd = os.open(os.path.join(cluster, 'events.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def read_events(cluster, tag=None):
+    """Reads the event log of the fake cluster.
+
+    Args:
+        cluster (str): Fake cluster directory.
+        tag (str, optional): Only events from processes started with this tag. Defaults to None.
+
+    Returns:
+        list: Events.
+    """
+    path = os.path.join(cluster, 'events.jsonl')
+    if not os.path.exists(path):
+        return []
+    events = []
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if tag is None or event['tag'] == tag:
+                events.append(event)
+    return events
+
+
+class StateLock(object):
+    """Lock serializing updates of the job records."""
+
+    def __init__(self, cluster):
+        self.path = os.path.join(cluster, 'state', 'lock')
+
+    def __enter__(self):
+        import fcntl
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+
+def job_path(cluster, job_id):
+    return os.path.join(cluster, 'state', 'jobs', '{}.json'.format(job_id))
+
+
+def read_job(cluster, job_id):
+    try:
+        with open(job_path(cluster, job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_job(cluster, job):
+    path = job_path(cluster, job['id'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(job, f)
+    os.replace(path + '.tmp', path)
+
+
+def update_job(cluster, job_id, **fields):
+    """Updates a job record.
+
+    Args:
+        cluster (str): Fake cluster directory.
+        job_id (str): Job id.
+        **fields: Fields to update.
+
+    Returns:
+        dict: Updated job record.
+    """
+    with StateLock(cluster):
+        job = read_job(cluster, job_id)
+        job.update(fields)
+        write_job(cluster, job)
+    return job
+
+
+def all_jobs(cluster):
+    jobs = []
+    job_dir = os.path.join(cluster, 'state', 'jobs')
+    for name in os.listdir(job_dir):
+        if name.endswith('.json'):
+            job = read_job(cluster, name[:-5])
+            if job is not None:
+                jobs.append(job)
+    return sorted(jobs, key=lambda j: (int(j['array_job'] or j['id']), j['array_task'] or 0))
+
+
+def node_address(host):
+    """Loopback address of a fake node (cn-3 is 127.0.1.3). Other hosts are
+    this machine.
+
+    Args:
+        host (str): Host name.
+
+    Returns:
+        str: IP address.
+    """
+    m = re.match(r'(?:.+@)?cn-(\d+)$', host)
+    if m:
+        return '127.0.1.{}'.format(int(m.group(1)))
+    return '127.0.0.1'
+
+
+def slurm_time(secs):
+    """Formats seconds like slurm (E.g. 1-02:03:04 or 02:03:04)."""
+    secs = max(0, int(secs))
+    days, secs = divmod(secs, 86400)
+    hours, secs = divmod(secs, 3600)
+    mins, secs = divmod(secs, 60)
+    if days:
+        return '{}-{:02}:{:02}:{:02}'.format(days, hours, mins, secs)
+    return '{:02}:{:02}:{:02}'.format(hours, mins, secs)
+
+
+def slurm_seconds(spec):
+    """Parses a slurm time limit (E.g. 30, 1:00:00 or 2-12) to seconds."""
+    days = 0
+    if '-' in spec:
+        days, spec = spec.split('-', 1)
+        parts = [int(p) for p in spec.split(':')] + [0] * 2
+        hours, mins, secs = parts[:3]
+    else:
+        parts = [int(p) for p in spec.split(':')]
+        if len(parts) == 1:
+            hours, mins, secs = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, mins, secs = 0, parts[0], parts[1]
+        else:
+            hours, mins, secs = parts
+    return int(days) * 86400 + hours * 3600 + mins * 60 + secs
+
+
+def megabytes(spec):
+    """Parses a slurm memory spec (E.g. 8192, 8G) to megabytes."""
+    m = re.match(r'(\d+(?:\.\d+)?)([KMGT]?)', spec.upper())
+    scale = {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024**2}[m.group(2)]
+    return int(float(m.group(1)) * scale)
+
+
+def parse_options(tokens, with_value, aliases):
+    """Parses slurm command line options.
+
+    Args:
+        tokens (list): Arguments.
+        with_value (list): Long option names taking a value.
+        aliases (dict): Short option mapped to long option name.
+
+    Returns:
+        (dict, list): Options and positional arguments.
+    """
+    options, positional = {}, []
+    tokens = list(tokens)
+    while tokens:
+        token = tokens.pop(0)
+        if token.startswith('--'):
+            name, eq, value = token[2:].partition('=')
+        elif token.startswith('-') and len(token) > 1:
+            name, value, eq = aliases.get(token[1], token[1]), token[2:], ''
+            eq = value and '=' or ''
+        else:
+            positional.append(token)
+            continue
+        if name in with_value:
+            if not eq:
+                value = tokens.pop(0) if tokens else ''
+            options[name] = value
+        else:
+            options[name] = True
+    return options, positional
+
+
+def format_field(value, width=None, right=True):
+    value = str(value)
+    if width is None:
+        return value
+    if len(value) > width:
+        value = value[:width - 1] + '+'
+    return value.rjust(width) if right else value.ljust(width)
+
+
+# -----------------------------------------------------------------------------
+# fake tools
+# -----------------------------------------------------------------------------
+
+def remote_environment(cluster, host):
+    """Environment of a command run over ssh on the fake cluster."""
+    config = load_config(cluster)
+    env = dict(os.environ)
+    env['HOME'] = os.path.join(cluster, 'home')
+    env['PATH'] = os.pathsep.join([os.path.join(cluster, 'bin'), os.path.join(cluster, 'cluster_bin'),
+                                   os.path.join(cluster, 'conda', 'condabin'), config['path']])
+    env[NESTED_VARIABLE] = '1'
+    if re.match(r'(?:.+@)?cn-\d+$', host):
+        env[NODE_VARIABLE] = host.split('@')[-1]
+    else:
+        env.pop(NODE_VARIABLE, None)
+    return env
+
+
+def hang_up_on_exit(pgid):
+    """Forks a watchdog that hangs up a process group when this process dies,
+    like sshd does when the connection drops.
+
+    Args:
+        pgid (int): Process group of the remote command.
+
+    Returns:
+        int: Process id of the watchdog.
+    """
+    parent = os.getpid()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    def hang_up(*args):
+        try:
+            os.killpg(pgid, signal.SIGHUP)
+        except OSError:
+            pass
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, hang_up)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        import ctypes
+        ctypes.CDLL(None).prctl(1, signal.SIGTERM) # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+    if os.getppid() != parent:
+        hang_up()
+    while True:
+        signal.pause()
+
+
+def pipe_socket(src, dst):
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for s in (src, dst):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def forward_port(spec):
+    """Starts forwarding a local port like ssh -L.
+
+    Args:
+        spec (str): Forward spec ([bind:]port:host:hostport).
+
+    Returns:
+        bool: True if the local port could be bound.
+    """
+    parts = spec.split(':')
+    bind = len(parts) == 4 and parts.pop(0) or '127.0.0.1'
+    port, host, hostport = int(parts[0]), parts[1], int(parts[2])
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.bind((bind == 'localhost' and '127.0.0.1' or bind, port))
+    except OSError:
+        print('bind [{}]:{}: Address already in use'.format(bind, port), file=sys.stderr)
+        print('channel_setup_fwd_listener_tcpip: cannot listen to port: {}'.format(port), file=sys.stderr)
+        print('Could not request local forwarding.', file=sys.stderr)
+        sys.stderr.flush()
+        return False
+    listener.listen(16)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            try:
+                remote = socket.create_connection((node_address(host), hostport), timeout=5)
+                remote.settimeout(None)
+            except OSError:
+                print('channel 2: open failed: connect failed: Connection refused', file=sys.stderr)
+                sys.stderr.flush()
+                conn.close()
+                continue
+            for a, b in ((conn, remote), (remote, conn)):
+                t = threading.Thread(target=pipe_socket, args=(a, b))
+                t.daemon = True
+                t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return True
+
+
+def fake_ssh(argv, cluster):
+    """Runs the remote command locally in the fake cluster home directory and
+    forwards ports given with -L.
+    """
+    config = load_config(cluster)
+    with_value = set('BbcDEeFIiJLlmOopQRSWw')
+    forwards, i = [], 0
+    while i < len(argv) and argv[i].startswith('-'):
+        for k, c in enumerate(argv[i][1:]):
+            if c in with_value:
+                value = argv[i][k + 2:]
+                if not value:
+                    i += 1
+                    value = argv[i]
+                if c == 'L':
+                    forwards.append(value)
+                break
+        i += 1
+    host, command = argv[i], ' '.join(argv[i + 1:])
+
+    time.sleep(config['ssh_latency'])
+    hostname = host.rpartition('@')[2]
+    if hostname not in (FRONTEND, 'localhost') and not re.match(r'cn-\d+$', hostname):
+        print('ssh: Could not resolve hostname {}: Name or service not known'.format(hostname), file=sys.stderr)
+        return 255
+    for spec in forwards:
+        forward_port(spec)
+
+    process = None
+
+    def stop(signum, frame):
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGHUP)
+            except OSError:
+                pass
+        os._exit(128 + signum)
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, stop)
+
+    if not command:
+        log_event(cluster, 'ssh', host=host, cmd='', forward=forwards, pgid=None)
+        while forwards:
+            time.sleep(3600)
+        return 0
+
+    # hold signals until the process is known to the signal handler
+    signals = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    shell = shutil.which('bash') or '/bin/sh'
+    process = Popen([shell, '-c', command], cwd=os.path.join(cluster, 'home'),
+                    env=remote_environment(cluster, host), start_new_session=True,
+                    preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_UNBLOCK, signals))
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+    log_event(cluster, 'ssh', host=host, cmd=command, forward=forwards, pgid=process.pid)
+    watchdog = hang_up_on_exit(process.pid)
+    returncode = process.wait()
+    os.kill(watchdog, signal.SIGKILL)
+    os.waitpid(watchdog, 0)
+    return returncode
+
+
+SBATCH_VALUES = ['partition', 'time', 'job-name', 'output', 'error', 'cpus-per-task', 'ntasks', 'nodes',
+                 'mem', 'mem-per-cpu', 'account', 'array', 'dependency', 'gres', 'chdir', 'kill-on-invalid-dep']
+SBATCH_ALIASES = {'p': 'partition', 't': 'time', 'J': 'job-name', 'o': 'output', 'e': 'error',
+                  'c': 'cpus-per-task', 'n': 'ntasks', 'N': 'nodes', 'A': 'account', 'a': 'array',
+                  'd': 'dependency', 'D': 'chdir'}
+
+
+def expand_array(spec):
+    """Task ids of an array spec (E.g. 0-9%2 or 1,3,5)."""
+    tasks = []
+    for part in spec.split('%')[0].split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            tasks.extend(range(int(start), int(end) + 1))
+        else:
+            tasks.append(int(part))
+    return tasks
+
+
+def fake_sbatch(argv, cluster):
+    """Queues a job. The job script is read from the file given or stdin."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, positional = parse_options(argv, SBATCH_VALUES + ['wrap'], SBATCH_ALIASES)
+    if positional:
+        with open(positional[0]) as f:
+            script = f.read()
+    elif options.get('wrap'):
+        script = '#!/bin/sh\n' + options['wrap'] + '\n'
+    else:
+        script = sys.stdin.read()
+    directives = []
+    for line in script.splitlines():
+        if line.startswith('#SBATCH'):
+            directives.extend(shlex.split(line[len('#SBATCH'):]))
+    job_options, _ = parse_options(directives, SBATCH_VALUES, SBATCH_ALIASES)
+    job_options.update(options)
+
+    if job_options.get('test-only'):
+        print('sbatch: Job 1 to start at {} using {} processors on nodes cn-1 in partition {}'.format(
+            datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), job_options.get('cpus-per-task', 1),
+            job_options.get('partition', 'normal')), file=sys.stderr)
+        return 0
+
+    with StateLock(cluster):
+        counter = os.path.join(cluster, 'state', 'counter')
+        job_id = int(open(counter).read()) + 1 if os.path.exists(counter) else 1001
+        with open(counter, 'w') as f:
+            f.write(str(job_id))
+    job_id = str(job_id)
+    script_path = os.path.join(cluster, 'state', 'scripts', job_id + '.sh')
+    with open(script_path, 'w') as f:
+        f.write(script)
+
+    name = job_options.get('job-name') or (positional and os.path.basename(positional[0]) or 'sbatch')
+    cwd = job_options.get('chdir') or os.getcwd()
+    record = dict(name=name, user=os.environ.get('USER', 'bench'), state='PENDING', submit=time.time(),
+                  start=None, end=None, node='', exit_code='0:0', script=script_path, cwd=cwd,
+                  command=positional and os.path.abspath(positional[0]) or script_path,
+                  partition=job_options.get('partition', 'normal'),
+                  time_limit=slurm_seconds(job_options.get('time', '01:00:00')),
+                  cpus=int(job_options.get('cpus-per-task', 1)),
+                  mem=megabytes(job_options.get('mem', '4096')),
+                  account=job_options.get('account', ''),
+                  output=job_options.get('output', 'slurm-%j.out'),
+                  error=job_options.get('error', job_options.get('output', 'slurm-%j.out')),
+                  dependency=job_options.get('dependency', ''),
+                  kill_on_invalid_dep=job_options.get('kill-on-invalid-dep', 'no') == 'yes', reason='',
+                  array_job=None, array_task=None, slurmd=None, pid=None)
+    if job_options.get('array'):
+        tasks = [dict(record, id='{}_{}'.format(job_id, i), array_job=job_id, array_task=i)
+                 for i in expand_array(job_options['array'])]
+    else:
+        tasks = [dict(record, id=job_id)]
+    with StateLock(cluster):
+        for task in tasks:
+            write_job(cluster, task)
+    for task in tasks:
+        Popen([os.path.join(cluster, 'cluster_bin', 'slurmd'), task['id']], stdin=DEVNULL, stdout=DEVNULL,
+              stderr=DEVNULL, start_new_session=True, close_fds=True)
+
+    log_event(cluster, 'sbatch', job_id=job_id, name=name, tasks=len(tasks))
+    if job_options.get('parsable'):
+        print(job_id)
+    else:
+        print('Submitted batch job {}'.format(job_id))
+    return 0
+
+
+def dependencies_met(cluster, job):
+    """Whether the dependencies of a job are met.
+
+    Returns:
+        bool: True if met, False if they can never be met and None if not yet.
+    """
+    if not job['dependency']:
+        return True
+    kind, *ids = job['dependency'].split(':')
+    for dep_id in ids:
+        if kind == 'aftercorr' and job['array_task'] is not None:
+            dep_ids = ['{}_{}'.format(dep_id, job['array_task'])]
+        else:
+            dep_ids = [j['id'] for j in all_jobs(cluster) if j['id'] == dep_id or j['array_job'] == dep_id]
+        for dep in (read_job(cluster, d) for d in dep_ids):
+            if dep is None or dep['state'] in ACTIVE:
+                return None
+            if kind in ('afterok', 'aftercorr') and dep['state'] != 'COMPLETED':
+                return False
+    return True
+
+
+def substitute_filename(pattern, job):
+    job_id = job['array_job'] or job['id']
+    path = pattern.replace('%j', job['id'].replace('_', '')).replace('%A', job_id)
+    path = path.replace('%a', str(job['array_task'])).replace('%x', job['name'])
+    path = path.replace('%u', job['user']).replace('%N', job['node'])
+    return os.path.join(job['cwd'], path)
+
+
+def slurmctld_message(job, reason):
+    return 'slurmstepd: error: *** JOB {} ON {} CANCELLED AT {}{} ***\n'.format(
+        job['id'], job['node'], datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), reason)
+
+
+def run_job(argv, cluster):
+    """Waits for the queue delay and dependencies, then runs a job script on a
+    fake node until it ends, times out or is cancelled.
+    """
+    config = load_config(cluster)
+    job_id = argv[0]
+    update_job(cluster, job_id, slurmd=os.getpid())
+    queued = time.time()
+    while True:
+        job = read_job(cluster, job_id)
+        if job['state'] != 'PENDING':
+            return 0
+        if time.time() - queued >= config['queue_delay']:
+            met = dependencies_met(cluster, job)
+            if met is False and job.get('kill_on_invalid_dep'):
+                update_job(cluster, job_id, state='CANCELLED', end=time.time())
+                return 0
+            if met is False and not job.get('reason'):
+                # like slurm, the job pends until it is cancelled
+                update_job(cluster, job_id, reason='DependencyNeverSatisfied')
+            if met:
+                break
+        time.sleep(0.1)
+
+    with StateLock(cluster):
+        job = read_job(cluster, job_id)
+        if job['state'] != 'PENDING':
+            return 0
+        index = int(job['array_job'] or job['id']) + (job['array_task'] or 0)
+        job.update(state='RUNNING', start=time.time(), node='cn-{}'.format(index % config['nodes'] + 1))
+        write_job(cluster, job)
+
+    tmp_dir = os.path.join(cluster, 'nodes', job['node'], 'tmp', job['id'])
+    os.makedirs(tmp_dir, exist_ok=True)
+    env = remote_environment(cluster, job['node'])
+    env.update(SLURM_JOB_ID=job['id'].replace('_', ''), SLURM_JOB_NAME=job['name'], SLURMD_NODENAME=job['node'],
+               SLURM_CPUS_PER_TASK=str(job['cpus']), TMPDIR=tmp_dir, USER=job['user'])
+    if job['array_job']:
+        env.update(SLURM_ARRAY_JOB_ID=job['array_job'], SLURM_ARRAY_TASK_ID=str(job['array_task']))
+    env.pop(NESTED_VARIABLE, None)
+
+    out_path, err_path = substitute_filename(job['output'], job), substitute_filename(job['error'], job)
+    for path in (out_path, err_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(out_path, 'a') as out, open(err_path, 'a') as err:
+        process = Popen(['sh', job['script']], cwd=job['cwd'], env=env, stdin=DEVNULL, stdout=out,
+                        stderr=err, start_new_session=True)
+    update_job(cluster, job_id, pid=process.pid)
+    try:
+        returncode = process.wait(timeout=max(0, job['time_limit'] - (time.time() - job['start'])))
+        timed_out = False
+    except TimeoutExpired:
+        timed_out = True
+        with open(err_path, 'a') as err:
+            err.write(slurmctld_message(job, ' DUE TO TIME LIMIT'))
+        os.killpg(process.pid, signal.SIGTERM)
+        returncode = process.wait()
+
+    with StateLock(cluster):
+        job = read_job(cluster, job_id)
+        if job['state'] == 'RUNNING':
+            job['state'] = timed_out and 'TIMEOUT' or (returncode and 'FAILED' or 'COMPLETED')
+            job['exit_code'] = '{}:0'.format(returncode if returncode >= 0 else 0)
+        job['end'] = time.time()
+        write_job(cluster, job)
+    return 0
+
+
+def fake_scancel(argv, cluster):
+    """Cancels jobs (or all tasks of a job array)."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, ids = parse_options(argv, ['name', 'user', 'signal', 'partition'],
+                                 {'n': 'name', 'u': 'user', 's': 'signal', 'p': 'partition'})
+    log_event(cluster, 'scancel', ids=ids, name=options.get('name'))
+    for job in all_jobs(cluster):
+        if not (job['id'] in ids or job['array_job'] in ids or options.get('name') == job['name']):
+            continue
+        with StateLock(cluster):
+            job = read_job(cluster, job['id'])
+            if job['state'] not in ACTIVE:
+                continue
+            running = job['state'] == 'RUNNING'
+            job.update(state='CANCELLED', end=time.time())
+            write_job(cluster, job)
+        if running and job['pid']:
+            with open(substitute_filename(job['error'], job), 'a') as err:
+                err.write(slurmctld_message(job, ''))
+            try:
+                os.killpg(job['pid'], signal.SIGTERM)
+            except OSError:
+                pass
+    return 0
+
+
+def job_fields(job, now):
+    """Values of the squeue and sacct fields of a job."""
+    elapsed = job['start'] and (job['end'] or now) - job['start'] or 0
+    state = job['state']
+    if state == 'CANCELLED':
+        state = 'CANCELLED by {}'.format(os.getuid())
+    return {'jobid': job['id'], 'jobname': job['name'], 'user': job['user'], 'state': state,
+            'exitcode': job['exit_code'], 'elapsed': slurm_time(elapsed), 'nodelist': job['node'] or 'None assigned',
+            'reqmem': '{}M'.format(job['mem']), 'reqcpus': job['cpus'], 'alloccpus': job['cpus'],
+            'account': job['account'], 'timelimit': slurm_time(job['time_limit']), 'partition': job['partition'],
+            'timeleft': slurm_time(job['time_limit'] - elapsed), 'maxrss': '', 'reason': job.get('reason') or 'None',
+            'command': job.get('command', job['script']),
+            'submit': datetime.fromtimestamp(job['submit']).strftime('%Y-%m-%dT%H:%M:%S'),
+            'start': job['start'] and datetime.fromtimestamp(job['start']).strftime('%Y-%m-%dT%H:%M:%S') or 'Unknown',
+            'end': job['end'] and datetime.fromtimestamp(job['end']).strftime('%Y-%m-%dT%H:%M:%S') or 'Unknown'}
+
+
+def select_jobs(cluster, ids, states, name=None):
+    selected = []
+    for job in all_jobs(cluster):
+        if ids and not (job['id'] in ids or job['array_job'] in ids):
+            continue
+        if states and job['state'] not in states and JOB_STATES.get(job['state']) not in states:
+            continue
+        if name and job['name'] not in name.split(','):
+            continue
+        selected.append(job)
+    return selected
+
+
+# squeue format letter mapped to header and job field
+SQUEUE_FIELDS = {'i': ('JOBID', 'jobid'), 'j': ('NAME', 'jobname'), 'u': ('USER', 'user'),
+                 'T': ('STATE', 'state'), 't': ('ST', 'short_state'), 'N': ('NODELIST', 'nodes'),
+                 'M': ('TIME', 'elapsed'), 'L': ('TIME_LEFT', 'timeleft'), 'l': ('TIME_LIMIT', 'timelimit'),
+                 'P': ('PARTITION', 'partition'), 'D': ('NODES', 'node_count'),
+                 'R': ('NODELIST(REASON)', 'reason'), 'm': ('MIN_MEMORY', 'reqmem'), 'C': ('CPUS', 'reqcpus'),
+                 'a': ('ACCOUNT', 'account'), 'V': ('SUBMIT_TIME', 'submit'), 'S': ('START_TIME', 'start'),
+                 'A': ('ARRAY_JOB_ID', 'array_job'), 'K': ('ARRAY_TASK_ID', 'array_task'),
+                 'o': ('COMMAND', 'command')}
+
+
+def fake_squeue(argv, cluster):
+    """Lists pending and running jobs."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, _ = parse_options(argv, ['format', 'jobs', 'user', 'states', 'name', 'partition'],
+                               {'o': 'format', 'j': 'jobs', 'u': 'user', 't': 'states', 'n': 'name',
+                                'p': 'partition', 'h': 'noheader'})
+    fmt = options.get('format', '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R')
+    ids = options.get('jobs') and options['jobs'].split(',') or []
+    states = options.get('states') and options['states'].upper().split(',') or ACTIVE
+    now = time.time()
+    specs = re.findall(r'%(\.?)(\d*)([a-zA-Z])|([^%]+)', fmt)
+    lines = []
+    if not options.get('noheader'):
+        lines.append(''.join(text or format_field(SQUEUE_FIELDS.get(c, (c, c))[0], int(w) if w else None, bool(r))
+                             for r, w, c, text in specs))
+    for job in select_jobs(cluster, ids, [s for s in states if s in JOB_STATES or s in JOB_STATES.values()],
+                           options.get('name')):
+        if job['state'] not in ACTIVE:
+            continue
+        values = job_fields(job, now)
+        values.update(short_state=JOB_STATES[job['state']], nodes=job['node'], node_count=1,
+                      state=job['state'], array_job=job['array_job'] or job['id'],
+                      array_task=job['array_task'] is None and 'N/A' or job['array_task'],
+                      reason=job['node'] or '({})'.format(job.get('reason') or 'Priority'))
+        lines.append(''.join(text or format_field(values.get(SQUEUE_FIELDS.get(c, (c, c))[1], ''), int(w) if w else None, bool(r))
+                             for r, w, c, text in specs))
+    if lines:
+        print('\n'.join(lines))
+    return 0
+
+
+def fake_sinfo(argv, cluster):
+    """Shows the number of idle and busy (mixed) nodes. Nodes running a job are busy."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, _ = parse_options(argv, ['format', 'partition', 'states'],
+                               {'o': 'format', 'p': 'partition', 't': 'states', 'h': 'noheader'})
+    busy = set(job['node'] for job in all_jobs(cluster) if job['state'] == 'RUNNING')
+    nodes = ['cn-{}'.format(i + 1) for i in range(config['nodes'])]
+    groups = [('idle', [n for n in nodes if n not in busy]), ('mixed', [n for n in nodes if n in busy])]
+    states = options.get('states') and options['states'].lower().split(',') or ['idle', 'mixed']
+    fmt = options.get('format', '%P %t %D %N')
+    lines = []
+    if not options.get('noheader'):
+        lines.append(fmt.replace('%P', 'PARTITION').replace('%t', 'STATE').replace('%T', 'STATE')
+                     .replace('%D', 'NODES').replace('%N', 'NODELIST'))
+    for state, members in groups:
+        if not members or not any(state.startswith(s) for s in states):
+            continue
+        lines.append(fmt.replace('%P', options.get('partition', 'normal')).replace('%t', state[:4])
+                     .replace('%T', state).replace('%D', str(len(members))).replace('%N', ','.join(members)))
+    if lines:
+        print('\n'.join(lines))
+    return 0
+
+
+def group_rss(pgid):
+    """Resident memory in kilobytes of the processes in a process group."""
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, ValueError):
+            continue
+        if int(fields[2]) == pgid:
+            total += int(fields[21]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    return total
+
+
+def fake_sstat(argv, cluster):
+    """Shows the memory use (MaxRSS) of running jobs as that of their batch step."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, _ = parse_options(argv, ['format', 'jobs'], {'o': 'format', 'j': 'jobs', 'n': 'noheader',
+                                                          'P': 'parsable2', 'p': 'parsable', 'a': 'allsteps'})
+    ids = options.get('jobs') and options['jobs'].split(',') or []
+    fields = [f.partition('%')[0].lower() for f in options.get('format', 'JobID,MaxRSS').split(',')]
+    lines = []
+    for job in select_jobs(cluster, ids, ['RUNNING']):
+        values = {'jobid': job['id'] + '.batch', 'maxrss': '{}K'.format(job['pid'] and group_rss(job['pid']) or 0)}
+        lines.append('|'.join(str(values.get(f, '')) for f in fields))
+    if lines:
+        print('\n'.join(lines))
+    return 0
+
+
+SACCT_ALIASES = {'time': 'timelimit', 'jobidraw': 'jobid', 'nnodes': 'node_count'}
+
+
+def fake_sacct(argv, cluster):
+    """Shows the accounting records of jobs."""
+    config = load_config(cluster)
+    time.sleep(config['slurm_latency'])
+    options, _ = parse_options(argv, ['format', 'jobs', 'state', 'user', 'starttime', 'endtime', 'name'],
+                               {'o': 'format', 'j': 'jobs', 's': 'state', 'u': 'user', 'S': 'starttime',
+                                'E': 'endtime', 'n': 'noheader', 'P': 'parsable2', 'p': 'parsable',
+                                'X': 'allocations'})
+    fields = []
+    for field in options.get('format', 'JobID,JobName,Partition,Account,AllocCPUS,State,ExitCode').split(','):
+        name, _, width = field.partition('%')
+        fields.append((name, SACCT_ALIASES.get(name.lower(), name.lower()), width and int(width) or max(10, len(name))))
+    ids = options.get('jobs') and options['jobs'].split(',') or []
+    states = options.get('state') and options['state'].upper().split(',') or []
+    parsable = options.get('parsable2') or options.get('parsable')
+    now = time.time()
+    lines = []
+    if not options.get('noheader'):
+        if parsable:
+            lines.append('|'.join(name for name, f, w in fields))
+        else:
+            lines.append(' '.join(format_field(name, w) for name, f, w in fields))
+            lines.append(' '.join('-' * w for name, f, w in fields))
+    for job in select_jobs(cluster, ids, states, options.get('name')):
+        values = job_fields(job, now)
+        if parsable:
+            lines.append('|'.join(str(values.get(f, '')) for name, f, w in fields))
+        else:
+            lines.append(' '.join(format_field(values.get(f, ''), w) for name, f, w in fields))
+    if lines:
+        print('\n'.join(lines))
+    return 0
+
+
+def fake_conda(argv, cluster):
+    """Answers the conda commands used on the cluster."""
+    root = os.path.join(cluster, 'conda')
+    envs = sorted(os.listdir(os.path.join(root, 'envs')))
+    command = ' '.join(argv[:2])
+    if command == 'info --base':
+        print(root)
+    elif command in ('env list', 'info --envs'):
+        if '--json' in argv:
+            print(json.dumps({'envs': [root] + [os.path.join(root, 'envs', e) for e in envs]}))
+        else:
+            print('# conda environments:\n#')
+            print('base'.ljust(20), root)
+            for name in envs:
+                print(name.ljust(20), os.path.join(root, 'envs', name))
+    elif command == 'shell.posix activate':
+        prefix = argv[2]
+        if not os.path.isabs(prefix):
+            prefix = os.path.join(root, 'envs', prefix)
+        print("export PATH='{}:{}'".format(os.path.join(prefix, 'bin'), os.environ['PATH']))
+        print("export CONDA_PREFIX='{}'".format(prefix))
+        print("export CONDA_DEFAULT_ENV='{}'".format(os.path.basename(prefix)))
+        print("export CONDA_SHLVL='1'")
+    elif argv[:1] == ['run']:
+        options, cmd = parse_options(argv[1:], ['name', 'prefix'], {'n': 'name', 'p': 'prefix'})
+        if cmd and cmd[0] == 'python':
+            cmd[0] = sys.executable
+        os.execvp(cmd[0], cmd)
+    elif argv[:1] == ['list']:
+        print('# This file may be used to create an environment using:')
+        print('python=3.11.0=fake')
+    else:
+        print('conda: fake conda does not support: {}'.format(' '.join(argv)), file=sys.stderr)
+        return 1
+    return 0
+
+
+def fake_lsof(argv, cluster):
+    """Lists the ports fake jupyter servers on this node listen on."""
+    runtime = os.path.join(cluster, 'home', '.local', 'share', 'jupyter', 'runtime')
+    node = os.environ.get(NODE_VARIABLE)
+    print('COMMAND     PID USER   FD   TYPE DEVICE SIZE/OFF NODE NAME')
+    for name in os.path.exists(runtime) and sorted(os.listdir(runtime)) or []:
+        if not re.match(r'jpserver-\d+\.json$', name):
+            continue
+        with open(os.path.join(runtime, name)) as f:
+            info = json.load(f)
+        if node and info['hostname'] != node:
+            continue
+        try:
+            os.kill(info['pid'], 0)
+        except OSError:
+            continue
+        print('jupyter-l {} {} 7u IPv4 0x0 0t0 TCP *:{} (LISTEN)'.format(
+            info['pid'], os.environ.get('USER', 'bench'), info['port']))
+    return 0
+
+
+def jupyter_log(level, message):
+    stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    print('[{} {} ServerApp] {}'.format(level, stamp, message), file=sys.stderr)
+    sys.stderr.flush()
+
+
+def fake_jupyter(argv, cluster):
+    """Starts a dummy jupyter server on a fake node. Other jupyter commands
+    (E.g. nbconvert) run the real jupyter.
+    """
+    if not argv or argv[0] not in ('lab', 'notebook', 'server'):
+        path = os.pathsep.join(p for p in os.environ['PATH'].split(os.pathsep) if not p.startswith(cluster))
+        jupyter = shutil.which('jupyter', path=path)
+        if jupyter is None:
+            print('jupyter: command not found', file=sys.stderr)
+            return 127
+        os.execv(jupyter, [jupyter] + argv)
+
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+    config = load_config(cluster)
+    options, _ = parse_options(argv[1:], ['port', 'ip'], {})
+    port = int(options.get('port', 8888))
+    node = os.environ.get(NODE_VARIABLE, 'cn-1')
+    token = secrets.token_hex(24)
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    start = time.time()
+    for i in range(config['log_lines']):
+        jupyter_log('I', 'Extension fake_extension_{} loaded from {}'.format(i, os.getcwd()))
+        time.sleep(config['boot_time'] / max(1, config['log_lines'] + 1))
+    time.sleep(max(0, config['boot_time'] - (time.time() - start)))
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def authorized(self):
+            query = parse_qs(urlparse(self.path).query)
+            header = self.headers.get('Authorization', '')
+            return query.get('token', [''])[0] == token or header == 'token ' + token
+
+        def reply(self, status, body, content_type='application/json'):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            log_event(cluster, 'jupyter', request=path, port=port)
+            if path == '/api':
+                self.reply(200, json.dumps({'version': '2.7.0'}))
+            elif not self.authorized():
+                self.reply(403, json.dumps({'message': 'Forbidden'}))
+            elif path == '/api/status':
+                now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                self.reply(200, json.dumps({'started': started, 'last_activity': now,
+                                            'connections': 0, 'kernels': 0}))
+            elif path in ('/api/kernels', '/api/sessions', '/api/terminals'):
+                self.reply(200, '[]')
+            elif path in ('/', '/lab', '/tree'):
+                self.reply(200, '<html><body>JupyterLab</body></html>', 'text/html')
+            else:
+                self.reply(404, json.dumps({'message': 'Not found'}))
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            log_event(cluster, 'jupyter', request='POST ' + path, port=port)
+            if not self.authorized():
+                self.reply(403, json.dumps({'message': 'Forbidden'}))
+            elif path == '/api/shutdown':
+                self.reply(200, '')
+                jupyter_log('I', 'Shutting down on /api/shutdown request.')
+                os.kill(os.getpid(), signal.SIGTERM)
+            else:
+                self.reply(404, json.dumps({'message': 'Not found'}))
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    try:
+        server = Server((node_address(node), port), Handler)
+    except OSError as e:
+        jupyter_log('E', 'Could not bind port {}: {}'.format(port, e))
+        return 1
+
+    runtime = os.environ.get('JUPYTER_RUNTIME_DIR',
+                             os.path.join(os.environ['HOME'], '.local', 'share', 'jupyter', 'runtime'))
+    os.makedirs(runtime, exist_ok=True)
+    runtime_file = os.path.join(runtime, 'jpserver-{}.json'.format(os.getpid()))
+    # reachable from the node like the url real servers write
+    url = 'http://{}:{}/'.format(node_address(node), port)
+    with open(runtime_file, 'w') as f:
+        json.dump({'base_url': '/', 'hostname': node, 'password': False, 'pid': os.getpid(), 'port': port,
+                   'root_dir': os.getcwd(), 'secure': False, 'sock': '', 'token': token, 'url': url,
+                   'version': '2.7.0'}, f)
+
+    def stop(signum, frame):
+        jupyter_log('C', 'received signal {}, stopping'.format(signum))
+        try:
+            os.remove(runtime_file)
+        except OSError:
+            pass
+        os._exit(0)
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, stop)
+
+    jupyter_log('I', 'Jupyter Server 2.7.0 is running at:')
+    jupyter_log('I', 'http://{}:{}/{}?token={}'.format(node, port, argv[0], token))
+    jupyter_log('I', '    http://127.0.0.1:{}/{}?token={}'.format(port, argv[0], token))
+    jupyter_log('I', 'Use Control-C to stop this server and shut down all kernels (twice to skip confirmation).')
+    server.serve_forever()
+    return 0
+
+
+def fake_browser(argv, cluster):
+    """Records that the browser is opened and loads the page in the background."""
+    from urllib.request import build_opener, ProxyHandler
+    from urllib.error import URLError, HTTPError
+
+    url = argv[0]
+    log_event(cluster, 'browser', event='open', url=url)
+    if os.fork():
+        return 0
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    opener = build_opener(ProxyHandler({}))
+    start, attempts, error = time.time(), 0, ''
+    while time.time() - start < 60:
+        attempts += 1
+        try:
+            # the fake server does not use TLS
+            response = opener.open(url.replace('https://', 'http://'), timeout=5)
+            log_event(cluster, 'browser', event='loaded', url=url, status=response.status, attempts=attempts)
+            os._exit(0)
+        except HTTPError as e:
+            log_event(cluster, 'browser', event='failed', url=url, status=e.code, attempts=attempts)
+            os._exit(0)
+        except (URLError, OSError) as e:
+            error = str(e)
+        time.sleep(0.2)
+    log_event(cluster, 'browser', event='failed', url=url, error=error, attempts=attempts)
+    os._exit(0)
+
+
+TOOLS = {'ssh': fake_ssh, 'sbatch': fake_sbatch, 'squeue': fake_squeue, 'sacct': fake_sacct, 'sstat': fake_sstat,
+         'sinfo': fake_sinfo, 'scancel': fake_scancel, 'conda': fake_conda, 'lsof': fake_lsof, 'jupyter': fake_jupyter,
+         'browser': fake_browser, 'slurmd': run_job}
+
+
+def fake_tool(name, cluster):
+    """Entry point of the fake tools.
+
+    Args:
+        name (str): Tool name.
+        cluster (str): Fake cluster directory.
+    """
+    if name not in ('ssh', 'sbatch', 'scancel', 'browser', 'slurmd'):
+        log_event(cluster, name, argv=sys.argv[1:])
+    sys.exit(TOOLS[name](sys.argv[1:], cluster) or 0)
+
+
+# -----------------------------------------------------------------------------
+# harness
+# -----------------------------------------------------------------------------
+
+SHIM = """#!{python} -S
+import importlib.util
+spec = importlib.util.spec_from_file_location('fakecluster', {module!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module.fake_tool({name!r}, {cluster!r})
+"""
+
+CONDA_SH = """conda() {{
+    if [ "$1" = activate ]
+    then
+        eval "$({root}/bin/conda shell.posix activate "$2")"
+    else
+        {root}/bin/conda "$@"
+    fi
+}}
+"""
+
+
+def make_cluster(cluster, config):
+    """Makes a fake cluster: the fake tools, a conda installation with an
+    environment, a home directory on the cluster and one on this machine.
+
+    Args:
+        cluster (str): Directory to make it in.
+        config (dict): Latencies and delays (see DEFAULT_CONFIG).
+    """
+    config = dict(config, path=os.environ.get('PATH', ''))
+    conda = os.path.join(cluster, 'conda')
+    for path in ['bin', 'cluster_bin', 'home/.slurm_jupyter', 'local', 'nodes', 'state/jobs', 'state/scripts',
+                 'conda/bin', 'conda/condabin', 'conda/etc/profile.d', 'conda/envs/{}/bin'.format(ENVIRONMENT),
+                 'conda/envs/{}/conda-meta'.format(ENVIRONMENT)]:
+        os.makedirs(os.path.join(cluster, path), exist_ok=True)
+    with open(os.path.join(cluster, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    with open(os.path.join(conda, 'envs', ENVIRONMENT, 'conda-meta', 'history'), 'w') as f:
+        f.write('==> {} <==\n'.format(datetime.now()))
+    with open(os.path.join(conda, 'etc', 'profile.d', 'conda.sh'), 'w') as f:
+        f.write(CONDA_SH.format(root=conda))
+
+    shims = [('bin', name) for name in CLIENT_TOOLS] + [('cluster_bin', name) for name in CLUSTER_TOOLS]
+    shims += [('conda/bin', 'conda'), ('conda/condabin', 'conda')]
+    for directory, name in shims:
+        path = os.path.join(cluster, directory, name)
+        with open(path, 'w') as f:
+            f.write(SHIM.format(python=sys.executable, module=os.path.abspath(__file__), name=name, cluster=cluster))
+        os.chmod(path, 0o755)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_cpu(pid):
+    """CPU seconds used by a process itself (not its children)."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def running_groups():
+    """Process groups with processes that are running (not zombies).
+
+    Returns:
+        set: Process group ids.
+    """
+    groups = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                state, ppid, pgrp = f.read().rsplit(')', 1)[1].split()[:3]
+        except (OSError, ValueError):
+            continue
+        if state != 'Z':
+            groups.add(int(pgrp))
+    return groups
+
+
+class Client(object):
+    """A slurm-jupyter process run against the fake cluster.
+
+    Args:
+        cluster (str): Fake cluster directory.
+        args (list): Command line arguments.
+        tag (str): Tag identifying the ssh calls and jobs made by this client.
+        verbose (bool, optional): Print the output of the client. Defaults to False.
+        entry (str, optional): Entry point (slurm_jupyter or slurm_nb_run). Defaults to 'slurm_jupyter'.
+    """
+
+    def __init__(self, cluster, args, tag, verbose=False, entry='slurm_jupyter'):
+        import site
+        self.cluster, self.tag, self.verbose = cluster, tag, verbose
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env.update({TAG_VARIABLE: tag, 'HOME': os.path.join(cluster, 'local'),
+                    'PATH': os.path.join(cluster, 'bin') + os.pathsep + env.get('PATH', ''),
+                    'BROWSER': os.path.join(cluster, 'bin', 'browser'),
+                    'PYTHONPATH': os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')])),
+                    'PYTHONUSERBASE': site.getuserbase(), 'PYTHONUNBUFFERED': '1'})
+        for name in (NESTED_VARIABLE, NODE_VARIABLE):
+            env.pop(name, None)
+        code = 'import sys; sys.argv[0] = "{}"; from slurm_jupyter import {}; {}()'.format(
+            entry.replace('_', '-'), entry, entry)
+        self.start = time.time()
+        self.process = Popen([sys.executable, '-c', code] + args, cwd=os.path.join(cluster, 'local'), env=env,
+                             stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+        self.lines, self.cpu, self.exit_time = [], 0, None
+        for target in (self._read, self._sample):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode(errors='replace')
+            self.lines.append((time.time(), line))
+            if self.verbose:
+                print('    [{}] {}'.format(self.tag, line), end='')
+        self.process.wait()
+        self.exit_time = self.exit_time or time.time()
+
+    def _sample(self):
+        while self.process.poll() is None:
+            try:
+                self.cpu = process_cpu(self.process.pid)
+            except (OSError, IndexError, ValueError):
+                break
+            time.sleep(0.05)
+
+    def events(self):
+        return read_events(self.cluster, self.tag)
+
+    def wait_for_browser(self, timeout):
+        """Waits until the browser has loaded the page.
+
+        Returns:
+            (float, float): Times the browser was opened and loaded the page (None if it did not).
+        """
+        opened = None
+        while time.time() - self.start < timeout and self.process.poll() is None:
+            for event in self.events():
+                if event['tool'] == 'browser' and event['event'] == 'open':
+                    opened = opened or event['t']
+                elif event['tool'] == 'browser':
+                    return opened, event['event'] == 'loaded' and event['t'] or None
+            time.sleep(0.1)
+        return opened, None
+
+    def interrupt(self, timeout, signals=(signal.SIGINT,), gap=0.05):
+        """Presses Ctrl-C (SIGINT to the process group) and waits for the client to exit.
+
+        Args:
+            timeout (float): Seconds to wait for the client to exit.
+            signals (tuple, optional): Signals sent in turn. E.g. two SIGINTs for a
+                double Ctrl-C or SIGHUP for a closed terminal. Defaults to (SIGINT,).
+            gap (float, optional): Seconds between signals. Defaults to 0.05.
+
+        Returns:
+            float: Time the first signal was sent.
+        """
+        sent = time.time()
+        for i, signum in enumerate(signals):
+            if i:
+                time.sleep(gap)
+            try:
+                os.killpg(self.process.pid, signum)
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout=timeout)
+        except TimeoutExpired:
+            pass
+        self.exit_time = self.exit_time or (self.process.poll() is not None and time.time() or None)
+        return sent
+
+    def kill(self):
+        """Kills the client and the remote side of its ssh connections, like a
+        dropped connection.
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        for pgid in self.remote_groups():
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def remote_groups(self):
+        return [e['pgid'] for e in self.events() if e['tool'] == 'ssh' and e.get('pgid')]
+
+    def leaked(self):
+        """Remote commands (E.g. tail) still running.
+
+        Returns:
+            list: Commands.
+        """
+        groups = running_groups()
+        return [e['cmd'] for e in self.events() if e['tool'] == 'ssh' and e.get('pgid') in groups]
+
+    def job_id(self):
+        for event in self.events():
+            if event['tool'] == 'sbatch':
+                return event['job_id']
+        return None
+
+    def breakdown(self):
+        for t, line in self.lines:
+            m = re.search(r'Started in ([^\x1b\n]*)', line)
+            if m:
+                return m.group(1)
+        return ''
+
+
+def run_session(cluster, args, tag, hold, timeout, verbose, before_stop=None, stop_signals=(signal.SIGINT,)):
+    """Runs a client until the browser loads the page, holds the session and
+    stops it with Ctrl-C (or the given signals).
+
+    Returns:
+        (dict, Client): Measurements and the client.
+    """
+    client = Client(cluster, args, tag, verbose=verbose)
+    opened, loaded = client.wait_for_browser(timeout)
+    result = {'ready': opened and opened - client.start, 'loaded': loaded and loaded - client.start,
+              'breakdown': client.breakdown(), 'job_id': client.job_id()}
+    start_cpu = client.cpu
+    result['cpu'] = start_cpu
+    if not loaded:
+        print(RED + '[{}] browser did not load the page. Last output:'.format(tag) + ENDC)
+        print(''.join(line for t, line in client.lines[-20:]))
+        client.kill()
+        return result, client
+
+    time.sleep(hold)
+    result['idle_cpu'] = (client.cpu - start_cpu) / hold if hold else 0
+    result['ssh_calls'] = len([e for e in client.events() if e['tool'] == 'ssh' and not e['nested']])
+    result['hops'] = len([e for e in client.events() if e['tool'] == 'ssh' and e['nested']])
+    if before_stop is not None:
+        before_stop(client)
+        return result, client
+
+    stop_calls = result['ssh_calls']
+    sent = client.interrupt(timeout=60, signals=stop_signals)
+    result['teardown'] = client.exit_time and client.exit_time - sent
+    # give hung up remote commands a moment to exit
+    time.sleep(0.5)
+    leaked = client.leaked()
+    result['leaked'] = len(leaked)
+    if leaked:
+        result['leaked_commands'] = leaked
+    result['ssh_calls'] = len([e for e in client.events() if e['tool'] == 'ssh' and not e['nested']])
+    result['teardown_ssh_calls'] = result['ssh_calls'] - stop_calls
+    result['cpu_total'] = client.cpu
+    return result, client
+
+
+def job_state(cluster, job_id, wait=0):
+    """State of a job, waiting up to wait seconds for it to end."""
+    start = time.time()
+    while True:
+        job = job_id and read_job(cluster, job_id)
+        if not job or job['state'] not in ACTIVE or time.time() - start >= wait:
+            return job and job['state'] or 'unknown'
+        time.sleep(0.1)
+
+
+def client_arguments(port, extra):
+    return ['-x', '-u', 'bench', '-f', FRONTEND, '--port', str(port)] + extra
+
+
+def launch_cycle(cluster, cycle, hold=5, timeout=120, verbose=False, extra_args=(),
+                 stop_signals=(signal.SIGINT,), tag='launch'):
+    """Launches a server, holds the session and stops it, which should cancel the job.
+
+    Returns:
+        dict: Measurements.
+    """
+    args = client_arguments(free_port(), ['-e', ENVIRONMENT, '-A', 'bench', '-t', '01:00:00'] + list(extra_args))
+    result, client = run_session(cluster, args, '{}{}'.format(tag, cycle), hold, timeout, verbose,
+                                 stop_signals=stop_signals)
+    result['job'] = job_state(cluster, result['job_id'], wait=10)
+    result['ok'] = bool(result.get('loaded')) and result['job'] == 'CANCELLED' and not result.get('leaked')
+    return result
+
+
+def double_interrupt_cycle(cluster, cycle, **kwargs):
+    """Like launch_cycle, but stops the session with a double Ctrl-C, which
+    should still cancel the job.
+    """
+    return launch_cycle(cluster, cycle, stop_signals=(signal.SIGINT, signal.SIGINT), tag='double', **kwargs)
+
+
+def hangup_cycle(cluster, cycle, **kwargs):
+    """Like launch_cycle, but closes the terminal (SIGHUP), which should still
+    cancel the job.
+    """
+    return launch_cycle(cluster, cycle, stop_signals=(signal.SIGHUP,), tag='hangup', **kwargs)
+
+
+def attach_cycle(cluster, cycle, hold=5, timeout=120, verbose=False, extra_args=()):
+    """Launches a server and drops the session, then attaches to the job, holds
+    the session and detaches, which should leave the job running.
+
+    Returns:
+        dict: Measurements.
+    """
+    port = free_port()
+    args = client_arguments(port, ['-e', ENVIRONMENT, '-A', 'bench', '-t', '01:00:00'] + list(extra_args))
+    launched, client = run_session(cluster, args, 'attach{}_launch'.format(cycle), 0, timeout, verbose,
+                                   before_stop=lambda c: c.kill())
+    if not launched.get('loaded'):
+        return dict(launched, ok=False)
+    args = client_arguments(port, ['-a'] + list(extra_args))
+    result, client = run_session(cluster, args, 'attach{}'.format(cycle), hold, timeout, verbose)
+    job_id = launched['job_id']
+    result['job'] = job_state(cluster, job_id)
+    result['ok'] = bool(result.get('loaded')) and result['job'] == 'RUNNING' and not result.get('leaked')
+    os.environ[TAG_VARIABLE] = 'harness'
+    fake_scancel([job_id], cluster)
+    job_state(cluster, job_id, wait=10)
+    return result
+
+
+def startup_cycle(cluster, cycle, timeout=120, verbose=False, extra_args=(), **kwargs):
+    """Measures the startup of the command line scripts: the time --help
+    takes for both scripts and the time until slurm-jupyter makes its first
+    ssh call. The session is killed after the first ssh call.
+
+    Returns:
+        dict: Measurements.
+    """
+    result = {}
+    for key, entry in [('help', 'slurm_jupyter'), ('nb_run_help', 'slurm_nb_run')]:
+        client = Client(cluster, ['--help'], 'startup{}'.format(cycle), verbose=verbose, entry=entry)
+        client.process.wait(timeout=timeout)
+        result[key] = time.time() - client.start
+
+    args = client_arguments(free_port(), ['-e', ENVIRONMENT, '-A', 'bench', '-t', '01:00:00'] + list(extra_args))
+    client = Client(cluster, args, 'startup{}'.format(cycle), verbose=verbose)
+    while time.time() - client.start < timeout and client.process.poll() is None:
+        calls = [e for e in client.events() if e['tool'] == 'ssh' and not e['nested']]
+        if calls:
+            result['first_ssh'] = calls[0]['t'] - client.start
+            break
+        time.sleep(0.01)
+    client.kill()
+    job_id = client.job_id()
+    if job_id:
+        os.environ[TAG_VARIABLE] = 'harness'
+        fake_scancel([job_id], cluster)
+    result['ok'] = all(key in result and result[key] <= budget for key, budget in STARTUP_BUDGETS.items())
+    return result
+
+
+SCENARIOS = {'launch': launch_cycle, 'attach': attach_cycle,
+             'double': double_interrupt_cycle, 'hangup': hangup_cycle, 'startup': startup_cycle}
+
+
+def cleanup(cluster):
+    """Cancels jobs and stops processes left on the fake cluster."""
+    os.environ[TAG_VARIABLE] = 'harness'
+    fake_scancel([j['id'] for j in all_jobs(cluster)], cluster)
+    for event in read_events(cluster):
+        for pid in filter(None, [event.get('pgid')]):
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+    for job in all_jobs(cluster):
+        for pid in filter(None, [job['pid'], job['slurmd']]):
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+METRICS = [('help', 'help', '{:.2f} s'), ('first_ssh', 'first ssh', '{:.2f} s'), ('ready', 'ready', '{:.1f} s'), ('loaded', 'loaded', '{:.1f} s'), ('teardown', 'teardown', '{:.1f} s'),
+           ('ssh_calls', 'ssh', '{}'), ('hops', 'hops', '{}'), ('cpu', 'cpu', '{:.2f} s'),
+           ('idle_cpu', 'idle cpu', '{:.1%}'), ('leaked', 'leaked', '{}'), ('job', 'job', '{}')]
+
+
+def format_row(cells, widths):
+    return '  '.join(str(c).ljust(w) for c, w in zip(cells, widths))
+
+
+def print_results(results):
+    header = ['scenario', 'cycle'] + [label for _, label, _ in METRICS]
+    rows = []
+    for r in results:
+        cells = [r['scenario'], r['cycle']]
+        for key, _, fmt in METRICS:
+            cells.append(r.get(key) is None and '-' or fmt.format(r[key]))
+        rows.append(cells)
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    print(BLUE + format_row(header, widths) + ENDC)
+    for r, row in zip(results, rows):
+        print((not r['ok'] and RED or '') + format_row(row, widths) + (not r['ok'] and ENDC or ''))
+    for r in results:
+        if r.get('breakdown'):
+            print('{} {}: {}'.format(r['scenario'], r['cycle'], r['breakdown']))
+
+
+def summarize(results):
+    """Median of each numeric metric for each scenario.
+
+    Returns:
+        dict: Scenario mapped to metric mapped to median.
+    """
+    summary = {}
+    for scenario in sorted(set(r['scenario'] for r in results)):
+        values = {}
+        for r in results:
+            if r['scenario'] != scenario:
+                continue
+            for key, value in r.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'cycle':
+                    values.setdefault(key, []).append(value)
+        summary[scenario] = dict((key, statistics.median(v)) for key, v in values.items())
+    return summary
+
+
+def check_budgets(summary, budgets):
+    """Compares medians to budgets (E.g. ready=40 or launch.teardown=2).
+
+    Returns:
+        list: Messages for exceeded budgets.
+    """
+    exceeded = []
+    for budget in budgets:
+        name, value = budget.split('=')
+        scenario, _, metric = name.rpartition('.')
+        for s, metrics in summary.items():
+            if scenario and s != scenario or metric not in metrics:
+                continue
+            if metrics[metric] > float(value):
+                exceeded.append('{} {} is {:.3g} (budget {})'.format(s, metric, metrics[metric], value))
+    return exceeded
+
+
+def main():
+    """Command line script running the benchmark."""
+    parser = argparse.ArgumentParser(description='Runs slurm-jupyter against a fake cluster on this machine '
+                                                 'and reports latency, ssh calls and client CPU.')
+    parser.add_argument('--cycles', dest='cycles', type=int, default=1,
+                        help='Number of cycles of each scenario.')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=list(SCENARIOS),
+                        help='Scenario to run (can be repeated). Defaults to all.')
+    parser.add_argument('--ssh-latency', dest='ssh_latency', type=float, default=DEFAULT_CONFIG['ssh_latency'],
+                        help='Seconds added to each ssh connection.')
+    parser.add_argument('--slurm-latency', dest='slurm_latency', type=float,
+                        default=DEFAULT_CONFIG['slurm_latency'], help='Seconds added to each slurm command.')
+    parser.add_argument('--queue-delay', dest='queue_delay', type=float, default=DEFAULT_CONFIG['queue_delay'],
+                        help='Seconds jobs are pending.')
+    parser.add_argument('--boot-time', dest='boot_time', type=float, default=DEFAULT_CONFIG['boot_time'],
+                        help='Seconds until jupyter reports it is running.')
+    parser.add_argument('--log-lines', dest='log_lines', type=int, default=DEFAULT_CONFIG['log_lines'],
+                        help='Number of lines jupyter logs while starting.')
+    parser.add_argument('--hold', dest='hold', type=float, default=5,
+                        help='Seconds to keep each session open to measure idle CPU.')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=120,
+                        help='Seconds to wait for the browser before giving up on a cycle.')
+    parser.add_argument('--client-args', dest='client_args', type=str, default='',
+                        help='Extra slurm-jupyter arguments (E.g. "--local-env").')
+    parser.add_argument('--budget', dest='budgets', action='append', default=[],
+                        help='Fail if the median of a metric exceeds a value (E.g. ready=40, '
+                             'launch.teardown=2 or ssh_calls=12). Can be repeated.')
+    parser.add_argument('--json', dest='json', type=str, default=None,
+                        help='Write results to this file.')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help='Keep the fake cluster directory.')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='Print the output of slurm-jupyter.')
+    args = parser.parse_args()
+
+    if not sys.platform.startswith('linux'):
+        print('The benchmark harness only runs on Linux')
+        sys.exit(1)
+
+    config = dict((key, getattr(args, key)) for key in DEFAULT_CONFIG if hasattr(args, key))
+    config = dict(DEFAULT_CONFIG, **config)
+    cluster = tempfile.mkdtemp(prefix='slurm_jupyter_bench_')
+    make_cluster(cluster, config)
+    print(BLUE + 'Fake cluster: {}'.format(cluster) + ENDC)
+
+    results = []
+    try:
+        for cycle in range(1, args.cycles + 1):
+            for scenario in args.scenarios or list(SCENARIOS):
+                print(BLUE + 'Running {} cycle {}'.format(scenario, cycle) + ENDC)
+                result = SCENARIOS[scenario](cluster, cycle, hold=args.hold, timeout=args.timeout,
+                                          verbose=args.verbose, extra_args=shlex.split(args.client_args))
+                results.append(dict(result, scenario=scenario, cycle=cycle))
+    finally:
+        cleanup(cluster)
+
+    print()
+    print_results(results)
+    summary = summarize(results)
+    exceeded = check_budgets(summary, args.budgets)
+    for message in exceeded:
+        print(RED + 'Over budget: ' + message + ENDC)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': config, 'results': results, 'summary': summary}, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(cluster, ignore_errors=True)
+    if exceeded or not all(r['ok'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
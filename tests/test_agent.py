@@ -0,0 +1,46 @@
+import os
+import sys
+import socket
+
+import pytest
+
+import slurm_jupyter
+from slurm_jupyter import agent
+
+
+@pytest.mark.parametrize('option', [['--agent'], ['--agent-status'], ['--agent-stop', 'all']])
+def test_agent_not_supported_on_windows(monkeypatch, capsys, option):
+    monkeypatch.setattr(slurm_jupyter, 'on_windows', lambda: True)
+    monkeypatch.setattr(sys, 'argv', ['slurm-jupyter', '-e', 'bench'] + option)
+    with pytest.raises(SystemExit) as e:
+        slurm_jupyter.slurm_jupyter()
+    assert e.value.code == 1
+    assert 'not supported on Windows' in capsys.readouterr().out
+
+
+def test_agent_main_not_supported_on_windows(monkeypatch):
+    monkeypatch.setattr(agent, 'on_windows', lambda: True)
+    monkeypatch.setattr(agent, 'Agent', lambda: pytest.fail('agent started'))
+    with pytest.raises(SystemExit):
+        agent.main()
+
+
+def test_session_teardown_runs_when_session_fails(monkeypatch, tmp_path):
+    cancelled = tmp_path / 'cancelled'
+
+    def failing_session(teardown=None):
+        teardown.cancel_command = 'touch {}'.format(cancelled)
+        raise RuntimeError('lost connection')
+
+    monkeypatch.setattr(slurm_jupyter, 'slurm_jupyter', failing_session)
+    session_agent = agent.Agent.__new__(agent.Agent)
+    session_agent.listener = socket.socket()
+    log_file = str(tmp_path / 'session.log')
+    pid = os.fork()
+    if pid == 0:
+        session_agent.run_session([], str(tmp_path), dict(os.environ), log_file)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 1
+    assert cancelled.exists()
+    with open(log_file) as f:
+        assert 'lost connection' in f.read()
@@ -0,0 +1,27 @@
+import subprocess
+
+import pytest
+
+import fakecluster
+from slurm_jupyter import StopServerException, wait_for_job_allocation
+
+
+def sbatch(*options):
+    process = subprocess.run(['sbatch', '--parsable'] + list(options) + ['--wrap', 'sleep 30'],
+                             stdout=subprocess.PIPE, check=True)
+    return process.stdout.decode().strip()
+
+
+def test_allocation_polls_until_node_is_known(cluster):
+    spec = {'user': 'bench', 'frontend': fakecluster.FRONTEND, 'job_id': sbatch()}
+    node = wait_for_job_allocation(spec)
+    subprocess.run(['scancel', spec['job_id']], check=True)
+    assert node.startswith('cn-')
+
+
+def test_allocation_of_ended_job_stops_server(cluster, capsys):
+    spec = {'user': 'bench', 'frontend': fakecluster.FRONTEND, 'job_id': sbatch()}
+    subprocess.run(['scancel', spec['job_id']], check=True)
+    with pytest.raises(StopServerException):
+        wait_for_job_allocation(spec)
+    assert 'ended (CANCELLED)' in capsys.readouterr().out
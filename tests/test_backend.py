@@ -0,0 +1,58 @@
+import subprocess
+
+import pytest
+
+from slurm_jupyter import backend
+from slurm_jupyter.backend import NEVER_SATISFIED, SubmitException, submit_graph, queued_job_ids, job_states
+
+
+def test_submit_graph_passes_dependency_ids():
+    jobs = {'a': ({'n': 'a'}, []), 'b': ({'n': 'b'}, ['a']), 'c': ({'n': 'c'}, ['a', 'b'])}
+    submitted = []
+
+    def submit(spec, dependencies):
+        submitted.append((spec['n'], dependencies))
+        return str(100 + len(submitted))
+
+    job_ids = submit_graph(jobs, submit)
+    assert job_ids == {'a': '101', 'b': '102', 'c': '103'}
+    assert submitted == [('a', []), ('b', ['101']), ('c', ['101', '102'])]
+
+
+def test_submit_graph_failure_keeps_submitted_ids():
+    jobs = {'a': ({'n': 'a'}, []), 'b': ({'n': 'b'}, ['a']), 'c': ({'n': 'c'}, ['b'])}
+
+    def submit(spec, dependencies):
+        if spec['n'] == 'b':
+            raise RuntimeError('sbatch: error: invalid account')
+        return '101'
+
+    with pytest.raises(SubmitException) as e:
+        submit_graph(jobs, submit)
+    assert e.value.job_ids == {'a': '101'}
+    assert 'invalid account' in str(e.value)
+
+
+def test_queued_job_ids(cluster):
+    def sbatch(name):
+        process = subprocess.run(['sbatch', '--parsable', '-J', name, '--wrap', 'sleep 30'],
+                                 stdout=subprocess.PIPE, check=True)
+        return process.stdout.decode().strip()
+
+    first, other, second = sbatch('nb_a'), sbatch('other'), sbatch('nb_a')
+    assert queued_job_ids(['nb_a', 'nb_b'], 'bench') == {'nb_a': second}
+
+
+def test_job_states_expands_pending_array_tasks(monkeypatch):
+    sacct = '\n'.join(['1001|COMPLETED|0:0|00:00:05|None',
+                        '1002_0|CANCELLED by 1234|0:0|00:00:01|None',
+                        '1002_[1-3,5%2]|PENDING|0:0|00:00:00|JobArrayTaskLimit',
+                        '1003|PENDING|0:0|00:00:00|DependencyNeverSatisfied',
+                        '1004|PENDING|0:0|00:00:00|Dependency'])
+    monkeypatch.setattr(backend, 'execute', lambda cmd: (sacct.encode(), b''))
+    assert job_states(['1001', '1002', '1003', '1004']) == {
+        '1001': ('COMPLETED', '0:0', '00:00:05'), '1002_0': ('CANCELLED', '0:0', '00:00:01'),
+        '1002_1': ('PENDING', '', ''), '1002_2': ('PENDING', '', ''), '1002_3': ('PENDING', '', ''),
+        '1002_5': ('PENDING', '', ''), '1003': (NEVER_SATISFIED, '0:0', '00:00:00'),
+        '1004': ('PENDING', '0:0', '00:00:00')}
+    assert job_states([]) == {}
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import subprocess
+
+from slurm_jupyter.cache import cache_key, evict, store_command
+
+
+def make_entry(cache_dir, name, size, age=0):
+    entry = os.path.join(cache_dir, name)
+    os.makedirs(entry)
+    with open(os.path.join(entry, '0'), 'wb') as f:
+        f.write(b'x' * size)
+    mtime = time.time() - age
+    os.utime(entry, (mtime, mtime))
+    return entry
+
+
+def test_evict_by_size_keeps_pending_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    old = make_entry(cache_dir, 'old', 2 * 1024**2, age=100)
+    new = make_entry(cache_dir, 'new', 2 * 1024**2, age=10)
+    pending = make_entry(cache_dir, 'older.pending.12.345', 2 * 1024**2, age=1000)
+    removed, freed = evict(cache_dir, max_size=3)
+    assert (removed, freed) == (1, 2 * 1024**2)
+    assert not os.path.exists(old)
+    assert os.path.exists(new) and os.path.exists(pending)
+
+
+def test_evict_stale_pending_entries_by_age(tmp_path):
+    cache_dir = str(tmp_path)
+    stale = make_entry(cache_dir, 'stale.pending.12.345', 10, age=3 * 86400)
+    running = make_entry(cache_dir, 'running.pending.13.346', 10, age=60)
+    removed, freed = evict(cache_dir, max_age=1)
+    assert removed == 1
+    assert not os.path.exists(stale) and os.path.exists(running)
+
+
+def test_store_command_publishes_entry(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    output = tmp_path / 'out.ipynb'
+    output.write_text('{}')
+    cmd = store_command(cache_dir, 'abc', [str(output)])
+    assert os.listdir(cache_dir) == []
+    assert os.system(cmd) == 0
+    assert os.listdir(cache_dir) == ['abc']
+    assert sorted(os.listdir(os.path.join(cache_dir, 'abc'))) == ['0', 'manifest.json']
+    with open(os.path.join(cache_dir, 'abc', 'manifest.json')) as f:
+        assert json.load(f)['files'] == {'0': str(output)}
+
+
+def test_concurrent_stores_do_not_share_pending_dir(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    output = tmp_path / 'out.ipynb'
+    output.write_text('{}')
+    cmd = store_command(cache_dir, 'abc', [str(output)])
+    jobs = [subprocess.Popen(cmd, shell=True, env=dict(os.environ, SLURM_JOB_ID=str(i))) for i in range(8)]
+    assert [job.wait() for job in jobs] == [0] * 8
+    assert os.listdir(cache_dir) == ['abc']
+    assert sorted(os.listdir(os.path.join(cache_dir, 'abc'))) == ['0', 'manifest.json']
+
+
+def write_notebook(path, cells):
+    with open(path, 'w') as f:
+        json.dump({'metadata': {'kernelspec': {'name': 'python3'}}, 'nbformat': 4, 'nbformat_minor': 5,
+                   'cells': [{'cell_type': t, 'source': s, 'metadata': {}} for t, s in cells]}, f)
+
+
+def test_key_ignores_markdown_by_default(tmp_path):
+    path = str(tmp_path / 'nb.ipynb')
+    write_notebook(path, [('markdown', '# Title'), ('code', 'x = 1')])
+    before = cache_key(path)
+    write_notebook(path, [('markdown', '# New title'), ('code', 'x = 1')])
+    assert cache_key(path) == before
+
+
+def test_inplace_key_includes_markdown(tmp_path):
+    path = str(tmp_path / 'nb.ipynb')
+    write_notebook(path, [('markdown', '# Title'), ('code', 'x = 1')])
+    before = cache_key(path, all_cells=True)
+    write_notebook(path, [('markdown', '# New title'), ('code', 'x = 1')])
+    assert cache_key(path, all_cells=True) != before
+    # outputs and cell metadata written by executing the notebook do not change the key
+    with open(path) as f:
+        nb = json.load(f)
+    nb['cells'][1].update(outputs=[{'output_type': 'stream', 'text': '1'}], execution_count=1,
+                          metadata={'execution': {}})
+    with open(path, 'w') as f:
+        json.dump(nb, f)
+    write_notebook(str(tmp_path / 'same.ipynb'), [('markdown', '# New title'), ('code', 'x = 1')])
+    assert cache_key(path, all_cells=True) == cache_key(str(tmp_path / 'same.ipynb'), all_cells=True)
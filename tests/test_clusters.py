@@ -0,0 +1,30 @@
+from slurm_jupyter import clusters
+from slurm_jupyter.clusters import UNKNOWN_WAIT, expected_wait, parse_probe
+
+
+def probe(name, wait=None, idle=0, usable=True, latency=0.1):
+    return {'name': name, 'wait': wait, 'idle': idle, 'usable': usable, 'latency': latency}
+
+
+def test_expected_wait_idle_nodes():
+    assert expected_wait(probe('a', idle=5)) == 0
+
+
+def test_expected_wait_unknown():
+    assert expected_wait(probe('a')) == UNKNOWN_WAIT
+
+
+def test_expected_wait_predicted():
+    assert expected_wait(probe('a', wait=1800, idle=5)) == 1800
+
+
+def test_idle_cluster_ranks_before_queued_cluster(monkeypatch):
+    probes = {'queued': probe('queued', wait=1800), 'idle': probe('idle', idle=3)}
+    monkeypatch.setattr(clusters, 'probe_cluster', lambda name, *args, **kwargs: probes[name])
+    ranked = clusters.probe_clusters([('queued', 'u', 'f1', ''), ('idle', 'u', 'f2', '')])
+    assert [p['name'] for p in ranked] == ['idle', 'queued']
+
+
+def test_parse_probe():
+    values = parse_probe('status=cached\nsnapshot=/x\nwait=120\nidle=2\nnoise\n')
+    assert values == {'status': 'cached', 'snapshot': '/x', 'wait': '120', 'idle': '2'}
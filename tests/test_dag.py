@@ -0,0 +1,62 @@
+import os
+import json
+
+import pytest
+
+from slurm_jupyter.dag import DependencyException, build_dag, parse_after, topological_order, critical_path
+
+
+def write_notebook(path, **meta):
+    with open(path, 'w') as f:
+        json.dump({'metadata': {'slurm_jupyter': meta}, 'nbformat': 4, 'nbformat_minor': 5, 'cells': []}, f)
+
+
+def test_dependencies_from_declared_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_notebook('download.ipynb', outputs=['data/raw.csv'])
+    write_notebook('clean.ipynb', inputs=['data/raw.csv'], outputs=['data/clean.csv'])
+    write_notebook('plot.ipynb', inputs=['data/clean.csv'], after=['download.ipynb'])
+    write_notebook('other.ipynb')
+    dag = build_dag(['plot.ipynb', 'clean.ipynb', 'download.ipynb', 'other.ipynb'])
+    assert dag == {'download.ipynb': [], 'clean.ipynb': ['download.ipynb'],
+                   'plot.ipynb': ['clean.ipynb', 'download.ipynb'], 'other.ipynb': []}
+    assert topological_order(dag) == ['download.ipynb', 'clean.ipynb', 'plot.ipynb', 'other.ipynb']
+
+
+def test_dependencies_from_after_arguments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_notebook('a.ipynb')
+    write_notebook('b.ipynb')
+    dag = build_dag(['a.ipynb', 'b.ipynb'], after=parse_after(['b.ipynb:a.ipynb']))
+    assert dag == {'a.ipynb': [], 'b.ipynb': ['a.ipynb']}
+
+
+def test_serial_chains_notebooks_in_order():
+    assert build_dag(['c.ipynb', 'a.ipynb', 'b.ipynb'], serial=True) == \
+        {'c.ipynb': [], 'a.ipynb': ['c.ipynb'], 'b.ipynb': ['a.ipynb']}
+
+
+def test_dependency_on_notebook_not_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_notebook('a.ipynb', after=['missing.ipynb'])
+    with pytest.raises(DependencyException, match='not among the notebooks to run'):
+        build_dag(['a.ipynb'])
+
+
+def test_circular_dependencies():
+    with pytest.raises(DependencyException, match='Circular'):
+        topological_order({'a': ['b'], 'b': ['c'], 'c': ['a']})
+
+
+def test_wrongly_formatted_after():
+    with pytest.raises(DependencyException):
+        parse_after(['a.ipynb'])
+    assert parse_after(['a.ipynb:b.ipynb,c.ipynb']) == \
+        {os.path.abspath('a.ipynb'): [os.path.abspath('b.ipynb'), os.path.abspath('c.ipynb')]}
+
+
+def test_critical_path():
+    dag = {'a': [], 'b': ['a'], 'c': ['b'], 'd': ['a']}
+    assert critical_path(dag) == (3, ['a', 'b', 'c'])
+    assert critical_path(dag, weights={'d': 5}) == (6, ['a', 'd'])
+    assert critical_path({}) == (0, [])
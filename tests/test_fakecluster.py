@@ -0,0 +1,72 @@
+import os
+import time
+import subprocess
+
+import fakecluster
+from fakecluster import slurm_time, slurm_seconds, megabytes, expand_array, parse_options
+
+
+def run(*cmd):
+    return subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode()
+
+
+def wait_until_ended(cluster, job_id, timeout=10):
+    start = time.time()
+    while fakecluster.job_state(cluster, job_id) in fakecluster.ACTIVE and time.time() - start < timeout:
+        time.sleep(0.1)
+    return fakecluster.job_state(cluster, job_id)
+
+
+def test_slurm_time():
+    assert slurm_time(3723) == '01:02:03'
+    assert slurm_time(90061) == '1-01:01:01'
+    assert slurm_seconds('30') == 1800
+    assert slurm_seconds('1:00:00') == 3600
+    assert slurm_seconds('2-12') == 2 * 86400 + 12 * 3600
+
+
+def test_megabytes():
+    assert megabytes('8192') == 8192
+    assert megabytes('8G') == 8192
+    assert megabytes('512k') == 0
+
+
+def test_expand_array():
+    assert expand_array('0-3%2') == [0, 1, 2, 3]
+    assert expand_array('1,3,5') == [1, 3, 5]
+
+
+def test_parse_options():
+    options, positional = parse_options(['-p', 'short', '--time=1:00', '-J', 'name', '--parsable', 'job.sh'],
+                                        ['partition', 'time', 'job-name'], {'p': 'partition', 'J': 'job-name'})
+    assert options == {'partition': 'short', 'time': '1:00', 'job-name': 'name', 'parsable': True}
+    assert positional == ['job.sh']
+
+
+def test_ssh_runs_in_cluster_home(cluster):
+    assert run('ssh', 'bench@' + fakecluster.FRONTEND, 'pwd').strip() == os.path.realpath(os.path.join(cluster, 'home'))
+
+
+def test_job_array_lifecycle(cluster):
+    job_id = run('sbatch', '--parsable', '--array=0-2', '--wrap', 'sleep 30').strip()
+    listed = run('squeue', '-h', '-r', '-j', job_id, '-o', '%i|%T')
+    assert sorted(line.split('|')[0] for line in listed.split()) == ['{}_{}'.format(job_id, i) for i in range(3)]
+    run('scancel', job_id)
+    assert [wait_until_ended(cluster, '{}_{}'.format(job_id, i)) for i in range(3)] == ['CANCELLED'] * 3
+    assert run('squeue', '-h', '-j', job_id) == ''
+
+
+def test_sacct_reports_exit(cluster):
+    job_id = run('sbatch', '--parsable', '--wrap', 'exit 3').strip()
+    assert wait_until_ended(cluster, job_id) == 'FAILED'
+    line = run('sacct', '-X', '--noheader', '--parsable2', '--format=JobID,State,ExitCode', '-j', job_id)
+    assert line.strip() == '{}|FAILED|3:0'.format(job_id)
+
+
+def test_launch_cycle(cluster):
+    # starts slurm-jupyter against the fake cluster, loads the page through
+    # the tunnel and stops it with Ctrl-C
+    result = fakecluster.launch_cycle(cluster, 0, hold=1, timeout=90)
+    assert result['ok'], result
+    assert result['job'] == 'CANCELLED'
+    assert result['ready'] < 60
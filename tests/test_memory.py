@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from slurm_jupyter.memory import (MEM_MARK, OOM_MARK, KERNELS_MARK, MemoryTrend, parse_sample, parse_oom,
+                                  parse_kernels, format_kernels, suggested_memory, relaunch_argv)
+
+
+def test_parse_monitor_lines():
+    assert parse_sample(MEM_MARK + ' 100 2048.5 8192') == (100, 2048.5, 8192)
+    assert parse_sample(MEM_MARK + ' garbage') is None
+    assert parse_sample('[I 12:00 ServerApp] Kernel started') is None
+    oom = {'kills': 1, 'pid': 42, 'command': 'python', 'mb': 7000, 'used': 8000, 'peak': 8100, 'reserved': 8192}
+    assert parse_oom(OOM_MARK + json.dumps(oom)) == oom
+    assert parse_oom(MEM_MARK + ' 1 2 3') is None
+    report = {'kernels': 4, 'top': [{'path': 'a.ipynb', 'pss': 2150, 'pid': 1}, {'path': 'b.ipynb', 'pss': 410, 'pid': 2}]}
+    assert format_kernels(parse_kernels(KERNELS_MARK + json.dumps(report))) == 'a.ipynb 2.1 Gb, b.ipynb 0.4 Gb (+2 kernels)'
+    assert format_kernels({'kernels': 0, 'top': []}) == 'no kernels'
+
+
+def test_trend_predicts_time_to_limit():
+    trend = MemoryTrend(min_samples=3)
+    trend.add(0, 1000, 4000)
+    trend.add(5, 1010, 4000)
+    assert trend.fit() is None
+    trend.add(10, 1020, 4000)
+    assert trend.growth() == pytest.approx(7200)
+    assert trend.time_to_limit() == pytest.approx(1490)
+
+
+def test_trend_only_fits_window():
+    trend = MemoryTrend(window=10, min_samples=2)
+    for t in range(0, 30, 5):
+        trend.add(t, 1000 if t < 15 else 3000 - 10 * t, 4000)
+    assert [t for t, used in trend.samples] == [15, 20, 25]
+    assert trend.time_to_limit() is None
+
+
+def test_warnings_are_not_repeated_too_often():
+    trend = MemoryTrend(horizon=1800, repeat=300, min_samples=2)
+    trend.add(0, 1000, 4000)
+    trend.add(5, 1010, 4000)
+    assert trend.warning() == pytest.approx(1495)
+    trend.add(10, 1020, 4000)
+    assert trend.warning() is None
+    trend.add(15, 2500, 4000)
+    assert trend.warning() is not None
+
+
+def test_suggested_memory():
+    assert suggested_memory(8192, 8100) == '12G'
+    assert suggested_memory(8192, 12000) == '15G'
+    assert suggested_memory(8192, None) == '12G'
+
+
+def test_relaunch_argv():
+    argv = ['-e', 'myenv', '-m', '8G', '--memory-per-cpu=2G', '-m16G', '--total-memory', '4G', '-c', '4']
+    assert relaunch_argv(argv, '12G') == ['-e', 'myenv', '-c', '4', '--total-memory', '12G']
@@ -0,0 +1,35 @@
+import os
+import sys
+import json
+
+import pytest
+
+from slurm_jupyter import slurm_nb_run, target_name
+
+
+@pytest.mark.parametrize('option', [['--executor', 'kernel-pool'], ['--incremental']])
+def test_gwf_backend_rejects_kernel_pool(monkeypatch, capsys, tmp_path, option):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(sys, 'argv', ['slurm-nb-run', '--backend', 'gwf'] + option + ['nb.ipynb'])
+    with pytest.raises(SystemExit):
+        slurm_nb_run()
+    assert '--backend gwf' in capsys.readouterr().out
+
+
+def test_target_names_include_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert target_name('a/analysis.ipynb') != target_name('b/analysis.ipynb')
+    assert target_name('analysis.ipynb', 'spike') == 'analysis_spike'
+
+
+def test_clashing_job_names_are_reported(monkeypatch, capsys, tmp_path):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    for path in ['a_b/c.ipynb', 'a/b_c.ipynb']:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5, 'cells': []}, f)
+    monkeypatch.setattr(sys, 'argv', ['slurm-nb-run', 'a_b/c.ipynb', 'a/b_c.ipynb'])
+    with pytest.raises(SystemExit):
+        slurm_nb_run()
+    assert 'same name (a_b_c)' in capsys.readouterr().out
@@ -0,0 +1,44 @@
+from slurm_jupyter.progress import EventLog, ProgressTracker, event_file, job_event_id, read_events
+
+
+def test_job_event_id(monkeypatch):
+    monkeypatch.setenv('SLURM_JOB_ID', '1005')
+    monkeypatch.delenv('SLURM_ARRAY_TASK_ID', raising=False)
+    assert job_event_id() == '1005'
+    monkeypatch.setenv('SLURM_ARRAY_JOB_ID', '1001')
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '4')
+    assert job_event_id() == '1001_4'
+
+
+def test_read_events_waits_for_complete_lines(tmp_path):
+    path = str(tmp_path / 'job.jsonl')
+    assert read_events(path) == ([], 0)
+    with open(path, 'w') as f:
+        f.write('{"t": 1, "e": "run", "nb": "a.ipynb", "i": 0}\nnot json\n{"t": 2, "e": "do')
+    events, offset = read_events(path)
+    assert events == [{'t': 1, 'e': 'run', 'nb': 'a.ipynb', 'i': 0}]
+    with open(path, 'a') as f:
+        f.write('ne", "nb": "a.ipynb", "i": 0, "s": 1.5}\n')
+    events, offset = read_events(path, offset)
+    assert events == [{'t': 2, 'e': 'done', 'nb': 'a.ipynb', 'i': 0, 's': 1.5}]
+    assert read_events(path, offset) == ([], offset)
+
+
+def test_tracker_follows_event_log(tmp_path):
+    path = event_file(str(tmp_path / 'events'), '1001_4')
+    log = EventLog(path, heartbeat=3600)
+    tracker = ProgressTracker()
+    log.write('start', nb='a.ipynb', n=3, k=1)
+    log.cell_started('a.ipynb', 1)
+    assert tracker.update(path)[0]['cell'] == 1
+    log.cell_finished('a.ipynb', 1)
+    log.cell_started('a.ipynb', 2)
+    log.cell_finished('a.ipynb', 2, error='ValueError: bad')
+    log.write('end', nb='a.ipynb', ok=False, s=2.0)
+    log.write('done', nb='b.ipynb', i=0, s=4, m=512)
+    log.close()
+    a, b = tracker.update(path)
+    assert (a['cells'], a['skipped'], a['done'], a['cell'], a['ok']) == (3, 1, 2, None, False)
+    assert a['errors'] == [(2, 'ValueError: bad')]
+    assert (b['slowest'], b['memory'], b['max_memory']) == ((4, 0), 512, 512)
+    assert tracker.update(path) == [a, b]
@@ -0,0 +1,49 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from slurm_jupyter import readiness
+from slurm_jupyter.readiness import parse_server_info, wait_for_server
+
+
+def test_parse_server_info():
+    text = '{"port": 8888, "token": "a"}\n{"port": 9999}\n\n{"port": 77'
+    assert parse_server_info(text) == [{'port': 8888, 'token': 'a'}, {'port': 9999}]
+    assert parse_server_info('') == []
+
+
+@pytest.fixture
+def server():
+    """A local http server answering /api/status when given the token 'secret'."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.headers.get('Authorization') == 'token secret' else 403)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+
+
+def test_wait_for_server_skips_stale_runtime_info(server, monkeypatch):
+    spec = {'port': server, 'hostport': 8888, 'run': 'lab'}
+    infos = [{'port': 8888, 'token': 'stale', 'base_url': '/', 'secure': False},
+             {'port': 8888, 'token': 'secret', 'base_url': '/', 'secure': False}]
+    calls = []
+    monkeypatch.setattr(readiness, 'server_info', lambda spec, verbose=False: calls.append(1) or list(infos))
+    run_event = threading.Event()
+    run_event.set()
+    url, counts = wait_for_server(spec, run_event, interval=0.01)
+    assert url == 'http://127.0.0.1:{}/lab?token=secret'.format(server)
+    assert counts['ssh_calls'] == len(calls) == 1
+
+
+def test_wait_for_server_stops_when_event_is_cleared():
+    assert wait_for_server({'port': 1, 'hostport': 1, 'run': 'lab'}, threading.Event()) is None
@@ -0,0 +1,51 @@
+import os
+import json
+
+import pytest
+
+from slurm_jupyter.spike import SpikeException, make_variants, variant_path
+
+
+def write_notebook(path, sources, nbformat=4):
+    with open(path, 'w') as f:
+        json.dump({'metadata': {}, 'nbformat': nbformat, 'nbformat_minor': 5,
+                   'cells': [{'cell_type': 'code', 'source': s, 'metadata': {}, 'execution_count': 3,
+                              'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': 'old'}]}
+                             for s in sources]}, f)
+
+
+def read_cells(path):
+    with open(path) as f:
+        return json.load(f)['cells']
+
+
+def test_variant_path():
+    assert variant_path('dir/analysis.ipynb', 'params/low.py') == os.path.join('dir', 'analysis', 'analysis_low.ipynb')
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_variants_get_parameter_cell(tmp_path, monkeypatch, processes):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('slurm_jupyter.spike.MIN_PARALLEL_VARIANTS', 2)
+    write_notebook('nb.ipynb', ['x = 1', 'print("é", x)'])
+    variants = make_variants(['nb.ipynb'], ['low.py', 'high.py'], processes=processes)
+    assert variants == {'low.py': {'nb.ipynb': variant_path('nb.ipynb', 'low.py')},
+                        'high.py': {'nb.ipynb': variant_path('nb.ipynb', 'high.py')}}
+    cells = read_cells(variants['high.py']['nb.ipynb'])
+    assert [c['source'] for c in cells] == ['%run ' + os.path.abspath('high.py'), 'x = 1', 'print("é", x)']
+    assert all(c['outputs'] == [] and c['execution_count'] is None for c in cells)
+
+
+def test_variants_replace_run_magic(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_notebook('nb.ipynb', ['import os', '%run defaults.py\ny = 2'])
+    variants = make_variants(['nb.ipynb'], ['low.py'], replace_run_magic=True)
+    cells = read_cells(variants['low.py']['nb.ipynb'])
+    assert [c['source'] for c in cells] == ['import os', '%run {}\ny = 2'.format(os.path.abspath('low.py'))]
+
+
+def test_old_notebook_format(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_notebook('nb.ipynb', [], nbformat=3)
+    with pytest.raises(SpikeException):
+        make_variants(['nb.ipynb'], ['low.py'])
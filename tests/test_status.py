@@ -0,0 +1,37 @@
+import pytest
+
+from slurm_jupyter import status
+from slurm_jupyter.status import memory_mb, parse_status, fetch_status
+
+SQUEUE = '\n'.join([
+    '1001|sjup_bench_lab_myenv_4242|RUNNING|cn-1|7:59:00|8:00:00|8G|2|/home/bench/.slurm_jupyter/sjup.sh',
+    '1002|slurm_jupyter_run|PENDING||8:00:00|8:00:00|8000M|1|/home/bench/slurm_jupyter_run_1_2_nb.sh',
+    '1003|other|RUNNING|cn-2|1:00|1:00|1G|1|/home/bench/other.sh',
+    '1004|short|RUNNING'])
+SSTAT = '\n'.join(['1001.batch|2097152K', '1001.0|1048576K', '1003.batch|10K', 'garbage'])
+
+
+@pytest.mark.parametrize('size,default_unit,mb', [('8G', 'M', 8192), ('8000M', 'M', 8000), ('1024K', 'M', 1),
+                                                  ('2048', 'K', 2), ('1.5T', 'M', 1.5 * 1024**2), ('', 'M', None)])
+def test_memory_mb(size, default_unit, mb):
+    assert memory_mb(size, default_unit) == mb
+
+
+def test_parse_status():
+    jobs = parse_status(SQUEUE + '\n--\n' + SSTAT + '\n')
+    assert [(j['job_id'], j['kind']) for j in jobs] == [('1001', 'server'), ('1002', 'nb-run')]
+    server, run = jobs
+    assert server['environment'] == 'myenv' and server['node'] == 'cn-1'
+    assert (server['memory_requested'], server['memory_used']) == (8192, 2048)
+    assert (run['node'], run['memory_used']) == (None, None)
+
+
+def test_fetch_status_reuses_recent_status(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    calls = []
+    monkeypatch.setattr(status, 'execute', lambda cmd, stdin=None: calls.append(stdin) or ((SQUEUE + '\n--\n').encode(), b''))
+    jobs, fetched = fetch_status('bench', 'login.fake')
+    assert fetch_status('bench', 'login.fake') == (jobs, fetched)
+    assert len(calls) == 1 and b"squeue -h -u bench" in calls[0]
+    fetch_status('bench', 'login.fake', max_age=0)
+    assert len(calls) == 2
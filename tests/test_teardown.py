@@ -0,0 +1,47 @@
+import sys
+import threading
+import subprocess
+
+from slurm_jupyter.teardown import Teardown
+
+
+def sleeper():
+    return subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+
+
+def test_teardown_cancels_and_stops_everything_once(tmp_path):
+    cancelled = tmp_path / 'cancelled'
+    run_event = threading.Event()
+    run_event.set()
+    thread = threading.Thread(target=run_event.wait)
+    teardown = Teardown(run_event=run_event)
+    teardown.cancel_command = 'touch {}'.format(cancelled)
+    process = sleeper()
+    thread.start()
+    teardown.add(process, thread)
+    assert teardown.run() is True
+    assert cancelled.exists()
+    assert process.poll() is not None
+    assert not run_event.is_set()
+    cancelled.unlink()
+    assert teardown.run() is None
+    assert not cancelled.exists()
+
+
+def test_teardown_kills_processes_ignoring_terminate():
+    process = subprocess.Popen([sys.executable, '-c',
+                                'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                                'print(flush=True); time.sleep(60)'], stdout=subprocess.PIPE)
+    process.stdout.readline()
+    teardown = Teardown(timeout=0.5)
+    teardown.add(process)
+    assert teardown.run() is None
+    assert process.wait(timeout=5) == -9
+
+
+def test_failed_cancel_is_reported(capsys):
+    teardown = Teardown()
+    teardown.cancel_command = 'false'
+    assert teardown.run(message='Stopping') is False
+    out = capsys.readouterr().out
+    assert 'Stopping' in out and 'Could not cancel slurm job (false)' in out
@@ -0,0 +1,64 @@
+import json
+import threading
+
+from slurm_jupyter.tracing import PhaseTrace
+
+
+def depths(trace):
+    return dict((e['name'], e['args']['depth']) for e in trace.events if e['ph'] == 'X')
+
+
+def test_nested_phases():
+    trace = PhaseTrace()
+    with trace.span('launch'):
+        with trace.span('sbatch'):
+            pass
+    assert depths(trace) == {'launch': 0, 'sbatch': 1}
+    assert trace.breakdown().endswith('launch 0.0 s')
+
+
+def test_phases_in_other_threads_are_not_nested():
+    trace = PhaseTrace()
+    started, done = threading.Event(), threading.Event()
+
+    def ready():
+        trace.begin('readiness')
+        started.set()
+        done.wait()
+        with trace.span('probe'):
+            pass
+        trace.end('readiness')
+
+    t = threading.Thread(target=ready)
+    t.start()
+    started.wait()
+    with trace.span('log wait'):
+        pass
+    done.set()
+    t.join()
+    assert depths(trace) == {'readiness': 0, 'probe': 1, 'log wait': 0}
+    tids = dict((e['name'], e['tid']) for e in trace.events)
+    assert tids['readiness'] == tids['probe'] != tids['log wait']
+
+
+def test_phase_ended_by_other_thread():
+    trace = PhaseTrace()
+    trace.begin('readiness')
+    t = threading.Thread(target=trace.end, args=('readiness',), kwargs={'ready': True})
+    t.start()
+    t.join()
+    trace.begin('next')
+    assert trace.open['next'][1] == 0
+    assert trace.events[0]['args'] == {'ready': True, 'depth': 0}
+
+
+def test_save_includes_unfinished_phases(tmp_path):
+    trace = PhaseTrace()
+    trace.begin('wait')
+    trace.mark('browser open')
+    path = str(tmp_path / 'traces' / 'trace.json')
+    trace.save(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events] == ['browser open', 'wait']
+    assert events[1]['args'] == {'depth': 0, 'unfinished': True}
@@ -0,0 +1,46 @@
+import os
+import subprocess
+
+from slurm_jupyter import wait_for_jobs, submit_slurm_batch_job
+from slurm_jupyter.backend import NEVER_SATISFIED, job_states, count_states
+
+
+def sbatch(command, *options):
+    process = subprocess.run(['sbatch', '--parsable'] + list(options) + ['--wrap', command],
+                             stdout=subprocess.PIPE, check=True)
+    return process.stdout.decode().strip()
+
+
+def batch_spec(name, commands):
+    os.makedirs('.slurm_jupyter', exist_ok=True)
+    return {'queue': 'normal', 'gres': '', 'memory_spec': '', 'nr_nodes': 1, 'nr_cores': 1, 'walltime': '00:10:00',
+            'tmp_dir': '.slurm_jupyter', 'tmp_name': 'test', 'log_id': '%j', 'job_name': name, 'array_spec': '',
+            'account_spec': '', 'sources_loaded': '', 'cwd': os.getcwd(), 'activation': '', 'stage': '',
+            'commands': commands, 'tmp_script': name + '.sh'}
+
+
+def test_count_states():
+    states = {'1': ('COMPLETED', '0:0', ''), '2_0': ('FAILED', '1:0', ''), '2_1': ('COMPLETED', '0:0', '')}
+    assert count_states(states) == {'COMPLETED': 2, 'FAILED': 1}
+
+
+def test_wait_for_jobs(cluster, capsys):
+    job_ids = [sbatch('sleep 0.5'), sbatch('exit 1')]
+    wait_for_jobs(job_ids, interval=0.2)
+    assert sorted(state for state, exit_code, elapsed in job_states(job_ids).values()) == ['COMPLETED', 'FAILED']
+    assert 'COMPLETED: 1, FAILED: 1' in capsys.readouterr().out
+
+
+def test_dependents_of_failed_job_are_removed(cluster):
+    failing = submit_slurm_batch_job(batch_spec('failing', 'exit 1'))
+    dependent = submit_slurm_batch_job(batch_spec('dependent', 'true'), dependencies=[failing])
+    wait_for_jobs([failing, dependent], interval=0.2)
+    assert job_states([dependent])[dependent][0] == 'CANCELLED'
+
+
+def test_wait_ends_on_dependency_never_satisfied(cluster, capsys):
+    failing = sbatch('exit 1')
+    dependent = sbatch('true', '--dependency=afterok:' + failing)
+    wait_for_jobs([failing, dependent], interval=0.2)
+    assert job_states([dependent])[dependent][0] == NEVER_SATISFIED
+    assert '{}: 1'.format(NEVER_SATISFIED) in capsys.readouterr().out
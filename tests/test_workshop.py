@@ -0,0 +1,73 @@
+import os
+import json
+import stat
+import subprocess
+
+import fakecluster
+from slurm_jupyter.workshop import (BEACON_ROOT, collect, parse_collect, count_task_states, roster_rows,
+                                    write_roster, save_workshop, load_workshop, read_students)
+
+WORKSHOP = {'job_id': '1001', 'frontend': 'login.fake', 'run': 'lab', 'students': ['ann', 'bob', 'cat']}
+
+
+def beacon(task, node='cn-1'):
+    return {'task': task, 'job_id': '1001_{}'.format(task), 'node': node, 'hostport': 20000 + task,
+            'token': 'tok{}'.format(task), 'scheme': 'http', 'base_url': '/', 'ready': 0}
+
+
+def test_parse_collect():
+    text = '1001_0|RUNNING|cn-1\n1001_1|PENDING|\n--\n{}\nnot json\n'.format(json.dumps(beacon(0)))
+    states, beacons = parse_collect(text)
+    assert states == {0: ('RUNNING', 'cn-1'), 1: ('PENDING', None)}
+    assert list(beacons) == [0]
+
+
+def test_count_before_array_is_listed():
+    counts = count_task_states({}, {}, 3)
+    assert counts == {'ready': 0, 'starting': 0, 'pending': 3, 'ended': 0}
+
+
+def test_count_unlisted_tasks_as_ended_once_seen():
+    states = {0: ('RUNNING', 'cn-1'), 1: ('RUNNING', 'cn-2')}
+    counts = count_task_states(states, {0: beacon(0), 2: beacon(2)}, 3, seen=True)
+    assert counts == {'ready': 1, 'starting': 1, 'pending': 0, 'ended': 1}
+
+
+def test_roster_ignores_beacons_of_ended_tasks():
+    states = {0: ('RUNNING', 'cn-1'), 1: ('PENDING', None)}
+    rows = roster_rows(WORKSHOP, states, {0: beacon(0), 2: beacon(2, node='cn-3')})
+    assert rows[0]['url'] == 'http://cn-1:20000/lab?token=tok0'
+    assert rows[0]['tunnel'] == 'ssh -N -L 20000:cn-1:20000 USER@login.fake'
+    assert [r['state'] for r in rows] == ['RUNNING', 'PENDING', 'ENDED']
+    assert rows[1]['url'] == rows[2]['url'] == ''
+
+
+def test_write_roster_private(tmp_path):
+    path = str(tmp_path / 'roster.csv')
+    write_roster(path, roster_rows(WORKSHOP, {0: ('RUNNING', 'cn-1')}, {0: beacon(0)}))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with open(path) as f:
+        assert f.readline().strip() == 'student,task,state,node,port,url,tunnel,local_url'
+
+
+def test_collect_from_cluster(cluster):
+    job_id = subprocess.run(['sbatch', '--parsable', '--array=0-2', '--wrap', 'sleep 30'],
+                            stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+    beacon_dir = os.path.join(cluster, 'home', BEACON_ROOT, job_id)
+    os.makedirs(beacon_dir)
+    with open(os.path.join(beacon_dir, '1.json'), 'w') as f:
+        json.dump(beacon(1), f)
+    states, beacons = collect('bench', fakecluster.FRONTEND, job_id)
+    subprocess.run(['scancel', job_id], check=True)
+    assert sorted(states) == [0, 1, 2]
+    assert list(beacons) == [1]
+
+
+def test_workshop_record_and_students(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert load_workshop('1001') is None
+    save_workshop(WORKSHOP)
+    assert load_workshop('1001') == WORKSHOP
+    path = tmp_path / 'students.txt'
+    path.write_text('# class of 2026\nann\n\n bob \n')
+    assert read_students(str(path)) == ['ann', 'bob']